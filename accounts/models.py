@@ -15,6 +15,10 @@ class UserProfile(models.Model):
     # After a user is created, there is an object called user profile.
     # At this time, user nickname is not set yet, so set null=True.
     nickname = models.CharField(null=True, max_length=200)
+    # maintained by FriendshipService, cached in redis like likes_count of
+    # tweets, see FriendshipService.get_follower_count
+    followers_count = models.IntegerField(default=0, null=True)
+    followings_count = models.IntegerField(default=0, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
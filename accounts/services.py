@@ -29,6 +29,66 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def prefetch_users(cls, instances, id_attr='user_id',
+                       cached_attr='_cached_user'):
+        # load users of a page along with their profiles in batch
+        MemcachedHelper.prefetch_objects(instances, User, id_attr, cached_attr)
+        cls.prefetch_profiles([
+            getattr(instance, cached_attr, None)
+            for instance in instances
+        ])
+
+    @classmethod
+    def prefetch_profiles(cls, users):
+        """
+        Batch version of get_profile_through_cache for a page of users.
+        Profiles are attached to users the same way as get_profile does,
+        so user.profile won't query memcached again.
+        """
+        users = [
+            user
+            for user in users
+            if user is not None and not hasattr(user, '_cached_user_profile')
+        ]
+        if not users:
+            return
+        key_to_user_id = {
+            USER_PROFILE_PATTERN.format(user_id=user.id): user.id
+            for user in users
+        }
+
+        # read from cache first
+        cached = cache.get_many(list(key_to_user_id.keys()))
+        profiles = {
+            key_to_user_id[key]: profile
+            for key, profile in cached.items()
+            if profile is not None
+        }
+
+        # cache miss, read from db in one query
+        missing_ids = [
+            user_id
+            for user_id in key_to_user_id.values()
+            if user_id not in profiles
+        ]
+        if missing_ids:
+            for profile in UserProfile.objects.filter(user_id__in=missing_ids):
+                profiles[profile.user_id] = profile
+            # profile is created lazily, see get_profile_through_cache
+            for user_id in missing_ids:
+                if user_id not in profiles:
+                    profiles[user_id], _ = UserProfile.objects.get_or_create(
+                        user_id=user_id,
+                    )
+            cache.set_many({
+                USER_PROFILE_PATTERN.format(user_id=user_id): profiles[user_id]
+                for user_id in missing_ids
+            })
+
+        for user in users:
+            setattr(user, '_cached_user_profile', profiles[user.id])
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
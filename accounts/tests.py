@@ -1,4 +1,5 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
 from testing.testcases import TestCase
 
 
@@ -13,3 +14,20 @@ class UserProfileTests(TestCase):
         p = user1.profile
         self.assertEqual(isinstance(p, UserProfile), True)
         self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_prefetch_profiles(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        user1.profile.nickname = 'nick1'
+        user1.profile.save()
+
+        users = [
+            UserService.get_user_by_id(user1.id),
+            UserService.get_user_by_id(user2.id),
+        ]
+        UserService.prefetch_profiles(users)
+        # missing profile is created the same way as user.profile
+        self.assertEqual(UserProfile.objects.count(), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(users[0].profile.nickname, 'nick1')
+            self.assertEqual(users[1].profile.nickname, None)
@@ -0,0 +1,8 @@
+import django
+import os
+
+
+def setup_django():
+    # the benchmarks run outside of manage.py, models need the app registry
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'twitter.settings')
+    django.setup()
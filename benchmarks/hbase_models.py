@@ -0,0 +1,108 @@
+"""
+Measure how fast rows returned by a scan are turned into instances, e.g.
+    python -m benchmarks.hbase_models --count 1000
+
+Rows are built in memory the way happybase returns them, no hbase
+thrift server is needed.
+"""
+from benchmarks import setup_django
+
+import argparse
+import time
+
+
+def run(instances, rounds):
+    model_class = instances[0].__class__
+    init_time, serialize_time = 0, 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        # happybase returns bytes for both row keys and cells
+        rows = [
+            (
+                instance.row_key,
+                {
+                    key.encode('utf-8'): value.encode('utf-8')
+                    for key, value in model_class.serialize_row_data(instance.__dict__).items()
+                },
+            )
+            for instance in instances
+        ]
+        serialize_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for row_key, row_data in rows:
+            model_class.init_from_row(row_key, row_data)
+        init_time += time.perf_counter() - start
+
+    total = len(instances) * rounds
+    print('{:<16} {:>16.0f} {:>16.0f}'.format(
+        model_class.__name__,
+        total / init_time,
+        total / serialize_time,
+    ))
+
+
+def run_codec(instances, codec, rounds):
+    model_class = instances[0].__class__
+    encode_time, decode_time = 0, 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        row_keys = [
+            model_class.serialize_row_key(instance.__dict__, codec=codec)
+            for instance in instances
+        ]
+        encode_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for row_key in row_keys:
+            model_class.deserialize_row_key(row_key, codec=codec)
+        decode_time += time.perf_counter() - start
+
+    total = len(instances) * rounds
+    print('{:<16} {:<8} {:>10.1f} {:>16.0f} {:>16.0f}'.format(
+        model_class.__name__,
+        codec.name,
+        sum(len(row_key) for row_key in row_keys) / len(row_keys),
+        total / encode_time,
+        total / decode_time,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark rows/s of HBaseModel.init_from_row, serialization and row key codecs',
+    )
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=20)
+    options = parser.parse_args()
+
+    setup_django()
+    from django_hbase.models.row_key_codecs import ROW_KEY_CODECS
+    from friendships.models import HBaseFollower
+    from newsfeeds.models import HBaseNewsFeed
+
+    timestamp = 1600000000000000
+    newsfeeds = [
+        HBaseNewsFeed(user_id=1, created_at=timestamp + i, tweet_id=i + 1)
+        for i in range(options.count)
+    ]
+    followers = [
+        HBaseFollower(to_user_id=1, created_at=timestamp + i, from_user_id=i + 1)
+        for i in range(options.count)
+    ]
+
+    print('{:<16} {:>16} {:>16}'.format('model', 'init_from_row/s', 'serialize/s'))
+    for instances in [newsfeeds, followers]:
+        run(instances, options.rounds)
+
+    print('')
+    print('{:<16} {:<8} {:>10} {:>16} {:>16}'.format(
+        'model', 'codec', 'key bytes', 'encode/s', 'decode/s',
+    ))
+    for instances in [newsfeeds, followers]:
+        for codec in ROW_KEY_CODECS.values():
+            run_codec(instances, codec, options.rounds)
+
+
+if __name__ == '__main__':
+    main()
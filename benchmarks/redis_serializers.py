@@ -0,0 +1,85 @@
+"""
+Compare the serializers used for the redis cached lists, e.g.
+    python -m benchmarks.redis_serializers --count 1000
+
+Instances are built in memory, no database or redis is needed.
+"""
+from benchmarks import setup_django
+
+import argparse
+import time
+
+
+def run(serializer, objects, rounds):
+    serialize_time, deserialize_time = 0, 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        serialized_list = [serializer.serialize(obj) for obj in objects]
+        serialize_time += time.perf_counter() - start
+
+        # redis returns bytes
+        serialized_list = [
+            data if isinstance(data, bytes) else data.encode('utf-8')
+            for data in serialized_list
+        ]
+        start = time.perf_counter()
+        for data in serialized_list:
+            serializer.deserialize(data)
+        deserialize_time += time.perf_counter() - start
+
+    total = len(objects) * rounds
+    bytes_per_entry = sum(len(data) for data in serialized_list) / len(objects)
+    print('{:<10} {:<30} {:>10.1f} {:>16.0f} {:>16.0f}'.format(
+        objects[0].__class__.__name__,
+        serializer.__name__,
+        bytes_per_entry,
+        total / serialize_time,
+        total / deserialize_time,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark bytes per entry and throughput of redis serializers',
+    )
+    # REDIS_LIST_LENGTH_LIMIT in production
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=5)
+    options = parser.parse_args()
+
+    setup_django()
+    from newsfeeds.models import NewsFeed
+    from tweets.models import Tweet
+    from utils.redis_serializers import (
+        CompactDjangoModelSerializer,
+        DjangoModelSerializer,
+    )
+    from utils.time_helpers import utc_now
+
+    now = utc_now()
+    tweets = [
+        Tweet(
+            id=i + 1,
+            user_id=i % 100 + 1,
+            content='benchmark tweet content {}'.format(i),
+            created_at=now,
+            likes_count=i,
+            comments_count=i,
+        )
+        for i in range(options.count)
+    ]
+    newsfeeds = [
+        NewsFeed(id=i + 1, user_id=1, tweet_id=i + 1, created_at=now)
+        for i in range(options.count)
+    ]
+
+    print('{:<10} {:<30} {:>10} {:>16} {:>16}'.format(
+        'model', 'serializer', 'bytes', 'serialize/s', 'deserialize/s',
+    ))
+    for objects in [tweets, newsfeeds]:
+        for serializer in [DjangoModelSerializer, CompactDjangoModelSerializer]:
+            run(serializer, objects, options.rounds)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 from likes.services import LikeService
+from utils.serializers import PrefetchListSerializer
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -22,11 +24,22 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, comments):
+        UserService.prefetch_users(comments)
+        self._liked_object_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Comment,
+            [comment.id for comment in comments],
+        )
 
     def get_likes_count(self, obj):
         return obj.like_set.count()
 
     def get_has_liked(self, obj):
+        if hasattr(self, '_liked_object_ids'):
+            return obj.id in self._liked_object_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
 
@@ -1,14 +1,52 @@
+from contextlib import contextmanager
 from django.conf import settings
+from django_hbase.memory_backend import MemoryConnection
 
 import happybase
+import os
+import threading
 
 
 class HBaseClient:
-    conn = None
+    pool = None
+    pid = None
+    lock = threading.Lock()
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
+    def get_pool(cls):
+        # One pool per process, shared by its threads. A forked process,
+        # like a celery prefork child, must not use the thrift sockets of its
+        # parent, it creates its own pool the first time it asks for one.
+        pid = os.getpid()
+        if cls.pool and cls.pid == pid:
+            return cls.pool
+        with cls.lock:
+            if cls.pool is None or cls.pid != pid:
+                cls.pool = happybase.ConnectionPool(
+                    size=settings.HBASE_POOL_SIZE,
+                    host=settings.HBASE_HOST,
+                    port=settings.HBASE_PORT,
+                    timeout=settings.HBASE_SOCKET_TIMEOUT,
+                )
+                cls.pid = pid
+        return cls.pool
+
+    @classmethod
+    @contextmanager
+    def connection(cls):
+        """
+        with HBaseClient.connection() as conn:
+            conn.table(...)
+
+        The connection goes back to the pool when the block ends, anything
+        read through it has to be read inside the block. When a thrift
+        error (e.g. TTransportException) is raised inside the block, the
+        pool reconnects the connection before the error is re-raised, so a
+        broken socket is not handed out again.
+        """
+        if settings.HBASE_BACKEND == 'memory':
+            yield MemoryConnection()
+            return
+        pool = cls.get_pool()
+        with pool.connection(timeout=settings.HBASE_POOL_TIMEOUT) as conn:
+            yield conn
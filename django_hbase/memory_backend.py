@@ -0,0 +1,276 @@
+"""
+In process stand-in for the subset of happybase used by HBaseModel, for
+tests and benchmarks on a machine without an hbase thrift server, see
+HBASE_BACKEND in settings.
+
+Tables live in this module, shared by all connections of the process, and
+keep their row keys in a sorted list like hbase keeps them in regions.
+Filter strings support KeyOnlyFilter, FirstKeyOnlyFilter and
+SingleColumnValueFilter with binary comparators joined by AND.
+"""
+from happybase.util import bytes_increment
+
+import bisect
+import re
+import threading
+
+tables = {}
+tables_lock = threading.Lock()
+
+
+def to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return bytes(str(value), encoding='utf-8')
+
+
+class MemoryConnection:
+
+    def table(self, name):
+        # unlike hbase a missing table is created on first use, benchmarks
+        # outside of unit tests can not create tables
+        name = to_bytes(name)
+        with tables_lock:
+            if name not in tables:
+                tables[name] = MemoryTable(name)
+            return tables[name]
+
+    def tables(self):
+        with tables_lock:
+            return sorted(tables)
+
+    def create_table(self, name, families):
+        with tables_lock:
+            tables[to_bytes(name)] = MemoryTable(to_bytes(name))
+
+    def delete_table(self, name, disable=False):
+        with tables_lock:
+            tables.pop(to_bytes(name), None)
+
+
+class MemoryTable:
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        # sorted row keys and {row key: {column key: value}}
+        self.row_keys = []
+        self.data = {}
+
+    def put(self, row, data):
+        row = to_bytes(row)
+        with self.lock:
+            if row not in self.data:
+                bisect.insort(self.row_keys, row)
+                self.data[row] = {}
+            for column, value in data.items():
+                self.data[row][to_bytes(column)] = to_bytes(value)
+
+    def delete(self, row, columns=None):
+        row = to_bytes(row)
+        with self.lock:
+            if row not in self.data:
+                return
+            if columns is not None:
+                row_data = self._select(self.data[row], columns)
+                for column in row_data:
+                    del self.data[row][column]
+                if self.data[row]:
+                    return
+            del self.data[row]
+            del self.row_keys[bisect.bisect_left(self.row_keys, row)]
+
+    def row(self, row, columns=None):
+        with self.lock:
+            return self._select(self.data.get(to_bytes(row), {}), columns)
+
+    def rows(self, rows, columns=None):
+        # like hbase, rows not found are left out
+        results = []
+        with self.lock:
+            for row in rows:
+                row_data = self._select(self.data.get(to_bytes(row), {}), columns)
+                if row_data:
+                    results.append((to_bytes(row), row_data))
+        return results
+
+    def batch(self, batch_size=None, **kwargs):
+        return MemoryBatch(self)
+
+    def scan(self, row_start=None, row_stop=None, row_prefix=None, columns=None,
+             filter=None, timestamp=None, include_timestamp=False,
+             batch_size=1000, scan_batching=None, limit=None,
+             sorted_columns=False, reverse=False):
+        # same argument handling as happybase.Table.scan
+        if row_prefix is not None:
+            if row_start is not None or row_stop is not None:
+                raise TypeError(
+                    "'row_prefix' cannot be combined with 'row_start' or 'row_stop'"
+                )
+            if reverse:
+                row_start, row_stop = bytes_increment(row_prefix), row_prefix
+            else:
+                row_start, row_stop = row_prefix, bytes_increment(row_prefix)
+        row_start = to_bytes(row_start) if row_start else None
+        row_stop = to_bytes(row_stop) if row_stop else None
+        row_filter = MemoryFilter(filter)
+
+        with self.lock:
+            # a reversed scan starts at row_start included and stops before
+            # row_stop, both are upper and lower bounds then
+            if reverse:
+                begin = 0 if row_stop is None else bisect.bisect_right(self.row_keys, row_stop)
+                end = len(self.row_keys) if row_start is None else \
+                    bisect.bisect_right(self.row_keys, row_start)
+                row_keys = self.row_keys[begin:end][::-1]
+            else:
+                begin = 0 if row_start is None else bisect.bisect_left(self.row_keys, row_start)
+                end = len(self.row_keys) if row_stop is None else \
+                    bisect.bisect_left(self.row_keys, row_stop)
+                row_keys = self.row_keys[begin:end]
+
+        return self._iter_rows(row_keys, columns, row_filter, limit)
+
+    def _iter_rows(self, row_keys, columns, row_filter, limit):
+        count = 0
+        for row_key in row_keys:
+            if limit is not None and count >= limit:
+                return
+            with self.lock:
+                row_data = self.data.get(row_key)
+                if row_data is None:
+                    # deleted after the scan started
+                    continue
+                row_data = self._select(row_data, columns)
+            row_data = row_filter.apply(row_data)
+            if not row_data:
+                continue
+            count += 1
+            yield row_key, row_data
+
+    def _select(self, row_data, columns):
+        # columns are b'cf:column' or whole column families b'cf'
+        if not columns:
+            return dict(row_data)
+        columns = [to_bytes(column) for column in columns]
+        return {
+            column: value
+            for column, value in row_data.items()
+            if column in columns or column.split(b':', 1)[0] in columns
+        }
+
+
+class MemoryBatch:
+
+    def __init__(self, table):
+        self.table = table
+        self.mutations = []
+
+    def put(self, row, data):
+        self.mutations.append((self.table.put, (row, data)))
+
+    def delete(self, row, columns=None):
+        self.mutations.append((self.table.delete, (row, columns)))
+
+    def send(self):
+        for mutation, args in self.mutations:
+            mutation(*args)
+        self.mutations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+
+class MemoryFilter:
+    """
+    "(SingleColumnValueFilter('cf', 'key', =, 'binary:value')) AND KeyOnlyFilter()"
+    parsed into functions applied to the cells of every row
+    """
+    TERM = re.compile(r'^(\w+)\((.*)\)$', re.DOTALL)
+    OPERATORS = {
+        '=': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+    }
+
+    def __init__(self, filter_string):
+        self.functions = []
+        if filter_string:
+            for term in self._split(to_bytes(filter_string).decode('utf-8'), ' AND '):
+                self.functions.append(self._parse_term(term))
+
+    def apply(self, row_data):
+        for function in self.functions:
+            if not row_data:
+                break
+            row_data = function(row_data)
+        return row_data
+
+    def _split(self, text, separator):
+        # split by separator outside of parentheses and quotes
+        parts, depth, quoted, start, index = [], 0, False, 0, 0
+        while index < len(text):
+            char = text[index]
+            if char == "'":
+                quoted = not quoted
+            elif not quoted and char == '(':
+                depth += 1
+            elif not quoted and char == ')':
+                depth -= 1
+            elif not quoted and depth == 0 and text.startswith(separator, index):
+                parts.append(text[start:index])
+                index += len(separator)
+                start = index
+                continue
+            index += 1
+        parts.append(text[start:])
+        return [part.strip() for part in parts]
+
+    def _parse_term(self, term):
+        while term.startswith('(') and term.endswith(')') and \
+                len(self._split(term[1:-1], ' AND ')) == 1 and \
+                not self.TERM.match(term):
+            term = term[1:-1].strip()
+        if len(self._split(term, ' AND ')) > 1:
+            sub_filter = MemoryFilter(term)
+            return sub_filter.apply
+
+        match = self.TERM.match(term)
+        if match is None:
+            raise NotImplementedError('filter not supported in memory: {}'.format(term))
+        name, arguments = match.group(1), self._split(match.group(2), ',')
+        if name == 'KeyOnlyFilter':
+            return lambda row_data: {column: b'' for column in row_data}
+        if name == 'FirstKeyOnlyFilter':
+            return lambda row_data: {min(row_data): row_data[min(row_data)]}
+        if name == 'SingleColumnValueFilter':
+            return self._single_column_value_filter(*arguments[:4])
+        raise NotImplementedError('filter not supported in memory: {}'.format(term))
+
+    def _single_column_value_filter(self, family, qualifier, operator, comparator):
+        column = to_bytes('{}:{}'.format(self._unquote(family), self._unquote(qualifier)))
+        comparator = self._unquote(comparator)
+        if not comparator.startswith('binary:'):
+            raise NotImplementedError('comparator not supported in memory: {}'.format(comparator))
+        expected = to_bytes(comparator[len('binary:'):])
+        compare = self.OPERATORS[operator]
+
+        def _filter(row_data):
+            # like hbase, rows without the column are not filtered out
+            if column not in row_data or compare(row_data[column], expected):
+                return row_data
+            return {}
+        return _filter
+
+    def _unquote(self, value):
+        value = value.strip()
+        if value.startswith("'") and value.endswith("'"):
+            value = value[1:-1].replace("''", "'")
+        return value
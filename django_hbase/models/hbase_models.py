@@ -1,7 +1,14 @@
+from contextlib import contextmanager
 from django_hbase.client import HBaseClient
 from django.conf import settings
 from django_hbase.models import HBaseField, IntegerField, TimestampField
 from django_hbase.models.exceptions import BadRowKeyError, EmptyColumnError
+from django_hbase.models.row_key_codecs import ROW_KEY_CODECS, StringRowKeyCodec
+
+import heapq
+import itertools
+import operator
+import zlib
 
 
 class HBaseModel:
@@ -9,11 +16,82 @@ class HBaseModel:
     class Meta:
         table_name = None
         row_key = ()
+        # 'string' or 'binary', see django_hbase/models/row_key_codecs.py
+        row_key_codec = 'string'
+        # Set to the previous row_key_codec while migrating a table. Rows
+        # with legacy keys are still read, and moved to row_key_codec when
+        # they are saved again.
+        legacy_row_key_codec = None
+        # Spread rows over N buckets (2 to 256) by a one byte salt in front
+        # of the row key, derived from the first row key field. Rows of one
+        # value of that field stay in one bucket, scans over more values
+        # read all buckets and merge. Writes over many values of the first
+        # field spread over N buckets, only worth it for N larger than the
+        # 10 ranges a reversed integer field gives already. Legacy rows are
+        # read without salt.
+        salt_buckets = None
+
+    # Field metadata, computed once per model class in __init_subclass__
+    # instead of walking cls.__dict__ for every row and every cell.
+    # {key: field}
+    _field_hash = {}
+    # ((key, field), ...) in row key order
+    _row_key_fields = ()
+    # ((key, field, column key), ...) of the fields stored in columns
+    _column_fields = ()
+    _column_families = ()
+    # {key: decoder}, decoder turns the stored value back into python
+    _field_decoders = {}
+    # {b'cf:key': (key, decoder)}, column keys as happybase returns them
+    _column_decoders = {}
+    _row_key_codec = StringRowKeyCodec
+    _legacy_row_key_codec = None
+    _salt_buckets = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_hash = {
+            key: value
+            for key, value in cls.__dict__.items()
+            if isinstance(value, HBaseField)
+        }
+        cls._row_key_fields = tuple(
+            (key, cls._field_hash.get(key))
+            for key in cls.Meta.row_key
+        )
+        cls._column_fields = tuple(
+            (key, field, '{}:{}'.format(field.column_family, key))
+            for key, field in cls._field_hash.items()
+            if field.column_family
+        )
+        cls._column_families = tuple(sorted({
+            field.column_family
+            for _, field, _ in cls._column_fields
+        }))
+        cls._field_decoders = {
+            key: cls.get_field_decoder(field)
+            for key, field in cls._field_hash.items()
+        }
+        cls._column_decoders = {
+            bytes(column_key, encoding='utf-8'): (key, cls._field_decoders[key])
+            for key, _, column_key in cls._column_fields
+        }
+        cls._row_key_codec = ROW_KEY_CODECS[getattr(cls.Meta, 'row_key_codec', 'string')]
+        cls._row_key_codec.check_fields(cls)
+        legacy_row_key_codec = getattr(cls.Meta, 'legacy_row_key_codec', None)
+        if legacy_row_key_codec is not None:
+            cls._legacy_row_key_codec = ROW_KEY_CODECS[legacy_row_key_codec]
+        cls._salt_buckets = getattr(cls.Meta, 'salt_buckets', None)
+        if cls._salt_buckets is not None and not 2 <= cls._salt_buckets <= 256:
+            raise ValueError('salt_buckets of {} should be between 2 and 256'.format(cls.__name__))
 
     @classmethod
+    @contextmanager
     def get_table(cls):
-        conn = HBaseClient.get_connection()
-        return conn.table(cls.get_table_name())
+        # with cls.get_table() as table:
+        # the connection of the table is held until the block ends
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
 
     @property
     def row_key(self):
@@ -21,24 +99,69 @@ class HBaseModel:
 
     @classmethod
     def get_field_hash(cls):
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        return cls._field_hash
+
+    @classmethod
+    def get_row_key_codecs(cls):
+        # codecs of the rows to read, None is the row key of the model:
+        # row_key_codec with salt if salt_buckets is set
+        if cls._legacy_row_key_codec is None:
+            return [None]
+        return [None, cls._legacy_row_key_codec]
+
+    @classmethod
+    def get_salt_bucket(cls, value):
+        # crc32 is stable across processes, unlike hash()
+        return zlib.crc32(bytes(str(value), encoding='utf-8')) % cls._salt_buckets
+
+    @classmethod
+    def get_salt(cls, bucket):
+        return bytes([bucket])
+
+    @classmethod
+    def get_scan_buckets(cls, start, stop, prefix):
+        # buckets to scan for the rows between start and stop or with prefix
+        if cls._salt_buckets is None:
+            return [None]
+        if prefix is not None and prefix[0] is not None:
+            return [cls.get_salt_bucket(prefix[0])]
+        if start is not None and stop is not None and \
+                start[0] is not None and start[0] == stop[0]:
+            return [cls.get_salt_bucket(start[0])]
+        return list(range(cls._salt_buckets))
+
+    def get_sort_key(self):
+        # values of the row key fields, rows read with different codecs
+        # are merged by it
+        return tuple(getattr(self, key) for key, _ in self._row_key_fields)
+
+    @classmethod
+    def get_field_decoder(cls, field):
+        # the reverse of serialize_field, works for str and bytes values
+        is_int = field.field_type in [IntegerField.field_type, TimestampField.field_type]
+        if field.reverse and is_int:
+            return lambda value: int(value[::-1])
+        if field.reverse:
+            return lambda value: value[::-1]
+        if is_int:
+            return int
+        return lambda value: value
 
     def __init__(self, **kwargs):
-        for key, field in self.get_field_hash().items():
-            value = kwargs.get(key)
-            setattr(self, key, value)
+        for key in self._field_hash:
+            setattr(self, key, kwargs.get(key))
 
     @classmethod
-    def init_from_row(cls, row_key, row_data):
+    def init_from_row(cls, row_key, row_data, codec=None):
         if not row_data:
             return None
-        data = cls.deserialize_row_key(row_key)
+        data = cls.deserialize_row_key(row_key, codec)
         for column_key, column_value in row_data.items():
+            column_decoder = cls._column_decoders.get(column_key)
+            if column_decoder is not None:
+                key, decoder = column_decoder
+                data[key] = decoder(column_value)
+                continue
             # remove column family
             column_key = column_key.decode('utf-8')
             key = column_key[column_key.find(':') + 1:]
@@ -46,49 +169,50 @@ class HBaseModel:
         return cls(**data)
 
     @classmethod
-    def serialize_row_key(cls, data, is_prefix=False):
+    def serialize_row_key(cls, data, is_prefix=False, codec=None):
         """
-        serialize dict to bytes (not str)
-        {key1: val1} => b"val1"
+        serialize dict to bytes (not str), see row_key_codecs.py
         {key1: val1, key2: val2} => b"val1:val2"
-        {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
+        The row key of the model unless codec is given, then the key of the
+        codec without salt.
         """
-        field_hash = cls.get_field_hash()
-        values = []
-        for key in cls.Meta.row_key:
-            field = field_hash.get(key)
-            value = data.get(key)
-            if value is None:
-                if not is_prefix:
-                    raise BadRowKeyError(f"{key} is missing in row key")
-                break
-            value = cls.serialize_field(field, value)
-            if ':' in value:
-                raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
-            values.append(value)
-        return bytes(':'.join(values), encoding='utf-8')
-
-    @classmethod
-    def deserialize_row_key(cls, row_key):
+        if codec is not None:
+            return codec.serialize(cls, data, is_prefix)
+        row_key = cls._row_key_codec.serialize(cls, data, is_prefix)
+        if cls._salt_buckets is None:
+            return row_key
+        leading_value = data.get(cls._row_key_fields[0][0])
+        if leading_value is None:
+            return row_key
+        return cls.get_salt(cls.get_salt_bucket(leading_value)) + row_key
+
+    @classmethod
+    def deserialize_row_key(cls, row_key, codec=None):
         """
-        "val1" => {'key1': val1, 'key2': None, 'key3': None}
-        "val1:val2" => {'key1': val1, 'key2': val2, 'key3': None}
-        "val1:val2:val3" => {'key1': val1, 'key2': val2, 'key3': val3}
+        "val1" => {'key1': val1}
+        "val1:val2" => {'key1': val1, 'key2': val2}
         """
-        data = {}
-        if isinstance(row_key, bytes):
-            row_key = row_key.decode('utf-8')
-
-        # val1:val2 => val1:val2:
-        # Every time find(':') returns a val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
-        return data
+        if codec is not None:
+            return codec.deserialize(cls, row_key)
+        if cls._salt_buckets is not None:
+            row_key = row_key[1:]
+        return cls._row_key_codec.deserialize(cls, row_key)
+
+    @classmethod
+    def is_valid_row_key(cls, row_key, codec=None):
+        # whether a row key read from the table is in the format of codec
+        if codec is not None:
+            return codec.is_valid(cls, row_key)
+        if cls._salt_buckets is None:
+            return cls._row_key_codec.is_valid(cls, row_key)
+        salt, row_key = row_key[:1], row_key[1:]
+        if not cls._row_key_codec.is_valid(cls, row_key):
+            return False
+        # a legacy key can look like a salted one, its first byte is not
+        # the salt of its value then
+        leading_key = cls._row_key_fields[0][0]
+        leading_value = cls._row_key_codec.deserialize(cls, row_key)[leading_key]
+        return salt == cls.get_salt(cls.get_salt_bucket(leading_value))
 
     @classmethod
     def serialize_field(cls, field, value):
@@ -96,30 +220,35 @@ class HBaseModel:
         if isinstance(field, IntegerField):
             # order alphabetically, could be 1 10 2
             # Fix int to be 16 digits, supply 0 if needed.
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
+            value = value.rjust(16, '0')
         if field.reverse:
             value = value[::-1]
         return value
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type, TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls._field_decoders[key](value)
 
     @classmethod
-    def serialize_row_data(cls, data):
-        row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
+    def serialize_columns(cls, columns):
+        """
+        ['key1', 'key2'] => [b'cf:key1', b'cf:key2']
+        row key fields are skipped, they are always read from the row key
+        """
+        if columns is None:
+            return None
+        column_keys = []
+        for key in columns:
+            field = cls._field_hash[key]
             if not field.column_family:
                 continue
-            column_key = '{}:{}'.format(field.column_family, key)
+            column_keys.append(bytes('{}:{}'.format(field.column_family, key), encoding='utf-8'))
+        return column_keys
+
+    @classmethod
+    def serialize_row_data(cls, data):
+        row_data = {}
+        for key, field, column_key in cls._column_fields:
             column_value = data.get(key)
             if column_value is None:
                 continue
@@ -132,18 +261,66 @@ class HBaseModel:
         # the row_key, so raise exception
         if len(row_data) == 0:
             raise EmptyColumnError()
+        # a row stored with the legacy row key is moved to the new one
+        legacy_row_key = None
+        if self._legacy_row_key_codec is not None:
+            legacy_row_key = self.serialize_row_key(
+                self.__dict__,
+                codec=self._legacy_row_key_codec,
+            )
         if batch:
             batch.put(self.row_key, row_data)
+            if legacy_row_key is not None:
+                batch.delete(legacy_row_key)
         else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            with self.get_table() as table:
+                table.put(self.row_key, row_data)
+                if legacy_row_key is not None:
+                    table.delete(legacy_row_key)
 
     @classmethod
     def get(cls, **kwargs):
-        row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row = table.row(row_key)
-        return cls.init_from_row(row_key, row)
+        row_keys = [
+            (codec, cls.serialize_row_key(kwargs, codec=codec))
+            for codec in cls.get_row_key_codecs()
+        ]
+        with cls.get_table() as table:
+            for codec, row_key in row_keys:
+                row = table.row(row_key)
+                if row:
+                    return cls.init_from_row(row_key, row, codec)
+        return None
+
+    @classmethod
+    def get_many(cls, row_key_dicts, columns=None):
+        """
+        [{key1: val1, key2: val2}, {key1: val3, key2: val4}] =>
+        [instance or None, instance or None]
+        in the order of the request, fetched in one thrift call.
+        columns: field names to read, None reads all columns. A row without
+        any of the selected columns is returned as None.
+        """
+        if not row_key_dicts:
+            return []
+        codecs = cls.get_row_key_codecs()
+        row_keys_by_codec = [
+            [cls.serialize_row_key(data, codec=codec) for data in row_key_dicts]
+            for codec in codecs
+        ]
+        column_keys = cls.serialize_columns(columns)
+        results = [None] * len(row_key_dicts)
+        with cls.get_table() as table:
+            # rows not found with the current codec are looked for with the
+            # legacy one, one more thrift call while migrating
+            for codec, row_keys in zip(codecs, row_keys_by_codec):
+                missing = [index for index, result in enumerate(results) if result is None]
+                if not missing:
+                    break
+                rows = dict(table.rows([row_keys[index] for index in missing], columns=column_keys))
+                for index in missing:
+                    row_key = row_keys[index]
+                    results[index] = cls.init_from_row(row_key, rows.get(row_key), codec)
+        return results
 
     @classmethod
     def create(cls, batch=None, **kwargs):
@@ -153,12 +330,12 @@ class HBaseModel:
 
     @classmethod
     def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
         results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
+        with cls.get_table() as table:
+            batch = table.batch()
+            for data in batch_data:
+                results.append(cls.create(batch=batch, **data))
+            batch.send()
         return results
 
     @classmethod
@@ -174,55 +351,211 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not drop table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        print(tables);
-        if cls.get_table_name() in tables:
-            return
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
-        }
-        conn.create_table(cls.get_table_name(), column_families)
+        with HBaseClient.connection() as conn:
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                return
+            column_families = {
+                column_family: dict()
+                for column_family in cls._column_families
+            }
+            conn.create_table(cls.get_table_name(), column_families)
 
     @classmethod
-    def serialize_row_key_from_tuple(cls, row_key_tuple):
+    def serialize_row_key_from_tuple(cls, row_key_tuple, codec=None):
         if row_key_tuple is None:
             return None
         data = {
             key: value
             for key, value in zip(cls.Meta.row_key, row_key_tuple)
         }
-        return cls.serialize_row_key(data, is_prefix=True)
+        return cls.serialize_row_key(data, is_prefix=True, codec=codec)
+
+    @classmethod
+    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False,
+               columns=None, filter_string=None):
+        """
+        columns: field names to read, None reads all columns.
+        filter_string: predicates evaluated by the region servers, in hbase
+        filter language, e.g. "SingleColumnValueFilter('cf', 'to_user_id',
+        =, 'binary:0000000000000002')", see serialize_field for the values.
+        """
+        return list(cls.iter_filter(
+            start=start,
+            stop=stop,
+            prefix=prefix,
+            limit=limit,
+            reverse=reverse,
+            columns=columns,
+            filter_string=filter_string,
+        ))
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
-        # serialize tuple to str
-        row_start = cls.serialize_row_key_from_tuple(start)
-        row_stop = cls.serialize_row_key_from_tuple(stop)
-        row_prefix = cls.serialize_row_key_from_tuple(prefix)
+    def iter_filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False,
+                    columns=None, filter_string=None, batch_size=1000):
+        """
+        Same as filter, but yields instances as the scanner fetches them,
+        batch_size rows per thrift call, instead of building the whole list.
+        The pooled connection is held until the generator is exhausted or
+        closed; stopping early (break, close()) closes the scanner.
+        """
+        # one connection for all the scanners merged, nested get_table()
+        # blocks would share and release the connection of the thread
+        with cls.get_table() as table:
+            yield from cls._iter_filter(
+                table, start, stop, prefix, limit, reverse, columns,
+                filter_string, batch_size,
+            )
 
-        # scan table
-        table = cls.get_table()
-        rows = table.scan(row_start, row_stop, row_prefix, limit=limit, reverse=reverse)
+    @classmethod
+    def _iter_filter(cls, table, start, stop, prefix, limit, reverse, columns,
+                     filter_string, batch_size):
+        codecs = cls.get_row_key_codecs()
+        if len(codecs) == 1:
+            buckets = cls.get_scan_buckets(start, stop, prefix)
+            if len(buckets) == 1:
+                rows = cls._iter_scan(
+                    table, None, buckets[0], start, stop, prefix, limit, reverse,
+                    columns, filter_string, batch_size,
+                )
+                for _, instance in rows:
+                    yield instance
+                return
 
-        # deserialize to instance list
-        results = []
-        for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+        # Rows of both codecs live in the table while migrating, the key
+        # ranges of one codec can contain keys of the other, they are
+        # skipped by checking the keys. limit is applied after the merge.
+        check_row_keys = len(codecs) > 1
+        if limit is not None:
+            batch_size = min(batch_size, limit)
+        scans, streams = [], []
+        for codec in codecs:
+            if codec is None:
+                buckets = cls.get_scan_buckets(start, stop, prefix)
+            else:
+                buckets = [None]
+            bucket_scans = [
+                cls._iter_scan(
+                    table, codec, bucket, start, stop, prefix,
+                    None if check_row_keys else limit, reverse,
+                    columns, filter_string, batch_size, check_row_keys,
+                )
+                for bucket in buckets
+            ]
+            scans.extend(bucket_scans)
+            # every bucket is in row key order without the salt
+            rows = heapq.merge(*bucket_scans, key=operator.itemgetter(0), reverse=reverse)
+            streams.append(instance for _, instance in rows)
+        try:
+            if len(streams) == 1:
+                instances = streams[0]
+            else:
+                # codecs order differently, merged by the values of the keys
+                instances = heapq.merge(*streams, key=cls.get_sort_key, reverse=reverse)
+            yield from itertools.islice(instances, limit)
+        finally:
+            for scan in scans:
+                scan.close()
+
+    @classmethod
+    def _get_scan_range(cls, codec, bucket, start, stop, prefix, reverse=False):
+        # (row_start, row_stop, row_prefix) in bytes, within bucket if it is
+        # not None. A reversed scan goes from row_start included down to
+        # row_stop excluded, same as happybase.
+        codec = codec or cls._row_key_codec
+        row_start = cls.serialize_row_key_from_tuple(start, codec)
+        row_stop = cls.serialize_row_key_from_tuple(stop, codec)
+        row_prefix = cls.serialize_row_key_from_tuple(prefix, codec)
+        if bucket is None:
+            return row_start, row_stop, row_prefix
+
+        salt = cls.get_salt(bucket)
+        if row_prefix is not None:
+            return None, None, salt + row_prefix
+        # rows of the bucket are after its salt and before the next salt,
+        # the last bucket goes to the end of the table
+        bucket_end = cls.get_salt(bucket + 1) if bucket < 255 else None
+        if reverse:
+            row_start = bucket_end if row_start is None else salt + row_start
+            row_stop = salt + (row_stop or b'')
+            return row_start, row_stop, None
+        row_start = salt + (row_start or b'')
+        row_stop = bucket_end if row_stop is None else salt + row_stop
+        return row_start, row_stop, None
+
+    @classmethod
+    def _iter_scan(cls, table, codec, bucket, start, stop, prefix, limit, reverse, columns,
+                   filter_string, batch_size, check_row_keys=False):
+        # yields (row key without salt, instance), table is held by the caller
+        row_start, row_stop, row_prefix = cls._get_scan_range(
+            codec, bucket, start, stop, prefix, reverse,
+        )
+        salt_size = 0 if bucket is None else 1
+
+        rows = table.scan(
+            row_start,
+            row_stop,
+            row_prefix,
+            columns=cls.serialize_columns(columns),
+            filter=filter_string,
+            limit=limit,
+            reverse=reverse,
+            batch_size=batch_size,
+        )
+        try:
+            for row_key, row_data in rows:
+                if check_row_keys and not cls.is_valid_row_key(row_key, codec):
+                    continue
+                yield row_key[salt_size:], cls.init_from_row(row_key, row_data, codec)
+        finally:
+            # happybase closes the scanner when its generator is closed
+            rows.close()
+
+    @classmethod
+    def count(cls, start=None, stop=None, prefix=None, filter_string=None):
+        # KeyOnlyFilter strips the values and FirstKeyOnlyFilter keeps one
+        # cell per row, only the row keys are transferred to be counted.
+        if filter_string:
+            # FirstKeyOnlyFilter could drop the cell filter_string checks
+            filter_string = '({}) AND KeyOnlyFilter()'.format(filter_string)
+        else:
+            filter_string = 'KeyOnlyFilter() AND FirstKeyOnlyFilter()'
+
+        codecs = cls.get_row_key_codecs()
+        total = 0
+        with cls.get_table() as table:
+            for codec in codecs:
+                if codec is None:
+                    buckets = cls.get_scan_buckets(start, stop, prefix)
+                else:
+                    buckets = [None]
+                for bucket in buckets:
+                    row_start, row_stop, row_prefix = cls._get_scan_range(
+                        codec, bucket, start, stop, prefix,
+                    )
+                    rows = table.scan(row_start, row_stop, row_prefix, filter=filter_string)
+                    if len(codecs) == 1:
+                        total += sum(1 for _ in rows)
+                    else:
+                        total += sum(
+                            1 for row_key, _ in rows
+                            if cls.is_valid_row_key(row_key, codec)
+                        )
+        return total
 
     @classmethod
     def delete(cls, **kwargs):
-        row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
\ No newline at end of file
+        row_keys = [
+            cls.serialize_row_key(kwargs, codec=codec)
+            for codec in cls.get_row_key_codecs()
+        ]
+        with cls.get_table() as table:
+            for row_key in row_keys:
+                table.delete(row_key)
@@ -0,0 +1,173 @@
+from django_hbase import models
+from django_hbase.models import BadRowKeyError
+from django_hbase.models.row_key_codecs import StringRowKeyCodec
+from testing.testcases import TestCase
+
+import time
+import zlib
+
+
+class BinaryFollowing(models.HBaseModel):
+    # HBaseFollowing moving to binary row keys
+    from_user_id = models.IntegerField(reverse=True)
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family='cf')
+
+    class Meta:
+        table_name = 'binary_followings'
+        row_key = ('from_user_id', 'created_at')
+        row_key_codec = 'binary'
+        legacy_row_key_codec = 'string'
+
+
+class SaltedFollowing(models.HBaseModel):
+    from_user_id = models.IntegerField()
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family='cf')
+
+    class Meta:
+        table_name = 'salted_followings'
+        row_key = ('from_user_id', 'created_at')
+        salt_buckets = 4
+
+
+class HBaseModelTests(TestCase):
+
+    @property
+    def ts_now(self):
+        return int(time.time() * 1000000)
+
+    def test_binary_row_key(self):
+        ts = self.ts_now
+        following = BinaryFollowing(from_user_id=1, created_at=ts, to_user_id=2)
+        row_key = following.row_key
+        self.assertEqual(len(row_key), 16)
+        self.assertEqual(
+            BinaryFollowing.deserialize_row_key(row_key),
+            {'from_user_id': 1, 'created_at': ts},
+        )
+        prefix = BinaryFollowing.serialize_row_key({'from_user_id': 1}, is_prefix=True)
+        self.assertEqual(row_key.startswith(prefix), True)
+        # reversed bits, consecutive ids are far apart
+        self.assertEqual(prefix[0], 0x80)
+        prefix = BinaryFollowing.serialize_row_key({'from_user_id': 2}, is_prefix=True)
+        self.assertEqual(prefix[0], 0x40)
+        # not reversed, ordered by value
+        self.assertEqual(
+            BinaryFollowing.serialize_row_key({'from_user_id': 1, 'created_at': ts}) <
+            BinaryFollowing.serialize_row_key({'from_user_id': 1, 'created_at': ts + 1}),
+            True,
+        )
+        with self.assertRaises(BadRowKeyError):
+            BinaryFollowing.serialize_row_key({'from_user_id': -1, 'created_at': ts})
+
+    def test_binary_row_key_dual_read(self):
+        ts = self.ts_now
+        # written before the model moved to binary row keys
+        legacy_data = {'from_user_id': 1, 'created_at': ts, 'to_user_id': 2}
+        legacy_row_key = BinaryFollowing.serialize_row_key(legacy_data, codec=StringRowKeyCodec)
+        with BinaryFollowing.get_table() as table:
+            table.put(legacy_row_key, BinaryFollowing.serialize_row_data(legacy_data))
+        BinaryFollowing.create(from_user_id=1, created_at=ts + 1, to_user_id=3)
+        BinaryFollowing.create(from_user_id=2, created_at=ts, to_user_id=1)
+
+        self.assertEqual(BinaryFollowing.get(from_user_id=1, created_at=ts).to_user_id, 2)
+        self.assertEqual(BinaryFollowing.get(from_user_id=1, created_at=ts + 1).to_user_id, 3)
+        followings = BinaryFollowing.filter(prefix=(1, None))
+        self.assertEqual([f.to_user_id for f in followings], [2, 3])
+        followings = BinaryFollowing.filter(prefix=(1, None), reverse=True, limit=1)
+        self.assertEqual([f.to_user_id for f in followings], [3])
+        self.assertEqual(BinaryFollowing.count(prefix=(1, None)), 2)
+        instances = BinaryFollowing.get_many([
+            {'from_user_id': 1, 'created_at': ts + 1},
+            {'from_user_id': 1, 'created_at': ts},
+        ])
+        self.assertEqual([f.to_user_id for f in instances], [3, 2])
+
+        # saved again, moved to the binary row key
+        following = BinaryFollowing.get(from_user_id=1, created_at=ts)
+        following.to_user_id = 4
+        following.save()
+        with BinaryFollowing.get_table() as table:
+            self.assertEqual(table.row(legacy_row_key), {})
+        self.assertEqual(BinaryFollowing.count(prefix=(1, None)), 2)
+        self.assertEqual(BinaryFollowing.get(from_user_id=1, created_at=ts).to_user_id, 4)
+
+        BinaryFollowing.delete(from_user_id=1, created_at=ts)
+        self.assertEqual(BinaryFollowing.count(prefix=(1, None)), 1)
+
+    def test_salted_row_key(self):
+        ts = self.ts_now
+        following = SaltedFollowing(from_user_id=1, created_at=ts, to_user_id=2)
+        row_key = following.row_key
+        self.assertEqual(row_key[0], zlib.crc32(b'1') % 4)
+        self.assertEqual(row_key[1:], b'0000000000000001:' + bytes(str(ts), encoding='utf-8'))
+        self.assertEqual(
+            SaltedFollowing.deserialize_row_key(row_key),
+            {'from_user_id': 1, 'created_at': ts},
+        )
+        self.assertEqual(SaltedFollowing.get_scan_buckets(None, None, (1, None)), [row_key[0]])
+        self.assertEqual(SaltedFollowing.get_scan_buckets(None, None, (None, None)), [0, 1, 2, 3])
+        self.assertEqual(SaltedFollowing.get_scan_buckets((1, 0), (2, 0), None), [0, 1, 2, 3])
+
+    def test_salted_filter(self):
+        ts = self.ts_now
+        for from_user_id in range(1, 9):
+            for i in range(2):
+                SaltedFollowing.create(from_user_id=from_user_id, created_at=ts + i, to_user_id=i)
+        buckets = {
+            SaltedFollowing.get_salt_bucket(from_user_id)
+            for from_user_id in range(1, 9)
+        }
+        self.assertEqual(len(buckets) > 1, True)
+
+        self.assertEqual(SaltedFollowing.get(from_user_id=3, created_at=ts + 1).to_user_id, 1)
+        followings = SaltedFollowing.filter(prefix=(3, None), reverse=True)
+        self.assertEqual([f.created_at for f in followings], [ts + 1, ts])
+
+        # all buckets merged in row key order
+        followings = SaltedFollowing.filter(prefix=(None, None))
+        self.assertEqual(
+            [(f.from_user_id, f.created_at) for f in followings],
+            [(from_user_id, ts + i) for from_user_id in range(1, 9) for i in range(2)],
+        )
+        followings = SaltedFollowing.filter(start=(2, ts + 1), stop=(4, ts + 1), limit=3)
+        self.assertEqual(
+            [(f.from_user_id, f.created_at) for f in followings],
+            [(2, ts + 1), (3, ts), (3, ts + 1)],
+        )
+        self.assertEqual(SaltedFollowing.count(prefix=(None, None)), 16)
+        self.assertEqual(SaltedFollowing.count(prefix=(5, None)), 2)
+
+        SaltedFollowing.delete(from_user_id=5, created_at=ts)
+        self.assertEqual(SaltedFollowing.count(prefix=(5, None)), 1)
+
+    def test_salted_reverse_filter(self):
+        ts = self.ts_now
+        for from_user_id in range(1, 9):
+            for i in range(2):
+                SaltedFollowing.create(from_user_id=from_user_id, created_at=ts + i, to_user_id=i)
+        keys = [(from_user_id, ts + i) for from_user_id in range(1, 9) for i in range(2)]
+
+        def get_keys(followings):
+            return [(f.from_user_id, f.created_at) for f in followings]
+
+        # all buckets merged in reversed row key order
+        followings = SaltedFollowing.filter(prefix=(None, None), reverse=True)
+        self.assertEqual(get_keys(followings), keys[::-1])
+        followings = SaltedFollowing.filter(reverse=True, limit=3)
+        self.assertEqual(get_keys(followings), keys[:-4:-1])
+        followings = SaltedFollowing.filter(prefix=(3, None), reverse=True, limit=1)
+        self.assertEqual(get_keys(followings), [(3, ts + 1)])
+
+        # start is included and stop excluded, start is the larger one
+        followings = SaltedFollowing.filter(start=(4, ts + 1), stop=(2, ts + 1), reverse=True)
+        self.assertEqual(get_keys(followings), [(4, ts + 1), (4, ts), (3, ts + 1), (3, ts)])
+        followings = SaltedFollowing.filter(
+            start=(4, ts + 1), stop=(2, ts + 1), reverse=True, limit=3,
+        )
+        self.assertEqual(get_keys(followings), [(4, ts + 1), (4, ts), (3, ts + 1)])
+        followings = SaltedFollowing.filter(start=(3, ts), reverse=True)
+        self.assertEqual(get_keys(followings), keys[4::-1])
+        followings = SaltedFollowing.filter(stop=(6, ts + 1), reverse=True, limit=3)
+        self.assertEqual(get_keys(followings), keys[:-4:-1])
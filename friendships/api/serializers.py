@@ -21,21 +21,25 @@ class BaseFriendshipSerializer(serializers.Serializer):
     def get_user_id(self, obj):
         raise NotImplementedError
 
-    def _get_following_user_id_set(self):
+    def _get_has_followed_map(self, obj):
         if self.context['request'].user.is_anonymous:
             return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
+        if hasattr(self, '_cached_has_followed_map'):
+            return self._cached_has_followed_map
+        # with many=True this serializer is shared by all objects of the
+        # page, look them all up at once instead of loading all followings
+        objects = self.parent.instance if self.parent is not None else [obj]
+        has_followed_map = FriendshipService.has_followed_many(
             self.context['request'].user.id,
+            [self.get_user_id(instance) for instance in objects],
         )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
+        setattr(self, '_cached_has_followed_map', has_followed_map)
+        return has_followed_map
 
     # user1 is viewing the list of user2's followings/followers user3/user4/user5...,
     # check user1 has followed user3/user4/user5
     def get_has_followed(self, obj):
-        return self.get_user_id(obj) in self._get_following_user_id_set()
+        return self._get_has_followed_map(obj).get(self.get_user_id(obj), False)
 
     def get_user(self, obj):
         user = UserService.get_user_by_id(self.get_user_id(obj))
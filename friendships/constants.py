@@ -0,0 +1,3 @@
+from django.conf import settings
+
+COUNT_REPAIR_BATCH_SIZE = 1000 if not settings.TESTING else 3
@@ -1,4 +1,21 @@
-def friendship_changed(sender, instance, **kwargs):
+def friendship_saved(sender, instance, created, **kwargs):
     # import inside to avoid dependency circular
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    from newsfeeds.services import NewsFeedService
+    if created:
+        FriendshipService.add_following_to_cache(instance.from_user_id, instance.to_user_id)
+        NewsFeedService.add_followed_celebrity(instance.from_user_id, instance.to_user_id)
+        FriendshipService.incr_friendship_counts(instance.from_user_id, instance.to_user_id)
+    else:
+        # changed in place, e.g. in admin, the previous to_user_id is unknown
+        FriendshipService.invalidate_following_cache(instance.from_user_id)
+        NewsFeedService.invalidate_followed_celebrities(instance.from_user_id)
+
+
+def friendship_deleted(sender, instance, **kwargs):
+    # import inside to avoid dependency circular
+    from friendships.services import FriendshipService
+    from newsfeeds.services import NewsFeedService
+    FriendshipService.remove_following_from_cache(instance.from_user_id, instance.to_user_id)
+    NewsFeedService.remove_followed_celebrity(instance.from_user_id, instance.to_user_id)
+    FriendshipService.decr_friendship_counts(instance.from_user_id, instance.to_user_id)
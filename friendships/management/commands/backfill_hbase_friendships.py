@@ -0,0 +1,67 @@
+from django.core.management.base import BaseCommand
+from friendships.models import HBaseFollowing
+from friendships.services import FriendshipService
+
+import time
+
+
+class Command(BaseCommand):
+    """
+    Write the HBaseFriendship row of every HBaseFollowing row, for follows
+    written to hbase before HBaseFriendship was added, e.g.
+        python manage.py backfill_hbase_friendships --rate 5000
+
+    Until it finished, a follow without its HBaseFriendship row is looked up
+    by scanning the followings of the user if HBASE_FRIENDSHIP_LEGACY_LOOKUP
+    is on, see get_follow_instance. The last following copied is kept in
+    redis, running the command again continues from there.
+    """
+    help = 'Copy hbase followings to the hbase friendships table in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--rate', type=int, default=0,
+            help='followings copied per second at most, 0 means no limit',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='copy from the first following instead of the last checkpoint',
+        )
+
+    def handle(self, *args, **options):
+        batch_size, rate = options['batch_size'], options['rate']
+        if options['restart']:
+            FriendshipService.record_hbase_friendship_backfill(None)
+        backfill = FriendshipService.get_hbase_friendship_backfill()
+        if backfill['finished']:
+            self.stdout.write('Backfill already finished, use --restart to run it again.')
+            return
+
+        cursor = backfill['cursor']
+        copied = 0
+        while True:
+            start = time.monotonic()
+            # the row of the cursor is copied already, read one more
+            followings = HBaseFollowing.filter(
+                start=tuple(cursor) if cursor else None,
+                limit=batch_size + 1 if cursor else batch_size,
+            )
+            if cursor:
+                followings = [
+                    following
+                    for following in followings
+                    if [following.from_user_id, following.created_at] != cursor
+                ][:batch_size]
+            if not followings:
+                break
+            copied += FriendshipService.copy_followings_to_hbase_friendships(followings)
+            cursor = [followings[-1].from_user_id, followings[-1].created_at]
+            FriendshipService.record_hbase_friendship_backfill(cursor)
+            self.stdout.write('{} followings copied, last {}'.format(copied, cursor))
+
+            if rate:
+                # sleep what is left of the time the batch is allowed to take
+                time.sleep(max(0, len(followings) / rate - (time.monotonic() - start)))
+        FriendshipService.record_hbase_friendship_backfill(cursor, finished=True)
+        self.stdout.write('{} followings copied.'.format(copied))
@@ -0,0 +1,134 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from friendships.models import Friendship, HBaseFollowing
+from friendships.services import FriendshipService
+from twitter.cache import FRIENDSHIP_MIGRATION_CURSOR_KEY
+from utils.redis_client import RedisClient
+
+import random
+import time
+
+
+class Command(BaseCommand):
+    """
+    Copy mysql friendships to HBaseFollowing, HBaseFollower and
+    HBaseFriendship before turning on switch_friendship_to_hbase:
+        1. turn on switch_friendship_dual_write_to_hbase, follow and unfollow
+           write both backends from then on
+        2. python manage.py migrate_friendships_to_hbase --rate 5000
+           friendships are read by id, the last id copied is kept in redis,
+           running the command again continues from there
+        3. python manage.py migrate_friendships_to_hbase --verify-only --verify 1000
+        4. turn on switch_friendship_to_hbase
+    """
+    help = 'Copy mysql friendships to hbase in batches and verify them by sampling'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--rate', type=int, default=0,
+            help='friendships copied per second at most, 0 means no limit',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='copy from the first friendship instead of the last checkpoint',
+        )
+        parser.add_argument(
+            '--verify', type=int, default=0,
+            help='number of random friendships checked in hbase after copying',
+        )
+        parser.add_argument('--verify-only', action='store_true')
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            self.copy(options['batch_size'], options['rate'], options['restart'])
+        if options['verify']:
+            self.verify(options['verify'], options['batch_size'])
+
+    def copy(self, batch_size, rate, restart):
+        conn = RedisClient.get_connection()
+        cursor = 0 if restart else int(conn.get(FRIENDSHIP_MIGRATION_CURSOR_KEY) or 0)
+        copied = 0
+        while True:
+            start = time.monotonic()
+            # keyset pagination on the primary key, no OFFSET
+            friendships = list(
+                Friendship.objects.filter(id__gt=cursor).order_by('id')[:batch_size]
+            )
+            if not friendships:
+                break
+            copied += FriendshipService.copy_friendships_to_hbase(friendships)
+            self._remove_unfollowed(friendships)
+            cursor = friendships[-1].id
+            conn.set(FRIENDSHIP_MIGRATION_CURSOR_KEY, cursor)
+            self.stdout.write('{} friendships copied, last id {}'.format(copied, cursor))
+
+            if rate:
+                # sleep what is left of the time the batch is allowed to take
+                time.sleep(max(0, len(friendships) / rate - (time.monotonic() - start)))
+        self.stdout.write('{} friendships copied.'.format(copied))
+
+    def _remove_unfollowed(self, friendships):
+        # A friendship deleted after it was read and before it was copied is
+        # in hbase now, its dual write had nothing to delete yet.
+        existing_ids = set(Friendship.objects.filter(
+            id__in=[friendship.id for friendship in friendships],
+        ).values_list('id', flat=True))
+        for friendship in friendships:
+            if friendship.id in existing_ids:
+                continue
+            FriendshipService.delete_hbase_friendship(
+                friendship.from_user_id,
+                friendship.to_user_id,
+            )
+            # followed again in the meantime, write the current one back
+            current = Friendship.objects.filter(
+                from_user_id=friendship.from_user_id,
+                to_user_id=friendship.to_user_id,
+            ).first()
+            if current is not None:
+                FriendshipService.copy_friendships_to_hbase([current])
+
+    def verify(self, sample_size, batch_size):
+        bounds = Friendship.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No friendships to verify.')
+            return
+        samples = {}
+        for _ in range(sample_size):
+            friendship = Friendship.objects.filter(
+                id__gte=random.randint(bounds['min_id'], bounds['max_id']),
+            ).order_by('id').first()
+            samples[friendship.id] = friendship
+        samples = list(samples.values())
+
+        missing = []
+        for index in range(0, len(samples), batch_size):
+            missing += FriendshipService.get_friendships_missing_in_hbase(
+                samples[index:index + batch_size],
+            )
+        # rows left in hbase for deleted friendships only show up in counts
+        user_ids = set(
+            friendship.from_user_id
+            for friendship in samples
+            if friendship.from_user_id is not None
+        )
+        different_count_user_ids = [
+            user_id
+            for user_id in user_ids
+            if Friendship.objects.filter(from_user_id=user_id).count() !=
+            HBaseFollowing.count(prefix=(user_id, None))
+        ]
+
+        self.stdout.write('{} friendships sampled, {} missing in hbase.'.format(
+            len(samples),
+            len(missing),
+        ))
+        for friendship in missing:
+            self.stdout.write('  missing: id {} {}'.format(friendship.id, friendship))
+        self.stdout.write('{} users sampled, {} with different following counts.'.format(
+            len(user_ids),
+            len(different_count_user_ids),
+        ))
+        for user_id in different_count_user_ids:
+            self.stdout.write('  different following count: user {}'.format(user_id))
@@ -0,0 +1,37 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from friendships.services import FriendshipService
+
+
+class Command(BaseCommand):
+    """
+    Set followers_count and followings_count of every user to the counts of
+    their friendships, once after migrating accounts to 0002, e.g.
+        python manage.py seed_friendship_counts --batch-size 1000
+
+    The friendships followed before the counts existed are not counted
+    otherwise, repair_friendship_counts_main_task only checks the users
+    followed or unfollowed since its last run. Users are read by id ranges,
+    running it again is safe, counts which are right are left as they are.
+    """
+    help = 'Seed the follower and following counts of all users in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_user_id, checked, repaired = 0, 0, 0
+        while True:
+            user_ids = list(
+                User.objects.filter(id__gt=last_user_id)
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not user_ids:
+                break
+            repaired += FriendshipService.repair_friendship_counts(user_ids)
+            checked += len(user_ids)
+            last_user_id = user_ids[-1]
+            self.stdout.write('{} users checked, last {}'.format(checked, last_user_id))
+        self.stdout.write('{} users checked, {} seeded.'.format(checked, repaired))
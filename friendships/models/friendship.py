@@ -1,5 +1,5 @@
 from django.db.models.signals import post_save, pre_delete
-from friendships.listeners import friendship_changed
+from friendships.listeners import friendship_deleted, friendship_saved
 from utils.memcached_helper import MemcachedHelper
 
 from django.db import models
@@ -42,6 +42,6 @@ class Friendship(models.Model):
     def cached_to_user(self):
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
-# hook up with listeners to invalidate cache
-pre_delete.connect(friendship_changed, sender=Friendship)
-post_save.connect(friendship_changed, sender=Friendship)
\ No newline at end of file
+# hook up with listeners to update the followings cache
+pre_delete.connect(friendship_deleted, sender=Friendship)
+post_save.connect(friendship_saved, sender=Friendship)
\ No newline at end of file
@@ -38,4 +38,22 @@ class HBaseFollower(models.HBaseModel):
 
     class Meta:
         table_name = 'twitter_followers'
-        row_key = ('to_user_id', 'created_at')
\ No newline at end of file
+        row_key = ('to_user_id', 'created_at')
+
+class HBaseFriendship(models.HBaseModel):
+    """
+    Store one row per follow，
+    row_key is from_user_id + to_user_id
+    Support queries：
+     - whether A follows B, a single row get
+     - when A followed B, to find the HBaseFollowing and HBaseFollower rows
+    """
+    # row key
+    from_user_id = models.IntegerField(reverse=True)
+    to_user_id = models.IntegerField()
+    # column key
+    created_at = models.TimestampField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_friendships'
+        row_key = ('from_user_id', 'to_user_id')
@@ -1,12 +1,33 @@
+from accounts.models import UserProfile
+from accounts.services import UserService
 from django.conf import settings
-from django.core.cache import caches
-from friendships.models import HBaseFollowing, HBaseFollower, Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from django.db.models import Count, F, Q
+from friendships.models import HBaseFollowing, HBaseFollower, HBaseFriendship, Friendship
+from redis.exceptions import WatchError
+from twitter.cache import (
+    FOLLOWINGS_LOADING_PATTERN,
+    FOLLOWINGS_PATTERN,
+    FRIENDSHIP_COUNTS_CHANGED_KEY,
+    HBASE_FRIENDSHIP_BACKFILL_KEY,
+)
 from gatekeeper.models import GateKeeper
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
 
+import json
 import time
+import uuid
 
-cache = caches['testing'] if settings.TESTING else caches['default']
+# Members marking the state of a cached followings set, user ids start at 1.
+# A set without FOLLOWINGS_LOADED, e.g. created by SADD right after the key
+# expired, is not trusted and gets loaded again.
+FOLLOWINGS_LOADED = b'0'
+FOLLOWINGS_TOO_LARGE = b'-1'
+# the set is being loaded, see _load_following_cache
+FOLLOWINGS_LOADING = b'-2'
+FOLLOWINGS_MARKERS = (FOLLOWINGS_LOADED, FOLLOWINGS_TOO_LARGE, FOLLOWINGS_LOADING)
 
 
 class FriendshipService(object):
@@ -40,6 +61,7 @@ class FriendshipService(object):
         ).prefetch_related('from_user')
         return [friendship.from_user for friendship in friendships]
 
+    @classmethod
     def get_follower_ids(cls, to_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             friendships = Friendship.objects.filter(to_user_id=to_user_id)
@@ -48,30 +70,323 @@ class FriendshipService(object):
         return [friendship.from_user_id for friendship in friendships]
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
-        # <TODO> cache in redis set
+    def iter_follower_id_batches(cls, to_user_id, batch_size, cursor=None):
+        """
+        Yield (follower_ids, cursor) with at most batch_size ids per batch,
+        oldest follower first, so that fanout never holds all followers of a
+        user in memory. cursor can be stored as json and passed back in to
+        continue right after the batch it was yielded with.
+        """
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = Friendship.objects.filter(from_user_id=from_user_id)
+            yield from cls._iter_follower_id_batches_from_mysql(to_user_id, batch_size, cursor)
         else:
-            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
-        user_id_set = set([
-            fs.to_user_id
-            for fs in friendships
+            yield from cls._iter_follower_id_batches_from_hbase(to_user_id, batch_size, cursor)
+
+    @classmethod
+    def _iter_follower_id_batches_from_mysql(cls, to_user_id, batch_size, cursor):
+        # Keyset pagination on the (to_user_id, created_at) index instead of
+        # OFFSET, which would scan all the skipped rows on every batch.
+        # id breaks the tie of friendships created at the same time.
+        # cursor is [created_at timestamp, id] of the last friendship read.
+        queryset = Friendship.objects.filter(to_user_id=to_user_id)
+        while True:
+            batch = queryset
+            if cursor is not None:
+                last_created_at = timestamp_to_datetime(cursor[0])
+                batch = batch.filter(
+                    Q(created_at__gt=last_created_at) |
+                    Q(created_at=last_created_at, id__gt=cursor[1])
+                )
+            rows = list(
+                batch.order_by('created_at', 'id')
+                .values_list('from_user_id', 'created_at', 'id')[:batch_size]
+            )
+            if not rows:
+                return
+            _, last_created_at, last_id = rows[-1]
+            cursor = [datetime_to_timestamp(last_created_at), last_id]
+            yield [from_user_id for from_user_id, _, _ in rows], cursor
+            if len(rows) < batch_size:
+                return
+
+    @classmethod
+    def _iter_follower_id_batches_from_hbase(cls, to_user_id, batch_size, cursor):
+        # one scanner streams all followers after the cursor, batch_size rows
+        # per thrift call. cursor is created_at of the last follower read.
+        start = (to_user_id, 0 if cursor is None else cursor + 1)
+        stop = (to_user_id, MAX_TIMESTAMP)
+        followers = HBaseFollower.iter_filter(start=start, stop=stop, batch_size=batch_size)
+        batch = []
+        for follower in followers:
+            batch.append(follower)
+            if len(batch) == batch_size:
+                yield [follower.from_user_id for follower in batch], batch[-1].created_at
+                batch = []
+        if batch:
+            yield [follower.from_user_id for follower in batch], batch[-1].created_at
+
+    @classmethod
+    def get_following_user_id_set(cls, from_user_id):
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        members = RedisClient.get_connection().smembers(key)
+        if FOLLOWINGS_LOADED in members:
+            return set(int(member) for member in members if member not in FOLLOWINGS_MARKERS)
+        if FOLLOWINGS_TOO_LARGE not in members:
+            user_ids = cls._load_following_cache(from_user_id)
+            if user_ids is not None:
+                return set(user_ids)
+        # too many followings to cache, read all of them from db
+        return set(cls._get_following_user_ids(from_user_id))
+
+    @classmethod
+    def has_followed_many(cls, from_user_id, to_user_ids):
+        """
+        {to_user_id: whether from_user_id has followed to_user_id}
+        One SMISMEMBER when the followings of from_user_id are cached, used
+        by list pages instead of loading all the followings.
+        """
+        if not to_user_ids:
+            return {}
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        flags = RedisHelper.smismember(
+            key,
+            [FOLLOWINGS_LOADED, FOLLOWINGS_TOO_LARGE, *to_user_ids],
+        )
+        is_loaded, is_too_large, flags = flags[0], flags[1], flags[2:]
+        if is_loaded:
+            return {
+                to_user_id: bool(flag)
+                for to_user_id, flag in zip(to_user_ids, flags)
+            }
+        if not is_too_large:
+            user_ids = cls._load_following_cache(from_user_id)
+            if user_ids is not None:
+                user_id_set = set(user_ids)
+                return {
+                    to_user_id: to_user_id in user_id_set
+                    for to_user_id in to_user_ids
+                }
+        # too many followings to cache, only look up the given users in db
+        followed_user_id_set = cls._get_followed_user_id_set(from_user_id, to_user_ids)
+        return {
+            to_user_id: to_user_id in followed_user_id_set
+            for to_user_id in to_user_ids
+        }
+
+    @classmethod
+    def _get_following_user_ids(cls, from_user_id, limit=None):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            user_ids = Friendship.objects.filter(
+                from_user_id=from_user_id,
+            ).values_list('to_user_id', flat=True)[:limit]
+            # to_user is set to null when the user is deleted
+            return [user_id for user_id in user_ids if user_id is not None]
+        followings = HBaseFollowing.filter(
+            prefix=(from_user_id, None),
+            limit=limit,
+            columns=['to_user_id'],
+        )
+        return [following.to_user_id for following in followings]
+
+    @classmethod
+    def _get_followed_user_id_set(cls, from_user_id, to_user_ids):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return set(Friendship.objects.filter(
+                from_user_id=from_user_id,
+                to_user_id__in=to_user_ids,
+            ).values_list('to_user_id', flat=True))
+        friendships = HBaseFriendship.get_many([
+            {'from_user_id': from_user_id, 'to_user_id': to_user_id}
+            for to_user_id in to_user_ids
         ])
-        return user_id_set
+        followed_user_id_set = set(
+            friendship.to_user_id
+            for friendship in friendships
+            if friendship is not None
+        )
+        if len(followed_user_id_set) == len(to_user_ids) or \
+                not cls.needs_legacy_follow_lookup():
+            return followed_user_id_set
+        # follows written before HBaseFriendship have no pair row yet
+        followings = HBaseFollowing.iter_filter(
+            prefix=(from_user_id, None),
+            columns=['to_user_id'],
+        )
+        return followed_user_id_set | (
+            set(following.to_user_id for following in followings) & set(to_user_ids)
+        )
+
+    @classmethod
+    def _load_following_cache(cls, from_user_id):
+        # Returns the loaded following user ids, or None when there are more
+        # than REDIS_FOLLOWINGS_SET_SIZE_LIMIT of them. In that case the set
+        # only holds FOLLOWINGS_TOO_LARGE, so readers go to db for this user
+        # until the key expires instead of loading all followings again.
+        limit = settings.REDIS_FOLLOWINGS_SET_SIZE_LIMIT
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        loading_key = FOLLOWINGS_LOADING_PATTERN.format(
+            user_id=from_user_id,
+            token=uuid.uuid4().hex,
+        )
+        conn = RedisClient.get_connection()
+        # A follow or unfollow while loading changes the key (see
+        # add_following_to_cache), the loaded set could miss it and is not
+        # stored then. The marker makes the key exist, so that WATCH sees
+        # the change even if the key was not cached at all.
+        pipeline = conn.pipeline()
+        pipeline.sadd(key, FOLLOWINGS_LOADING)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+
+        with conn.pipeline() as pipeline:
+            pipeline.watch(key)
+            user_ids = cls._get_following_user_ids(from_user_id, limit + 1)
+            # built aside and renamed into place, readers never see a half
+            # written set
+            build = conn.pipeline(transaction=False)
+            if len(user_ids) > limit:
+                build.sadd(loading_key, FOLLOWINGS_TOO_LARGE)
+                user_ids = None
+            else:
+                build.sadd(loading_key, FOLLOWINGS_LOADED, *user_ids)
+            build.expire(loading_key, settings.REDIS_KEY_EXPIRE_TIME)
+            build.execute()
+            pipeline.multi()
+            pipeline.rename(loading_key, key)
+            try:
+                pipeline.execute()
+            except WatchError:
+                # loaded again on the next read
+                conn.delete(loading_key)
+        return user_ids
+
+    @classmethod
+    def add_following_to_cache(cls, from_user_id, to_user_id):
+        # same as RedisHelper.push_object, a set not loaded yet is loaded on
+        # its next read instead, which sees the new following
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        if not cls._is_following_cache_loaded(conn, key):
+            return
+        pipeline = conn.pipeline()
+        pipeline.sadd(key, to_user_id)
+        pipeline.scard(key)
+        _, size = pipeline.execute()
+        if size > settings.REDIS_FOLLOWINGS_SET_SIZE_LIMIT + 1:
+            # loaded again and marked too large on the next read
+            conn.delete(key)
+
+    @classmethod
+    def remove_following_from_cache(cls, from_user_id, to_user_id):
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        if not cls._is_following_cache_loaded(conn, key):
+            return
+        conn.srem(key, to_user_id)
+
+    @classmethod
+    def _is_following_cache_loaded(cls, conn, key):
+        is_loaded, is_too_large = RedisHelper.smismember(
+            key,
+            [FOLLOWINGS_LOADED, FOLLOWINGS_TOO_LARGE],
+        )
+        if not is_loaded and not is_too_large:
+            # a load running right now may have read the followings before
+            # this change, deleting its marker keeps it from storing them
+            conn.delete(key)
+        return is_loaded
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        RedisClient.get_connection().delete(key)
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        for follow in followings:
-            if follow.to_user_id == to_user_id:
-                return follow
-        return None
+        # a single row get on the (from_user_id, to_user_id) row key instead
+        # of scanning all followings of from_user_id
+        instance = HBaseFriendship.get(from_user_id=from_user_id, to_user_id=to_user_id)
+        if instance is not None or not cls.needs_legacy_follow_lookup():
+            return instance
+        # Follows written before HBaseFriendship have no pair row until the
+        # backfill_hbase_friendships command copied them, scan the
+        # followings of from_user_id for them until then. Not written back
+        # here, an unfollow in the meantime would bring the row back.
+        followings = HBaseFollowing.filter(
+            prefix=(from_user_id, None),
+            filter_string="SingleColumnValueFilter('cf', 'to_user_id', =, 'binary:{}')".format(
+                HBaseFollowing.serialize_field(HBaseFollowing.to_user_id, to_user_id),
+            ),
+            limit=1,
+        )
+        if not followings:
+            return None
+        return HBaseFriendship(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=followings[0].created_at,
+        )
+
+    @classmethod
+    def get_hbase_friendship_backfill(cls):
+        # {'cursor': [from_user_id, created_at] or None, 'finished': bool}
+        value = RedisClient.get_connection().get(HBASE_FRIENDSHIP_BACKFILL_KEY)
+        if value is None:
+            return {'cursor': None, 'finished': False}
+        return json.loads(value)
+
+    @classmethod
+    def record_hbase_friendship_backfill(cls, cursor, finished=False):
+        RedisClient.get_connection().set(
+            HBASE_FRIENDSHIP_BACKFILL_KEY,
+            json.dumps({'cursor': cursor, 'finished': finished}),
+        )
+
+    @classmethod
+    def is_hbase_friendship_backfilled(cls):
+        return cls.get_hbase_friendship_backfill()['finished']
+
+    @classmethod
+    def needs_legacy_follow_lookup(cls):
+        # opt-in, see HBASE_FRIENDSHIP_LEGACY_LOOKUP. Deployments without
+        # legacy follows never read the backfill state from redis.
+        if not settings.HBASE_FRIENDSHIP_LEGACY_LOOKUP:
+            return False
+        return not cls.is_hbase_friendship_backfilled()
+
+    @classmethod
+    def copy_followings_to_hbase_friendships(cls, followings):
+        """
+        Write the HBaseFriendship row of HBaseFollowing rows written before
+        there was one, in one table batch. Returns the number of rows written.
+        """
+        HBaseFriendship.batch_create([
+            {
+                'from_user_id': following.from_user_id,
+                'to_user_id': following.to_user_id,
+                'created_at': following.created_at,
+            }
+            for following in followings
+        ])
+        # unfollowed after the following was read, its pair row is back now
+        current_followings = HBaseFollowing.get_many([
+            {'from_user_id': following.from_user_id, 'created_at': following.created_at}
+            for following in followings
+        ])
+        for following, current in zip(followings, current_followings):
+            if current is not None:
+                continue
+            pair = HBaseFriendship.get(
+                from_user_id=following.from_user_id,
+                to_user_id=following.to_user_id,
+            )
+            # followed again in the meantime, that pair row is kept
+            if pair is not None and pair.created_at == following.created_at:
+                HBaseFriendship.delete(
+                    from_user_id=following.from_user_id,
+                    to_user_id=following.to_user_id,
+                )
+        return len(followings)
 
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
@@ -94,23 +409,33 @@ class FriendshipService(object):
 
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             # create data in mysql
-            return Friendship.objects.create(
+            friendship = Friendship.objects.create(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
             )
+            # copied to hbase with the same created_at as the migration
+            # does, see the migrate_friendships_to_hbase command
+            if GateKeeper.is_switch_on('switch_friendship_dual_write_to_hbase'):
+                cls.create_hbase_friendship(
+                    from_user_id,
+                    to_user_id,
+                    datetime_to_timestamp(friendship.created_at),
+                )
+            return friendship
 
         # create data in hbase
-        now = int(time.time() * 1000000)
-        HBaseFollower.create(
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            created_at=now,
-        )
-        return HBaseFollowing.create(
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            created_at=now,
+        following = cls.create_hbase_friendship(
+            from_user_id,
+            to_user_id,
+            int(time.time() * 1000000),
         )
+        # mysql friendships update the cache and counts in their listeners
+        # import inside to avoid dependency circular
+        from newsfeeds.services import NewsFeedService
+        cls.add_following_to_cache(from_user_id, to_user_id)
+        NewsFeedService.add_followed_celebrity(from_user_id, to_user_id)
+        cls.incr_friendship_counts(from_user_id, to_user_id)
+        return following
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -131,21 +456,229 @@ class FriendshipService(object):
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
             ).delete()
+            if GateKeeper.is_switch_on('switch_friendship_dual_write_to_hbase'):
+                cls.delete_hbase_friendship(from_user_id, to_user_id)
             return deleted
 
+        if not cls.delete_hbase_friendship(from_user_id, to_user_id):
+            return 0
+        # import inside to avoid dependency circular
+        from newsfeeds.services import NewsFeedService
+        cls.remove_following_from_cache(from_user_id, to_user_id)
+        NewsFeedService.remove_followed_celebrity(from_user_id, to_user_id)
+        cls.decr_friendship_counts(from_user_id, to_user_id)
+        return 1
+
+    @classmethod
+    def create_hbase_friendship(cls, from_user_id, to_user_id, created_at):
+        HBaseFollower.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=created_at,
+        )
+        following = HBaseFollowing.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=created_at,
+        )
+        # written last, has_followed is true once both lists have the row
+        HBaseFriendship.create(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=created_at,
+        )
+        return following
+
+    @classmethod
+    def delete_hbase_friendship(cls, from_user_id, to_user_id):
+        # returns the number of friendships deleted, 0 or 1
         instance = cls.get_follow_instance(from_user_id, to_user_id)
         if instance is None:
             return 0
-
         HBaseFollowing.delete(from_user_id=from_user_id,
                               created_at=instance.created_at)
         HBaseFollower.delete(to_user_id=to_user_id,
                              created_at=instance.created_at)
+        HBaseFriendship.delete(from_user_id=from_user_id, to_user_id=to_user_id)
         return 1
 
+    @classmethod
+    def copy_friendships_to_hbase(cls, friendships):
+        """
+        Batch version of create_hbase_friendship for mysql friendships, one
+        table batch per hbase table. Row keys come from the mysql rows, so
+        copying a friendship again, or after a dual write, overwrites the
+        same rows. Returns the number of friendships copied.
+        """
+        # to_user or from_user is set to null when the user is deleted
+        batch_data = [
+            {
+                'from_user_id': friendship.from_user_id,
+                'to_user_id': friendship.to_user_id,
+                'created_at': datetime_to_timestamp(friendship.created_at),
+            }
+            for friendship in friendships
+            if friendship.from_user_id is not None and friendship.to_user_id is not None
+        ]
+        if not batch_data:
+            return 0
+        HBaseFollower.batch_create(batch_data)
+        HBaseFollowing.batch_create(batch_data)
+        HBaseFriendship.batch_create(batch_data)
+        return len(batch_data)
+
+    @classmethod
+    def get_friendships_missing_in_hbase(cls, friendships):
+        """
+        mysql friendships whose rows in the three hbase tables are missing
+        or were written with another created_at, three get_many in total.
+        """
+        friendships = [
+            friendship
+            for friendship in friendships
+            if friendship.from_user_id is not None and friendship.to_user_id is not None
+        ]
+        timestamps = [datetime_to_timestamp(friendship.created_at) for friendship in friendships]
+        pairs = HBaseFriendship.get_many([
+            {'from_user_id': friendship.from_user_id, 'to_user_id': friendship.to_user_id}
+            for friendship in friendships
+        ])
+        followings = HBaseFollowing.get_many([
+            {'from_user_id': friendship.from_user_id, 'created_at': timestamp}
+            for friendship, timestamp in zip(friendships, timestamps)
+        ])
+        followers = HBaseFollower.get_many([
+            {'to_user_id': friendship.to_user_id, 'created_at': timestamp}
+            for friendship, timestamp in zip(friendships, timestamps)
+        ])
+        missing = []
+        for friendship, timestamp, pair, following, follower in zip(
+            friendships, timestamps, pairs, followings, followers,
+        ):
+            if pair is None or pair.created_at != timestamp or \
+                    following is None or following.to_user_id != friendship.to_user_id or \
+                    follower is None or follower.from_user_id != friendship.from_user_id:
+                missing.append(friendship)
+        return missing
+
+    @classmethod
+    def incr_friendship_counts(cls, from_user_id, to_user_id):
+        cls._update_friendship_counts(from_user_id, to_user_id, 1)
+
+    @classmethod
+    def decr_friendship_counts(cls, from_user_id, to_user_id):
+        cls._update_friendship_counts(from_user_id, to_user_id, -1)
+
+    @classmethod
+    def _update_friendship_counts(cls, from_user_id, to_user_id, delta):
+        # same as likes_count of tweets: an atomic F() update in db, then
+        # the count cached in redis, see likes/listeners.py
+        user_ids = [
+            user_id
+            for user_id in [from_user_id, to_user_id]
+            # to_user or from_user is set to null when the user is deleted
+            if user_id is not None
+        ]
+        # checked by the next repair, marked first so that a failed update
+        # below is repaired as well
+        if user_ids:
+            RedisClient.get_connection().sadd(FRIENDSHIP_COUNTS_CHANGED_KEY, *user_ids)
+        for user_id, attr in [
+            (from_user_id, 'followings_count'),
+            (to_user_id, 'followers_count'),
+        ]:
+            if user_id is None:
+                continue
+            profile = UserService.get_profile_through_cache(user_id)
+            UserProfile.objects.filter(id=profile.id).update(**{attr: F(attr) + delta})
+            if delta > 0:
+                RedisHelper.incr_count(profile, attr)
+            else:
+                RedisHelper.decr_count(profile, attr)
+
     @classmethod
     def get_following_count(cls, from_user_id):
+        profile = UserService.get_profile_through_cache(from_user_id)
+        return RedisHelper.get_count(profile, 'followings_count')
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        profile = UserService.get_profile_through_cache(to_user_id)
+        return RedisHelper.get_count(profile, 'followers_count')
+
+    @classmethod
+    def get_following_counts_from_db(cls, from_user_ids):
+        # {from_user_id: count} for the users having followings, exact but
+        # one GROUP BY on mysql or one key only scan per user on hbase
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            return Friendship.objects.filter(from_user_id=from_user_id).count()
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        return len(followings)
+            # order_by() drops Meta.ordering, which would be grouped by too
+            return dict(Friendship.objects.filter(
+                from_user_id__in=from_user_ids,
+            ).order_by().values_list('from_user_id').annotate(Count('id')))
+        counts = {
+            from_user_id: HBaseFollowing.count(prefix=(from_user_id, None))
+            for from_user_id in from_user_ids
+        }
+        return {user_id: count for user_id, count in counts.items() if count}
+
+    @classmethod
+    def get_follower_counts_from_db(cls, to_user_ids):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            # order_by() drops Meta.ordering, which would be grouped by too
+            return dict(Friendship.objects.filter(
+                to_user_id__in=to_user_ids,
+            ).order_by().values_list('to_user_id').annotate(Count('id')))
+        counts = {
+            to_user_id: HBaseFollower.count(prefix=(to_user_id, None))
+            for to_user_id in to_user_ids
+        }
+        return {user_id: count for user_id, count in counts.items() if count}
+
+    @classmethod
+    def pop_changed_count_user_ids(cls, count):
+        # at most count users whose counts changed, removed from the set
+        user_ids = RedisClient.get_connection().spop(FRIENDSHIP_COUNTS_CHANGED_KEY, count)
+        return [int(user_id) for user_id in user_ids]
+
+    @classmethod
+    def repair_friendship_counts(cls, user_ids):
+        """
+        Set followers_count and followings_count of the users to the counts
+        of their friendships, e.g. after a follow whose count update failed,
+        or for friendships created before the counts existed.
+        Returns the number of users whose counts were wrong.
+        """
+        following_counts = cls.get_following_counts_from_db(user_ids)
+        follower_counts = cls.get_follower_counts_from_db(user_ids)
+        profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.filter(user_id__in=user_ids)
+        }
+        conn = RedisClient.get_connection()
+        repaired = 0
+        for user_id in user_ids:
+            counts = {
+                'followings_count': following_counts.get(user_id, 0),
+                'followers_count': follower_counts.get(user_id, 0),
+            }
+            profile = profiles.get(user_id)
+            if profile is None:
+                if not any(counts.values()):
+                    continue
+                # profile is created lazily, see get_profile_through_cache
+                profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
+            wrong_attrs = [
+                attr
+                for attr, count in counts.items()
+                if getattr(profile, attr) != count
+            ]
+            if not wrong_attrs:
+                continue
+            UserProfile.objects.filter(id=profile.id).update(**{
+                attr: counts[attr]
+                for attr in wrong_attrs
+            })
+            # loaded from db again on the next read
+            conn.delete(*[RedisHelper.get_count_key(profile, attr) for attr in wrong_attrs])
+            repaired += 1
+        return repaired
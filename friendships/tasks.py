@@ -0,0 +1,28 @@
+from celery import shared_task
+from friendships.constants import COUNT_REPAIR_BATCH_SIZE
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def repair_friendship_counts_batch_task(user_ids):
+    # import inside to avoid dependency circular
+    from friendships.services import FriendshipService
+    repaired = FriendshipService.repair_friendship_counts(user_ids)
+    return '{} users checked, {} repaired.'.format(len(user_ids), repaired)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def repair_friendship_counts_main_task():
+    # Runs periodically, see CELERY_BEAT_SCHEDULE. Only the users followed
+    # or unfollowed since the last run are checked, the counts of all users
+    # are seeded by the seed_friendship_counts command.
+    # import inside to avoid dependency circular
+    from friendships.services import FriendshipService
+    batch_count = 0
+    while True:
+        user_ids = FriendshipService.pop_changed_count_user_ids(COUNT_REPAIR_BATCH_SIZE)
+        if not user_ids:
+            break
+        repair_friendship_counts_batch_task.delay(user_ids)
+        batch_count += 1
+    return '{} batches of friendship counts to repair.'.format(batch_count)
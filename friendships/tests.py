@@ -1,10 +1,22 @@
-from friendships.services import FriendshipService
+from accounts.models import UserProfile
+from django.conf import settings
+from django.core.management import call_command
+from django.test import override_settings
+from friendships.services import FOLLOWINGS_LOADED, FOLLOWINGS_LOADING, FriendshipService
+from friendships.tasks import repair_friendship_counts_main_task
 from testing.testcases import TestCase
 from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import HBaseFollowing, HBaseFollower
+from friendships.models import Friendship, HBaseFollowing, HBaseFollower, HBaseFriendship
+from gatekeeper.models import GateKeeper
+from twitter.cache import FOLLOWINGS_PATTERN, FRIENDSHIP_MIGRATION_CURSOR_KEY
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+from io import StringIO
 
 import time
 
+
 class FriendshipServiceTests(TestCase):
 
     def setUp(self):
@@ -25,6 +37,260 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(self.test1.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
+    def test_iter_follower_id_batches(self):
+        followers = [self.create_user('follower{}'.format(i)) for i in range(5)]
+        for follower in followers:
+            self.create_friendship(from_user=follower, to_user=self.test1)
+
+        batches = list(FriendshipService.iter_follower_id_batches(self.test1.id, 2))
+        self.assertEqual(
+            [follower_ids for follower_ids, _ in batches],
+            [[followers[0].id, followers[1].id], [followers[2].id, followers[3].id], [followers[4].id]],
+        )
+        batches = list(FriendshipService.iter_follower_id_batches(self.test1.id, 5))
+        self.assertEqual(batches[0][0], [follower.id for follower in followers])
+        batches = list(FriendshipService.iter_follower_id_batches(self.test2.id, 2))
+        self.assertEqual(batches, [])
+
+        # continue from the cursor of the first batch
+        iterator = FriendshipService.iter_follower_id_batches(self.test1.id, 2)
+        _, cursor = next(iterator)
+        batches = list(FriendshipService.iter_follower_id_batches(self.test1.id, 2, cursor))
+        self.assertEqual(
+            [follower_ids for follower_ids, _ in batches],
+            [[followers[2].id, followers[3].id], [followers[4].id]],
+        )
+
+    def test_following_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users[:2]:
+            FriendshipService.follow(self.test1.id, user.id)
+        key = FOLLOWINGS_PATTERN.format(user_id=self.test1.id)
+        conn = RedisClient.get_connection()
+        self.assertFalse(conn.exists(key))
+
+        # loaded on the first read, then kept up to date
+        user_id_set = FriendshipService.get_following_user_id_set(self.test1.id)
+        self.assertSetEqual(user_id_set, {users[0].id, users[1].id})
+        FriendshipService.follow(self.test1.id, users[2].id)
+        FriendshipService.unfollow(self.test1.id, users[0].id)
+        self.assertTrue(conn.sismember(key, users[2].id))
+        self.assertFalse(conn.sismember(key, users[0].id))
+        user_id_set = FriendshipService.get_following_user_id_set(self.test1.id)
+        self.assertSetEqual(user_id_set, {users[1].id, users[2].id})
+        self.assertEqual(
+            FriendshipService.has_followed_many(self.test1.id, [user.id for user in users]),
+            {users[0].id: False, users[1].id: True, users[2].id: True},
+        )
+        self.assertEqual(FriendshipService.has_followed_many(self.test2.id, [users[0].id]), {users[0].id: False})
+        self.assertSetEqual(FriendshipService.get_following_user_id_set(self.test2.id), set())
+
+        # too many followings to cache
+        limit = settings.REDIS_FOLLOWINGS_SET_SIZE_LIMIT
+        users += [self.create_user('many{}'.format(i)) for i in range(limit)]
+        for user in users[3:]:
+            FriendshipService.follow(self.test1.id, user.id)
+        self.assertFalse(conn.exists(key))
+        user_id_set = FriendshipService.get_following_user_id_set(self.test1.id)
+        self.assertEqual(len(user_id_set), limit + 2)
+        self.assertEqual(conn.smembers(key), {b'-1'})
+        self.assertEqual(
+            FriendshipService.has_followed_many(self.test1.id, [users[0].id, users[-1].id]),
+            {users[0].id: False, users[-1].id: True},
+        )
+
+    def test_following_cache_without_smismember(self):
+        # redis servers older than 6.2
+        RedisHelper._has_smismember = False
+        try:
+            FriendshipService.follow(self.test1.id, self.test2.id)
+            user = self.create_user('user')
+            self.assertEqual(
+                FriendshipService.has_followed_many(self.test1.id, [self.test2.id, user.id]),
+                {self.test2.id: True, user.id: False},
+            )
+            FriendshipService.follow(self.test1.id, user.id)
+            self.assertEqual(
+                FriendshipService.has_followed_many(self.test1.id, [self.test2.id, user.id]),
+                {self.test2.id: True, user.id: True},
+            )
+        finally:
+            RedisHelper._has_smismember = None
+
+    def test_following_cache_load_race(self):
+        key = FOLLOWINGS_PATTERN.format(user_id=self.test1.id)
+        conn = RedisClient.get_connection()
+        FriendshipService.follow(self.test1.id, self.test2.id)
+
+        # a follow while the set is being loaded drops the load
+        conn.sadd(key, FOLLOWINGS_LOADING)
+        user = self.create_user('user')
+        FriendshipService.follow(self.test1.id, user.id)
+        self.assertFalse(conn.exists(key))
+
+        # markers are never read as user ids
+        conn.sadd(key, FOLLOWINGS_LOADED, FOLLOWINGS_LOADING, self.test2.id, user.id)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.test1.id),
+            {self.test2.id, user.id},
+        )
+        conn.delete(key)
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.test1.id),
+            {self.test2.id, user.id},
+        )
+        self.assertEqual(
+            conn.smembers(key),
+            {FOLLOWINGS_LOADED, str(self.test2.id).encode(), str(user.id).encode()},
+        )
+        # no loading set is left behind
+        self.assertEqual(conn.keys(key + ':*'), [])
+
+    def test_friendship_counts(self):
+        user = self.create_user('user')
+        FriendshipService.follow(self.test1.id, self.test2.id)
+        FriendshipService.follow(self.test1.id, user.id)
+        FriendshipService.follow(user.id, self.test2.id)
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(self.test2.id), 2)
+        self.assertEqual(FriendshipService.get_follower_count(self.test1.id), 0)
+        FriendshipService.unfollow(self.test1.id, self.test2.id)
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(self.test2.id), 1)
+        self.assertEqual(UserProfile.objects.get(user=self.test2).followers_count, 1)
+
+        # counts drifting from friendships are repaired
+        UserProfile.objects.filter(user=self.test1).update(followings_count=5)
+        RedisClient.clear()
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 5)
+        user_ids = [self.test1.id, self.test2.id, user.id]
+        self.assertEqual(FriendshipService.repair_friendship_counts(user_ids), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 1)
+        self.assertEqual(FriendshipService.repair_friendship_counts(user_ids), 0)
+
+        # only the users followed or unfollowed since the last run
+        UserProfile.objects.update(followers_count=0, followings_count=0)
+        self.assertEqual(
+            repair_friendship_counts_main_task(),
+            '0 batches of friendship counts to repair.',
+        )
+        FriendshipService.follow(self.test2.id, user.id)
+        self.assertEqual(
+            repair_friendship_counts_main_task(),
+            '1 batches of friendship counts to repair.',
+        )
+        profile = UserProfile.objects.get(user=user)
+        self.assertEqual((profile.followers_count, profile.followings_count), (2, 1))
+        self.assertEqual(UserProfile.objects.get(user=self.test1).followings_count, 0)
+
+        # the counts of all users are seeded once
+        self.create_user('other')
+        out = StringIO()
+        call_command('seed_friendship_counts', batch_size=2, stdout=out)
+        self.assertIn('4 users checked, 1 seeded.', out.getvalue())
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(self.test2.id), 1)
+
+    def test_migrate_friendships_to_hbase(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        for user in users:
+            FriendshipService.follow(self.test1.id, user.id)
+        FriendshipService.follow(self.test2.id, self.test1.id)
+        call_command('migrate_friendships_to_hbase', batch_size=3, stdout=StringIO())
+        cursor = RedisClient.get_connection().get(FRIENDSHIP_MIGRATION_CURSOR_KEY)
+        self.assertEqual(int(cursor), Friendship.objects.order_by('id').last().id)
+
+        # dual write while migrating, the next run continues from the cursor
+        GateKeeper.turn_on('switch_friendship_dual_write_to_hbase')
+        FriendshipService.unfollow(self.test1.id, users[0].id)
+        FriendshipService.follow(self.test2.id, users[0].id)
+        out = StringIO()
+        call_command('migrate_friendships_to_hbase', batch_size=3, verify=10, stdout=out)
+        # only the friendship followed after the first run
+        self.assertIn('\n1 friendships copied.', out.getvalue())
+        self.assertIn('missing in hbase', out.getvalue())
+        self.assertNotIn('missing: ', out.getvalue())
+        self.assertNotIn('different following count: ', out.getvalue())
+
+        GateKeeper.turn_on('switch_friendship_to_hbase')
+        self.assertTrue(FriendshipService.has_followed(self.test2.id, users[0].id))
+        self.assertFalse(FriendshipService.has_followed(self.test1.id, users[0].id))
+        self.assertSetEqual(
+            FriendshipService.get_following_user_id_set(self.test1.id),
+            {users[1].id, users[2].id},
+        )
+        self.assertEqual(
+            set(FriendshipService.get_follower_ids(self.test1.id)),
+            {self.test2.id},
+        )
+
+        # a friendship lost in hbase is found by verification
+        HBaseFriendship.delete(from_user_id=self.test1.id, to_user_id=users[1].id)
+        out = StringIO()
+        call_command('migrate_friendships_to_hbase', verify_only=True, verify=50, stdout=out)
+        self.assertIn('missing: id {}'.format(
+            Friendship.objects.get(from_user=self.test1, to_user=users[1]).id,
+        ), out.getvalue())
+
+    def test_hbase_follow_and_unfollow(self):
+        GateKeeper.turn_on('switch_friendship_to_hbase')
+        self.assertFalse(FriendshipService.has_followed(self.test1.id, self.test2.id))
+        following = FriendshipService.follow(self.test1.id, self.test2.id)
+        self.assertTrue(FriendshipService.has_followed(self.test1.id, self.test2.id))
+        self.assertFalse(FriendshipService.has_followed(self.test2.id, self.test1.id))
+        friendship = HBaseFriendship.get(from_user_id=self.test1.id, to_user_id=self.test2.id)
+        self.assertEqual(friendship.created_at, following.created_at)
+
+        self.assertEqual(FriendshipService.unfollow(self.test1.id, self.test2.id), 1)
+        self.assertFalse(FriendshipService.has_followed(self.test1.id, self.test2.id))
+        self.assertEqual(FriendshipService.unfollow(self.test1.id, self.test2.id), 0)
+        self.assertEqual(HBaseFollowing.count(prefix=(self.test1.id, None)), 0)
+        self.assertEqual(HBaseFollower.count(prefix=(self.test2.id, None)), 0)
+        self.assertEqual(FriendshipService.get_following_count(self.test1.id), 0)
+        self.assertEqual(FriendshipService.get_follower_count(self.test2.id), 0)
+
+    @override_settings(HBASE_FRIENDSHIP_LEGACY_LOOKUP=True)
+    def test_backfill_hbase_friendships(self):
+        GateKeeper.turn_on('switch_friendship_to_hbase')
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        # followed before HBaseFriendship, only the two lists have the rows
+        ts = int(time.time() * 1000000)
+        for i, user in enumerate(users):
+            HBaseFollowing.create(from_user_id=self.test1.id, to_user_id=user.id, created_at=ts + i)
+            HBaseFollower.create(from_user_id=self.test1.id, to_user_id=user.id, created_at=ts + i)
+        # no scan unless the deployment opted in
+        with self.settings(HBASE_FRIENDSHIP_LEGACY_LOOKUP=False):
+            self.assertFalse(FriendshipService.has_followed(self.test1.id, users[1].id))
+        self.assertTrue(FriendshipService.has_followed(self.test1.id, users[1].id))
+        self.assertFalse(FriendshipService.has_followed(self.test1.id, self.test2.id))
+        self.assertEqual(FriendshipService.get_follow_instance(self.test1.id, users[1].id).created_at, ts + 1)
+        self.assertEqual(
+            FriendshipService._get_followed_user_id_set(self.test1.id, [users[0].id, self.test2.id]),
+            {users[0].id},
+        )
+        self.assertEqual(FriendshipService.unfollow(self.test1.id, users[0].id), 1)
+        self.assertEqual(HBaseFollowing.count(prefix=(self.test1.id, None)), 2)
+
+        # the next run continues from the cursor
+        FriendshipService.follow(self.test2.id, self.test1.id)
+        call_command('backfill_hbase_friendships', batch_size=1, stdout=StringIO())
+        self.assertEqual(FriendshipService.get_hbase_friendship_backfill()['finished'], True)
+        for user in users[1:]:
+            self.assertIsNotNone(HBaseFriendship.get(from_user_id=self.test1.id, to_user_id=user.id))
+        self.assertIsNone(HBaseFriendship.get(from_user_id=self.test1.id, to_user_id=users[0].id))
+        self.assertEqual(HBaseFriendship.count(), 3)
+        out = StringIO()
+        call_command('backfill_hbase_friendships', stdout=out)
+        self.assertIn('already finished', out.getvalue())
+
+        # no scan once the backfill finished
+        HBaseFriendship.delete(from_user_id=self.test1.id, to_user_id=users[1].id)
+        self.assertFalse(FriendshipService.has_followed(self.test1.id, users[1].id))
+        out = StringIO()
+        call_command('backfill_hbase_friendships', restart=True, stdout=out)
+        self.assertIn('\n3 followings copied.', out.getvalue())
+        self.assertTrue(FriendshipService.has_followed(self.test1.id, users[1].id))
+
 
 class HBaseTests(TestCase):
 
@@ -137,3 +403,66 @@ class HBaseTests(TestCase):
         self.assertEqual(len(results), 2)
         self.assertEqual(results[0].to_user_id, 3)
         self.assertEqual(results[1].to_user_id, 2)
+
+    def test_get_many(self):
+        ts = self.ts_now
+        timestamps = [ts, ts + 1, ts + 2]
+        for to_user_id, ts in zip([2, 3, 4], timestamps):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=ts)
+
+        # in the order of the request, None for missing rows
+        instances = HBaseFollowing.get_many([
+            {'from_user_id': 1, 'created_at': timestamps[2]},
+            {'from_user_id': 1, 'created_at': ts + 3},
+            {'from_user_id': 1, 'created_at': timestamps[0]},
+        ])
+        self.assertEqual(instances[0].to_user_id, 4)
+        self.assertEqual(instances[0].created_at, timestamps[2])
+        self.assertEqual(instances[1], None)
+        self.assertEqual(instances[2].to_user_id, 2)
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+        instances = HBaseFollowing.get_many(
+            [{'from_user_id': 1, 'created_at': timestamps[1]}],
+            columns=['to_user_id'],
+        )
+        self.assertEqual(instances[0].to_user_id, 3)
+        self.assertEqual(instances[0].from_user_id, 1)
+
+    def test_filter_columns_and_count(self):
+        ts = self.ts_now
+        for i, to_user_id in enumerate([2, 3, 4]):
+            HBaseFollowing.create(from_user_id=1, to_user_id=to_user_id, created_at=ts + i)
+        HBaseFollowing.create(from_user_id=2, to_user_id=1, created_at=ts)
+
+        followings = HBaseFollowing.filter(prefix=(1, None), columns=['to_user_id'])
+        self.assertEqual([f.to_user_id for f in followings], [2, 3, 4])
+
+        filter_string = "SingleColumnValueFilter('cf', 'to_user_id', =, 'binary:{}')".format(
+            HBaseFollowing.serialize_field(HBaseFollowing.to_user_id, 3),
+        )
+        followings = HBaseFollowing.filter(prefix=(1, None), filter_string=filter_string)
+        self.assertEqual([f.to_user_id for f in followings], [3])
+
+        self.assertEqual(HBaseFollowing.count(prefix=(1, None)), 3)
+        self.assertEqual(HBaseFollowing.count(prefix=(2, None)), 1)
+        self.assertEqual(HBaseFollowing.count(prefix=(3, None)), 0)
+        self.assertEqual(HBaseFollowing.count(prefix=(1, None), filter_string=filter_string), 1)
+
+    def test_iter_filter(self):
+        ts = self.ts_now
+        for i in range(5):
+            HBaseFollower.create(from_user_id=10 + i, to_user_id=1, created_at=ts + i)
+
+        followers = HBaseFollower.iter_filter(prefix=(1, None), batch_size=2)
+        self.assertEqual(isinstance(followers, list), False)
+        self.assertEqual([f.from_user_id for f in followers], [10, 11, 12, 13, 14])
+
+        followers = HBaseFollower.iter_filter(prefix=(1, None), reverse=True, batch_size=2)
+        self.assertEqual(next(followers).from_user_id, 14)
+        self.assertEqual(next(followers).from_user_id, 13)
+        # stop early, the scanner is closed
+        followers.close()
+
+        followers = HBaseFollower.iter_filter(prefix=(1, None), limit=3, batch_size=2)
+        self.assertEqual(len(list(followers)), 3)
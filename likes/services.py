@@ -13,3 +13,18 @@ class LikeService(object):
             object_id=target.id,
             user=user,
         ).exists()
+
+    @classmethod
+    def get_liked_object_ids(cls, user, model_class, object_ids):
+        """
+        Batch version of has_liked for a page of tweets/comments.
+        One query hitting the <user, content_type, object_id> unique index,
+        returns the set of object ids liked by the user.
+        """
+        if user.is_anonymous or not object_ids:
+            return set()
+        return set(Like.objects.filter(
+            content_type=ContentType.objects.get_for_model(model_class),
+            object_id__in=object_ids,
+            user=user,
+        ).values_list('object_id', flat=True))
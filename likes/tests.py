@@ -0,0 +1,31 @@
+from likes.services import LikeService
+from testing.testcases import TestCase
+from tweets.models import Tweet
+
+
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        super(LikeServiceTests, self).setUp()
+        self.user1 = self.create_user('user1')
+        self.user2 = self.create_user('user2')
+
+    def test_get_liked_object_ids(self):
+        tweets = [self.create_tweet(self.user1) for i in range(3)]
+        self.create_like(self.user2, tweets[0])
+        self.create_like(self.user2, tweets[2])
+        self.create_like(self.user1, tweets[1])
+        tweet_ids = [tweet.id for tweet in tweets]
+
+        with self.assertNumQueries(1):
+            liked_ids = LikeService.get_liked_object_ids(self.user2, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {tweets[0].id, tweets[2].id})
+        for tweet in tweets:
+            self.assertEqual(
+                tweet.id in liked_ids,
+                LikeService.has_liked(self.user2, tweet),
+            )
+
+        liked_ids = LikeService.get_liked_object_ids(self.user1, Tweet, tweet_ids)
+        self.assertEqual(liked_ids, {tweets[1].id})
+        self.assertEqual(LikeService.get_liked_object_ids(self.user1, Tweet, []), set())
@@ -1,19 +1,49 @@
 from rest_framework import serializers
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class NewsFeedSerializer(serializers.Serializer):
     tweet = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
 
+    class Meta:
+        list_serializer_class = PrefetchListSerializer
+
     def update(self, instance, validated_data):
         pass
 
     def create(self, validated_data):
         pass
 
+    def prefetch(self, newsfeeds):
+        MemcachedHelper.prefetch_objects(newsfeeds, Tweet, 'tweet_id', '_cached_tweet')
+        # the tweet has been deleted, don't look it up again when rendering
+        for newsfeed in newsfeeds:
+            if not hasattr(newsfeed, '_cached_tweet'):
+                newsfeed._cached_tweet = None
+        # one tweet serializer for the whole page, so that whatever it
+        # prefetched can be reused by every newsfeed.
+        self._tweet_serializer = TweetSerializer(context=self.context)
+        self._tweet_serializer.prefetch([
+            newsfeed.cached_tweet
+            for newsfeed in newsfeeds
+            if newsfeed.cached_tweet is not None
+        ])
+
     def get_tweet(self, obj):
-        return TweetSerializer(obj.cached_tweet, context=self.context).data
+        try:
+            tweet = obj.cached_tweet
+        except Tweet.DoesNotExist:
+            tweet = None
+        # the tweet has been deleted
+        if tweet is None:
+            return None
+        if hasattr(self, '_tweet_serializer'):
+            return self._tweet_serializer.to_representation(tweet)
+        return TweetSerializer(tweet, context=self.context).data
 
     def get_created_at(self, obj):
         return obj.created_at
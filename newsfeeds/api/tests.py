@@ -162,6 +162,23 @@ class NewsFeedApiTests(TestCase):
         results = response.data['results']
         self.assertEqual(results[0]['tweet']['content'], 'content2')
 
+    def test_deleted_tweet(self):
+        tweets = [
+            self.create_tweet(self.user1, 'content{}'.format(i))
+            for i in range(3)
+        ]
+        for tweet in tweets:
+            self.create_newsfeed(self.user2, tweet)
+        tweets[1].delete()
+
+        response = self.user2_client.get(NEWSFEEDS_URL)
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['tweet']['content'], 'content2')
+        self.assertEqual(results[1]['tweet'], None)
+        self.assertEqual(results[2]['tweet']['content'], 'content0')
+
     def _paginate_to_get_newsfeeds(self, client):
         # paginate until the end
         response = client.get(NEWSFEEDS_URL)
@@ -215,3 +232,36 @@ class NewsFeedApiTests(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    def test_celebrity_newsfeeds_beyond_cache(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user1, self.user2)
+        self.create_friendship(self.user1, user3)
+        NewsFeedService.mark_as_celebrity(self.user2.id)
+
+        # tweets of user3 are pushed, tweets of user2 are pulled, only the
+        # latest list_limit newsfeeds are cached
+        tweets = []
+        for i in range(list_limit + page_size * 2):
+            if i % 3 == 0:
+                tweets.append(self.create_tweet(self.user2, 'celebrity{}'.format(i)))
+                continue
+            tweet = self.create_tweet(user3, 'pushed{}'.format(i))
+            self.create_newsfeed(self.user1, tweet)
+            tweets.append(tweet)
+        tweets = tweets[::-1]
+
+        def _test_merged_newsfeeds():
+            results = self._paginate_to_get_newsfeeds(self.user1_client)
+            self.assertEqual(
+                [result['tweet']['id'] for result in results],
+                [tweet.id for tweet in tweets],
+            )
+
+        _test_merged_newsfeeds()
+        # cache expired, the celebrities are kept in redis as well
+        self.clear_cache()
+        NewsFeedService.mark_as_celebrity(self.user2.id)
+        _test_merged_newsfeeds()
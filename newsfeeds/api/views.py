@@ -25,7 +25,17 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
         page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
         # the requested data is not in cache, need query db.
         if page is None:
-            if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            celebrity_ids = NewsFeedService.get_followed_celebrity_ids(request.user.id)
+            if celebrity_ids:
+                # tweets of celebrities are merged into the db pages too
+                newsfeeds = NewsFeedService.get_newsfeeds_from_db(
+                    request.user.id,
+                    celebrity_ids,
+                    self.paginator.get_max_score(request),
+                    self.paginator.page_size + 1,
+                )
+                page = self.paginator.paginate_sorted_set(newsfeeds, request)
+            elif GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
                 page = self.paginator.paginate_hbase(HBaseNewsFeed,
                                                      (request.user.id,),
                                                      request)
@@ -1,3 +1,9 @@
 from django.conf import settings
 
-FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
\ No newline at end of file
+FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# seconds, the lease of a fanout job expires this long after the last batch
+# its worker dispatched, then the job can be resumed by another worker
+FANOUT_LEASE_TIMEOUT = 60
+# a backfill task continues in a new task after this many seconds, before
+# its time_limit is reached, see backfill_newsfeeds_range_task
+BACKFILL_TASK_TIME_BUDGET = 50 * 60
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedBackfillService
+from newsfeeds.tasks import backfill_newsfeeds_range_task
+
+
+class Command(BaseCommand):
+    """
+    Copy mysql newsfeeds to HBaseNewsFeed before turning on
+    switch_newsfeed_to_hbase:
+        1. turn on switch_newsfeed_dual_write_to_hbase, newsfeeds created
+           from then on are written to both
+        2. python manage.py backfill_newsfeeds_to_hbase --range-size 10000 --rate 2000
+        3. python manage.py backfill_newsfeeds_to_hbase --report
+        4. turn on switch_newsfeed_to_hbase
+
+    Users are split in id ranges, every range is copied by its own celery
+    task, so the backfill runs on as many workers as there are. A range
+    continues from its checkpoint when the command runs again, finished
+    ranges are skipped. A newsfeed copied by both the backfill and the dual
+    write is written to the same row.
+    """
+    help = 'Copy mysql newsfeeds to hbase with one celery task per user id range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--range-size', type=int, default=10000)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--rate', type=int, default=0,
+            help='newsfeeds copied per second by every task at most, 0 means no limit',
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='forget the progress and copy all ranges from the start',
+        )
+        parser.add_argument(
+            '--report', action='store_true',
+            help='print the progress of every range without starting tasks',
+        )
+
+    def handle(self, *args, **options):
+        if not options['report']:
+            self.dispatch(
+                options['range_size'],
+                options['batch_size'],
+                options['rate'],
+                options['restart'],
+            )
+        self.report()
+
+    def dispatch(self, range_size, batch_size, rate, restart):
+        if restart:
+            NewsFeedBackfillService.clear_progress()
+        bounds = NewsFeed.objects.aggregate(min_id=Min('user_id'), max_id=Max('user_id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No newsfeeds to backfill.')
+            return
+
+        progress = NewsFeedBackfillService.get_progress()
+        dispatched = 0
+        for start_user_id in range(bounds['min_id'], bounds['max_id'] + 1, range_size):
+            end_user_id = start_user_id + range_size
+            range_progress = progress.get((start_user_id, end_user_id))
+            if range_progress is not None and \
+                    range_progress['status'] == NewsFeedBackfillService.FINISHED:
+                continue
+            backfill_newsfeeds_range_task.delay(start_user_id, end_user_id, batch_size, rate)
+            dispatched += 1
+        self.stdout.write('{} ranges of {} users dispatched.'.format(dispatched, range_size))
+
+    def report(self):
+        progress = NewsFeedBackfillService.get_progress()
+        for (start_user_id, end_user_id), range_progress in progress.items():
+            self.stdout.write('users [{}, {}): {} newsfeeds copied, {}'.format(
+                start_user_id,
+                end_user_id,
+                range_progress['copied'],
+                range_progress['status'],
+            ))
+        finished = sum(
+            1
+            for range_progress in progress.values()
+            if range_progress['status'] == NewsFeedBackfillService.FINISHED
+        )
+        self.stdout.write('{} of {} ranges finished, {} newsfeeds copied.'.format(
+            finished,
+            len(progress),
+            sum(range_progress['copied'] for range_progress in progress.values()),
+        ))
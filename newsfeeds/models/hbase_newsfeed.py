@@ -13,14 +13,27 @@ class HBaseNewsFeed(models.HBaseModel):
     class Meta:
         table_name = 'twitter_newsfeeds'
         row_key = ('user_id', 'created_at')
+        # A fanout writes to thousands of followers at once. The reversed
+        # user_id only spreads them by its last digit, over 10 key ranges.
+        # The salt spreads them over 16 buckets, newsfeeds of one user stay
+        # in one bucket so that a page is still a single scan.
+        salt_buckets = 16
+        # rows written before salting was turned on
+        legacy_row_key_codec = 'string'
 
     def __str__(self):
         return '{} inbox of {}: {}'.format(self.created_at, self.user_id, self.tweet_id)
 
     @property
     def cached_tweet(self):
+        # set in batch by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
     @property
     def cached_user(self):
+        # set in batch by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
\ No newline at end of file
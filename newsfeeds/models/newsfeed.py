@@ -22,6 +22,9 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
+        # set in batch by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
         return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
 
 post_save.connect(push_newsfeed_to_cache, sender=NewsFeed)
\ No newline at end of file
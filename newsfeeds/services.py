@@ -1,9 +1,34 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
+from newsfeeds.constants import FANOUT_LEASE_TIMEOUT
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
-from newsfeeds.tasks import fanout_newsfeeds_main_task
-from twitter.cache import USER_NEWSFEEDS_PATTERN
-from utils.redis_helper import RedisHelper
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from newsfeeds.tasks import (
+    fanout_newsfeeds_main_task,
+    invalidate_followed_celebrities_main_task,
+)
+from tweets.models import Tweet
+from tweets.services import TweetService
+from twitter.cache import (
+    USER_NEWSFEEDS_PATTERN,
+    CELEBRITY_USER_IDS_KEY,
+    FOLLOWED_CELEBRITIES_PATTERN,
+    FANOUT_JOB_PATTERN,
+    FANOUT_JOB_LEASE_PATTERN,
+    NEWSFEED_BACKFILL_KEY,
+)
+from utils.redis_client import RedisClient
+from utils.redis_helper import MergedObjectList, RedisHelper
+from utils.redis_serializers import HBaseModelSerializer, NewsFeedIdSerializer
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
+
+import json
+
+# Member marking a cached followed celebrities set as loaded, user ids start
+# at 1, same as FOLLOWINGS_LOADED of the followings set.
+FOLLOWED_CELEBRITIES_LOADED = b'0'
 
 
 def lazy_load_newsfeeds(user_id):
@@ -28,19 +53,237 @@ class NewsFeedService(object):
         # doesn't know how to serialize Tweet.
         fanout_newsfeeds_main_task.delay(tweet.id, tweet.timestamp, tweet.user_id)
 
+    @classmethod
+    def get_cache_serializer(cls, model_class, user_id):
+        if model_class == HBaseNewsFeed:
+            model_serializer = HBaseModelSerializer
+        else:
+            model_serializer = RedisHelper.get_django_model_serializer()
+        return NewsFeedIdSerializer(
+            model_class,
+            user_id,
+            model_serializer,
+            ids_only=settings.REDIS_NEWSFEED_IDS_ONLY,
+        )
+
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            serializer = HBaseModelSerializer
+            model_class = HBaseNewsFeed
+        else:
+            model_class = NewsFeed
+        newsfeeds = RedisHelper.load_object_list(
+            key,
+            lazy_load_newsfeeds(user_id),
+            serializer=cls.get_cache_serializer(model_class, user_id),
+            sorted_set=RedisHelper.use_sorted_set(USER_NEWSFEEDS_PATTERN),
+        )
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds
+        return cls.merge_celebrity_tweets(
+            user_id,
+            model_class,
+            newsfeeds,
+            celebrity_ids,
+        )
+
+    @classmethod
+    def is_celebrity(cls, user_id):
+        # followers_count kept on the profile by the friendship listeners,
+        # no COUNT query on the followers
+        return FriendshipService.get_follower_count(user_id) >= \
+            settings.CELEBRITY_FOLLOWERS_THRESHOLD
+
+    @classmethod
+    def mark_as_celebrity(cls, user_id):
+        # Once a celebrity, always a celebrity. Otherwise the tweets which
+        # were not pushed would disappear from the followers' newsfeeds.
+        conn = RedisClient.get_connection()
+        if not conn.sadd(CELEBRITY_USER_IDS_KEY, user_id):
+            return
+        # once per celebrity, the followers load their followed celebrities
+        # again on their next read. Walking millions of followers is left to
+        # its own tasks, not to the fanout.
+        invalidate_followed_celebrities_main_task.delay(user_id)
+
+    @classmethod
+    def batch_invalidate_followed_celebrities(cls, user_ids):
+        RedisClient.get_connection().delete(*[
+            FOLLOWED_CELEBRITIES_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        ])
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        key = FOLLOWED_CELEBRITIES_PATTERN.format(user_id=user_id)
+        members = RedisClient.get_connection().smembers(key)
+        if FOLLOWED_CELEBRITIES_LOADED in members:
+            return [
+                int(member)
+                for member in members
+                if member != FOLLOWED_CELEBRITIES_LOADED
+            ]
+        return cls._load_followed_celebrities(user_id)
+
+    @classmethod
+    def _load_followed_celebrities(cls, user_id):
+        conn = RedisClient.get_connection()
+        celebrity_ids = {
+            int(celebrity_id)
+            for celebrity_id in conn.smembers(CELEBRITY_USER_IDS_KEY)
+        }
+        # most users follow no celebrity at all, skip the followings query
+        if celebrity_ids:
+            celebrity_ids &= FriendshipService.get_following_user_id_set(user_id)
+        key = FOLLOWED_CELEBRITIES_PATTERN.format(user_id=user_id)
+        # MULTI, readers never see a half written set
+        pipeline = conn.pipeline()
+        pipeline.delete(key)
+        pipeline.sadd(key, FOLLOWED_CELEBRITIES_LOADED, *celebrity_ids)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+        return list(celebrity_ids)
+
+    @classmethod
+    def add_followed_celebrity(cls, from_user_id, to_user_id):
+        conn = RedisClient.get_connection()
+        if not conn.sismember(CELEBRITY_USER_IDS_KEY, to_user_id):
+            return
+        # loaded again with the new celebrity on the next read
+        cls.invalidate_followed_celebrities(from_user_id)
+
+    @classmethod
+    def remove_followed_celebrity(cls, from_user_id, to_user_id):
+        key = FOLLOWED_CELEBRITIES_PATTERN.format(user_id=from_user_id)
+        RedisClient.get_connection().srem(key, to_user_id)
+
+    @classmethod
+    def invalidate_followed_celebrities(cls, user_id):
+        key = FOLLOWED_CELEBRITIES_PATTERN.format(user_id=user_id)
+        RedisClient.get_connection().delete(key)
+
+    @classmethod
+    def merge_celebrity_tweets(cls, user_id, model_class, newsfeeds, celebrity_ids):
+        """
+        Tweets of celebrities are not pushed to followers (see
+        fanout_newsfeeds_main_task). The cached tweets of every followed
+        celebrity are k-way merged into the newsfeeds by created_at when
+        read, only the page asked for is read from each list.
+        The cached lists are truncated, the pages below the oldest cached
+        object of any of them are merged from db by get_newsfeeds_from_db.
+        """
+        return cls._merge_newsfeeds(
+            user_id,
+            model_class,
+            [newsfeeds] + [
+                TweetService.get_cached_tweets(celebrity_id)
+                for celebrity_id in celebrity_ids
+            ],
+            truncated_length=settings.REDIS_LIST_LENGTH_LIMIT,
+        )
+
+    @classmethod
+    def get_newsfeeds_from_db(cls, user_id, celebrity_ids, max_score, limit):
+        """
+        Db version of merge_celebrity_tweets for the pages which are not
+        cached, at most limit newsfeeds and limit tweets of every followed
+        celebrity older than max_score are read and merged.
+        """
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            model_class = HBaseNewsFeed
+            if max_score is None:
+                newsfeeds = HBaseNewsFeed.filter(
+                    prefix=(user_id, None),
+                    limit=limit,
+                    reverse=True,
+                )
+            else:
+                newsfeeds = HBaseNewsFeed.filter(
+                    start=(user_id, max_score),
+                    stop=(user_id, None),
+                    limit=limit + 1,
+                    reverse=True,
+                )
+                # hbase only supports <= instead of <
+                newsfeeds = [
+                    newsfeed
+                    for newsfeed in newsfeeds
+                    if newsfeed.created_at < max_score
+                ][:limit]
+        else:
+            model_class = NewsFeed
+            newsfeeds = NewsFeed.objects.filter(user_id=user_id)
+            if max_score is not None:
+                newsfeeds = newsfeeds.filter(created_at__lt=timestamp_to_datetime(max_score))
+            newsfeeds = list(newsfeeds.order_by('-created_at')[:limit])
+
+        tweet_lists = []
+        for celebrity_id in celebrity_ids:
+            tweets = Tweet.objects.filter(user_id=celebrity_id)
+            if max_score is not None:
+                tweets = tweets.filter(created_at__lt=timestamp_to_datetime(max_score))
+            tweet_lists.append(list(tweets.order_by('-created_at')[:limit]))
+        return cls._merge_newsfeeds(user_id, model_class, [newsfeeds] + tweet_lists)
+
+    @classmethod
+    def _merge_newsfeeds(cls, user_id, model_class, object_lists, truncated_length=None):
+        def _convert(obj):
+            if isinstance(obj, model_class):
+                return obj
+            return cls._newsfeed_from_tweet(model_class, user_id, obj)
+
+        return MergedObjectList(
+            object_lists,
+            convert=_convert,
+            # pushed before the author became a celebrity
+            unique_key=lambda newsfeed: newsfeed.tweet_id,
+            truncated_length=truncated_length,
+        )
+
+    @classmethod
+    def _newsfeed_from_tweet(cls, model_class, user_id, tweet):
+        # same created_at as the fanout task would have used
+        if model_class == HBaseNewsFeed:
+            created_at = tweet.timestamp
         else:
-            serializer = DjangoModelSerializer
-        return RedisHelper.load_objects(key, lazy_load_newsfeeds(user_id), serializer=serializer)
+            created_at = tweet.created_at
+        newsfeed = model_class(user_id=user_id, tweet_id=tweet.id, created_at=created_at)
+        # the tweet is at hand already, no need to hydrate it again
+        setattr(newsfeed, '_cached_tweet', tweet)
+        return newsfeed
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, lazy_load_newsfeeds(newsfeed.user_id))
+        RedisHelper.push_object(
+            key,
+            newsfeed,
+            lazy_load_newsfeeds(newsfeed.user_id),
+            serializer=cls.get_cache_serializer(
+                newsfeed.__class__,
+                newsfeed.user_id,
+            ),
+            sorted_set=RedisHelper.use_sorted_set(USER_NEWSFEEDS_PATTERN),
+        )
+
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds):
+        # one pipeline for the whole fanout batch instead of round trips per
+        # follower, returns (warm_count, skipped_count)
+        items = [
+            (
+                USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id),
+                newsfeed,
+                cls.get_cache_serializer(newsfeed.__class__, newsfeed.user_id),
+            )
+            for newsfeed in newsfeeds
+        ]
+        return RedisHelper.push_objects_to_warm_keys(
+            items,
+            sorted_set=RedisHelper.use_sorted_set(USER_NEWSFEEDS_PATTERN),
+        )
 
     @classmethod
     def create(cls, **kwargs):
@@ -50,6 +293,7 @@ class NewsFeedService(object):
             cls.push_newsfeed_to_cache(newsfeed)
         else:
             newsfeed = NewsFeed.objects.create(**kwargs)
+            cls._dual_write_to_hbase([newsfeed])
         return newsfeed
 
     @classmethod
@@ -57,10 +301,261 @@ class NewsFeedService(object):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
             newsfeeds = HBaseNewsFeed.batch_create(batch_params)
         else:
-            newsfeeds = [NewsFeed(**params) for params in batch_params]
-            NewsFeed.objects.bulk_create(newsfeeds)
+            newsfeeds = cls._exclude_existing_newsfeeds(
+                [NewsFeed(**params) for params in batch_params],
+            )
+            # ignore_conflicts for a batch written by two workers at once
+            NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=True)
+            cls._dual_write_to_hbase(newsfeeds)
 
         # bulk create won't trigger post_save signal, manually push to cache.
-        for newsfeed in newsfeeds:
-            NewsFeedService.push_newsfeed_to_cache(newsfeed)
-        return newsfeeds
+        warm_count, skipped_count = cls.push_newsfeeds_to_cache(newsfeeds)
+        return newsfeeds, warm_count, skipped_count
+
+    @classmethod
+    def _dual_write_to_hbase(cls, newsfeeds):
+        # newsfeeds created while the backfill runs are copied by the
+        # writes themselves, with the same row keys as the backfill, see
+        # the backfill_newsfeeds_to_hbase command
+        if GateKeeper.is_switch_on('switch_newsfeed_dual_write_to_hbase'):
+            NewsFeedBackfillService.copy_newsfeeds_to_hbase(newsfeeds)
+
+    @classmethod
+    def _exclude_existing_newsfeeds(cls, newsfeeds):
+        # A resumed fanout can dispatch a batch again, (user, tweet) is
+        # unique, newsfeeds written already are neither created nor pushed
+        # to cache again. hbase rows are overwritten, no need there.
+        if not newsfeeds:
+            return newsfeeds
+        existing = set(NewsFeed.objects.filter(
+            user_id__in=[newsfeed.user_id for newsfeed in newsfeeds],
+            tweet_id__in=set(newsfeed.tweet_id for newsfeed in newsfeeds),
+        ).values_list('user_id', 'tweet_id'))
+        return [
+            newsfeed
+            for newsfeed in newsfeeds
+            if (newsfeed.user_id, newsfeed.tweet_id) not in existing
+        ]
+
+
+class FanoutJobService(object):
+    """
+    Progress of the fanout of a tweet, kept in a redis hash so that a
+    restarted fanout continues from the last follower cursor instead of
+    reading the follower list from the start again.
+    """
+
+    RUNNING = 'running'
+    FINISHED = 'finished'
+
+    INT_FIELDS = (
+        'tweet_user_id',
+        'author_newsfeed_created',
+        'total_followers',
+        'followers_dispatched',
+        'batches_dispatched',
+        'batches_completed',
+    )
+    # created_at is a datetime or a timestamp, cursor depends on the backend
+    JSON_FIELDS = ('created_at', 'cursor')
+
+    @classmethod
+    def get_key(cls, tweet_id):
+        return FANOUT_JOB_PATTERN.format(tweet_id=tweet_id)
+
+    @classmethod
+    def get_job(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        values = conn.hgetall(cls.get_key(tweet_id))
+        if not values:
+            return None
+        job = {key.decode(): value.decode() for key, value in values.items()}
+        for field in cls.INT_FIELDS:
+            job[field] = int(job[field])
+        for field in cls.JSON_FIELDS:
+            job[field] = json.loads(job[field])
+        return job
+
+    @classmethod
+    def create_job(cls, tweet_id, created_at, tweet_user_id):
+        job = {
+            'tweet_user_id': tweet_user_id,
+            'created_at': created_at,
+            'author_newsfeed_created': 0,
+            'total_followers': FriendshipService.get_follower_count(tweet_user_id),
+            'followers_dispatched': 0,
+            'batches_dispatched': 0,
+            'batches_completed': 0,
+            'cursor': None,
+            'status': cls.RUNNING,
+        }
+        mapping = dict(job)
+        for field in cls.JSON_FIELDS:
+            mapping[field] = json.dumps(job[field], cls=DjangoJSONEncoder)
+
+        key = cls.get_key(tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hset(key, mapping=mapping)
+        pipeline.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+        # read back, so that created_at looks the same as in a resumed job
+        return cls.get_job(tweet_id)
+
+    @classmethod
+    def get_lease(cls, tweet_id):
+        """
+        Only the worker holding the lease runs the fanout of the tweet, a
+        resume while the first worker is alive returns right away.
+            lease = FanoutJobService.get_lease(tweet_id)
+            if lease.acquire(blocking=False):
+                ...
+                lease.reacquire()  # after every batch
+        A redis lock with a token of its own, only its owner can extend or
+        release it. It expires FANOUT_LEASE_TIMEOUT seconds after the last
+        reacquire, when the worker died.
+        """
+        conn = RedisClient.get_connection()
+        return conn.lock(
+            FANOUT_JOB_LEASE_PATTERN.format(tweet_id=tweet_id),
+            timeout=FANOUT_LEASE_TIMEOUT,
+        )
+
+    @classmethod
+    def record_author_newsfeed(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        conn.hset(cls.get_key(tweet_id), 'author_newsfeed_created', 1)
+
+    @classmethod
+    def record_dispatch(cls, tweet_id, follower_count, cursor):
+        # counters and cursor move together, returns the updated counters
+        key = cls.get_key(tweet_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline()
+        pipeline.hincrby(key, 'followers_dispatched', follower_count)
+        pipeline.hincrby(key, 'batches_dispatched', 1)
+        pipeline.hset(key, 'cursor', json.dumps(cursor))
+        followers_dispatched, batches_dispatched, _ = pipeline.execute()
+        return followers_dispatched, batches_dispatched
+
+    @classmethod
+    def record_completion(cls, tweet_id):
+        key = cls.get_key(tweet_id)
+        conn = RedisClient.get_connection()
+        # do not leave a record without expire time behind for expired jobs
+        if not conn.exists(key):
+            return
+        conn.hincrby(key, 'batches_completed', 1)
+
+    @classmethod
+    def finish_job(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        conn.hset(cls.get_key(tweet_id), 'status', cls.FINISHED)
+
+
+class NewsFeedBackfillService(object):
+    """
+    Copies mysql newsfeeds to HBaseNewsFeed before switch_newsfeed_to_hbase
+    is turned on, one celery task per user id range, see the
+    backfill_newsfeeds_to_hbase command. Newsfeeds created meanwhile are
+    written to both with switch_newsfeed_dual_write_to_hbase. Progress of
+    every range is a json field of one redis hash, so that the backfill can
+    be stopped, resumed and reported on.
+    """
+
+    RUNNING = 'running'
+    FINISHED = 'finished'
+
+    @classmethod
+    def get_range_name(cls, start_user_id, end_user_id):
+        return '{}-{}'.format(start_user_id, end_user_id)
+
+    @classmethod
+    def get_progress(cls):
+        # {(start_user_id, end_user_id): progress}, by start_user_id
+        conn = RedisClient.get_connection()
+        progress = {}
+        for name, value in conn.hgetall(NEWSFEED_BACKFILL_KEY).items():
+            start_user_id, end_user_id = name.decode().split('-')
+            progress[(int(start_user_id), int(end_user_id))] = json.loads(value)
+        return dict(sorted(progress.items()))
+
+    @classmethod
+    def get_range_progress(cls, start_user_id, end_user_id):
+        conn = RedisClient.get_connection()
+        value = conn.hget(
+            NEWSFEED_BACKFILL_KEY,
+            cls.get_range_name(start_user_id, end_user_id),
+        )
+        return json.loads(value) if value is not None else None
+
+    @classmethod
+    def record_progress(cls, start_user_id, end_user_id, cursor, copied, status):
+        conn = RedisClient.get_connection()
+        conn.hset(
+            NEWSFEED_BACKFILL_KEY,
+            cls.get_range_name(start_user_id, end_user_id),
+            json.dumps({'cursor': cursor, 'copied': copied, 'status': status}),
+        )
+
+    @classmethod
+    def clear_progress(cls):
+        RedisClient.get_connection().delete(NEWSFEED_BACKFILL_KEY)
+
+    @classmethod
+    def iter_newsfeed_batches(cls, start_user_id, end_user_id, batch_size, cursor=None):
+        """
+        Yield (newsfeeds, cursor) for the newsfeeds of users in
+        [start_user_id, end_user_id). Keyset pagination on the
+        (user_id, created_at) index, id breaks the tie of newsfeeds created
+        at the same time. cursor is [user_id, created_at timestamp, id] of
+        the last newsfeed read.
+        """
+        queryset = NewsFeed.objects.filter(
+            user_id__gte=start_user_id,
+            user_id__lt=end_user_id,
+        )
+        while True:
+            batch = queryset
+            if cursor is not None:
+                last_user_id, last_created_at, last_id = cursor
+                last_created_at = timestamp_to_datetime(last_created_at)
+                batch = batch.filter(
+                    Q(user_id__gt=last_user_id) |
+                    Q(user_id=last_user_id, created_at__gt=last_created_at) |
+                    Q(user_id=last_user_id, created_at=last_created_at, id__gt=last_id)
+                )
+            newsfeeds = list(batch.order_by('user_id', 'created_at', 'id')[:batch_size])
+            if not newsfeeds:
+                return
+            last = newsfeeds[-1]
+            cursor = [last.user_id, datetime_to_timestamp(last.created_at), last.id]
+            yield newsfeeds, cursor
+            if len(newsfeeds) < batch_size:
+                return
+
+    @classmethod
+    def copy_newsfeeds_to_hbase(cls, newsfeeds):
+        """
+        One HBaseNewsFeed table batch for the newsfeeds, returns how many
+        were copied. created_at is tweet.timestamp, the same as fanout
+        writes, so a newsfeed copied again overwrites the same row.
+        """
+        tweet_ids = set(newsfeed.tweet_id for newsfeed in newsfeeds)
+        tweets = {
+            tweet.id: tweet
+            for tweet in Tweet.objects.filter(id__in=tweet_ids).only('id', 'created_at')
+        }
+        # user or tweet is set to null when deleted
+        batch_data = [
+            {
+                'user_id': newsfeed.user_id,
+                'created_at': tweets[newsfeed.tweet_id].timestamp,
+                'tweet_id': newsfeed.tweet_id,
+            }
+            for newsfeed in newsfeeds
+            if newsfeed.user_id is not None and newsfeed.tweet_id in tweets
+        ]
+        if batch_data:
+            HBaseNewsFeed.batch_create(batch_data)
+        return len(batch_data)
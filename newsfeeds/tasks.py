@@ -1,43 +1,193 @@
 from celery import shared_task
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.constants import BACKFILL_TASK_TIME_BUDGET, FANOUT_BATCH_SIZE
+from redis.exceptions import LockError
 from utils.time_constants import ONE_HOUR
 
+import time
+
 
 @shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
 def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
     # import inside to avoid dependency circular
-    from newsfeeds.services import NewsFeedService
+    from newsfeeds.services import NewsFeedService, FanoutJobService
     batch_params = [
         {'user_id': follower_id, 'created_at': created_at, 'tweet_id': tweet_id}
         for follower_id in follower_ids
     ]
-    newsfeeds = NewsFeedService.batch_create(batch_params)
-    return "{} newsfeeds created".format(len(newsfeeds))
+    newsfeeds, warm_count, skipped_count = NewsFeedService.batch_create(batch_params)
+    FanoutJobService.record_completion(tweet_id)
+    return "{} newsfeeds created, {} pushed to cache, {} cold caches skipped".format(
+        len(newsfeeds),
+        warm_count,
+        skipped_count,
+    )
 
 
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
 def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
     #  # import inside to avoid dependency circular
-    from newsfeeds.services import NewsFeedService
+    from newsfeeds.services import FanoutJobService
 
-    # Create for the author first.
-    # Make sure the tweet author can see his/her tweet in his/her newsfeeds asap.
-    NewsFeedService.create(
-        user_id=tweet_user_id,
-        tweet_id=tweet_id,
-        created_at=created_at,
-    )
+    # a resume while the worker running the fanout is alive does nothing
+    lease = FanoutJobService.get_lease(tweet_id)
+    if not lease.acquire(blocking=False):
+        return 'Fanout of tweet {} is running in another worker.'.format(tweet_id)
+    try:
+        return _fanout_newsfeeds(tweet_id, created_at, tweet_user_id, lease)
+    except LockError:
+        # the lease expired and another worker took the job over
+        return 'Fanout of tweet {} lost its lease.'.format(tweet_id)
+    finally:
+        try:
+            lease.release()
+        except LockError:
+            pass
+
+
+def _fanout_newsfeeds(tweet_id, created_at, tweet_user_id, lease):
+    from newsfeeds.services import NewsFeedService, FanoutJobService
+
+    # A job record means the fanout was started before and the worker died,
+    # followers before the cursor got their batches already.
+    job = FanoutJobService.get_job(tweet_id)
+    if job is not None and job['status'] == FanoutJobService.FINISHED:
+        return 'Fanout of tweet {} already finished.'.format(tweet_id)
+    if job is None:
+        job = FanoutJobService.create_job(tweet_id, created_at, tweet_user_id)
+
+    if not job['author_newsfeed_created']:
+        # Create for the author first.
+        # Make sure the tweet author can see his/her tweet in his/her newsfeeds asap.
+        NewsFeedService.create(
+            user_id=tweet_user_id,
+            tweet_id=tweet_id,
+            created_at=created_at,
+        )
+        FanoutJobService.record_author_newsfeed(tweet_id)
 
-    # Get all follower ids，divide by batch size
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
+    # Pushing a tweet to millions of followers is too expensive,
+    # followers of a celebrity pull the tweets when reading newsfeeds.
+    # Decided before the first batch only, a resumed fanout goes on.
+    if job['batches_dispatched'] == 0 and NewsFeedService.is_celebrity(tweet_user_id):
+        NewsFeedService.mark_as_celebrity(tweet_user_id)
+        FanoutJobService.finish_job(tweet_id)
+        return 'Celebrity {} skipped fanout, newsfeeds will be pulled.'.format(
+            tweet_user_id,
+        )
+
+    # Stream follower ids batch by batch, every batch is dispatched as soon as
+    # it is read, memory stays bounded by FANOUT_BATCH_SIZE.
+    follower_count = job['followers_dispatched']
+    batch_count = job['batches_dispatched']
+    batches = FriendshipService.iter_follower_id_batches(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+        job['cursor'],
+    )
+    for batch_ids, cursor in batches:
         fanout_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
-        index += FANOUT_BATCH_SIZE
+        # a worker dying right between these two lines dispatches this one
+        # batch again on resume, never skips one. batch_create skips the
+        # newsfeeds it wrote already.
+        follower_count, batch_count = FanoutJobService.record_dispatch(
+            tweet_id,
+            len(batch_ids),
+            cursor,
+        )
+        lease.reacquire()
+    FanoutJobService.finish_job(tweet_id)
 
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        follower_count,
+        batch_count,
+    )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def invalidate_followed_celebrities_batch_task(follower_ids):
+    # import inside to avoid dependency circular
+    from newsfeeds.services import NewsFeedService
+    NewsFeedService.batch_invalidate_followed_celebrities(follower_ids)
+    return '{} followed celebrities sets invalidated.'.format(len(follower_ids))
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def invalidate_followed_celebrities_main_task(celebrity_id):
+    # Same batching as the fanout, one task per FANOUT_BATCH_SIZE followers.
+    # A worker dying in the middle leaves the rest of the sets to
+    # REDIS_KEY_EXPIRE_TIME.
+    batch_count = 0
+    batches = FriendshipService.iter_follower_id_batches(celebrity_id, FANOUT_BATCH_SIZE)
+    for follower_ids, _ in batches:
+        invalidate_followed_celebrities_batch_task.delay(follower_ids)
+        batch_count += 1
+    return 'Followers of celebrity {} invalidated in {} batches.'.format(
+        celebrity_id,
+        batch_count,
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def resume_fanout_newsfeeds_task(tweet_id):
+    # entry point to continue a fanout whose worker died, from its job record
+    from newsfeeds.services import FanoutJobService
+    job = FanoutJobService.get_job(tweet_id)
+    if job is None:
+        return 'No fanout job of tweet {} to resume.'.format(tweet_id)
+    return fanout_newsfeeds_main_task(
+        tweet_id,
+        job['created_at'],
+        job['tweet_user_id'],
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def backfill_newsfeeds_range_task(start_user_id, end_user_id, batch_size, rate=0):
+    # import inside to avoid dependency circular
+    from newsfeeds.services import NewsFeedBackfillService
+
+    # continue from the checkpoint of the range, if any
+    progress = NewsFeedBackfillService.get_range_progress(start_user_id, end_user_id)
+    if progress is not None and progress['status'] == NewsFeedBackfillService.FINISHED:
+        return 'Backfill of users [{}, {}) already finished.'.format(start_user_id, end_user_id)
+    cursor = progress['cursor'] if progress is not None else None
+    copied = progress['copied'] if progress is not None else 0
+
+    task_start = time.monotonic()
+    batches = NewsFeedBackfillService.iter_newsfeed_batches(
+        start_user_id,
+        end_user_id,
+        batch_size,
+        cursor,
+    )
+    for newsfeeds, cursor in batches:
+        batch_start = time.monotonic()
+        copied += NewsFeedBackfillService.copy_newsfeeds_to_hbase(newsfeeds)
+        NewsFeedBackfillService.record_progress(
+            start_user_id,
+            end_user_id,
+            cursor,
+            copied,
+            NewsFeedBackfillService.RUNNING,
+        )
+        if rate:
+            # newsfeeds per second of this task at most
+            time.sleep(max(0, len(newsfeeds) / rate - (time.monotonic() - batch_start)))
+        if time.monotonic() - task_start > BACKFILL_TASK_TIME_BUDGET:
+            # continue from the checkpoint before time_limit kills this task
+            backfill_newsfeeds_range_task.delay(start_user_id, end_user_id, batch_size, rate)
+            return '{} newsfeeds of users [{}, {}) copied, continued in a new task.'.format(
+                copied,
+                start_user_id,
+                end_user_id,
+            )
+
+    NewsFeedBackfillService.record_progress(
+        start_user_id,
+        end_user_id,
+        cursor,
+        copied,
+        NewsFeedBackfillService.FINISHED,
     )
+    return '{} newsfeeds of users [{}, {}) copied.'.format(copied, start_user_id, end_user_id)
@@ -1,10 +1,22 @@
+from django.core.management import call_command
+from django_hbase.models.row_key_codecs import StringRowKeyCodec
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
-from newsfeeds.services import NewsFeedService
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.constants import FANOUT_BATCH_SIZE
+from newsfeeds.services import NewsFeedService, FanoutJobService, NewsFeedBackfillService
+from newsfeeds.tasks import (
+    backfill_newsfeeds_range_task,
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    resume_fanout_newsfeeds_task,
+)
 from testing.testcases import TestCase
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.redis_helper import CachedSortedObjectList, RedisHelper
+
+from io import StringIO
 
 
 class NewsFeedServiceTests(TestCase):
@@ -51,6 +63,112 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
         self.assertEqual([f.created_at for f in feeds], [feed2.created_at, feed1.created_at])
 
+    def test_batch_create(self):
+        old_tweet = self.create_tweet(self.user2)
+        self.create_newsfeed(self.user1, old_tweet)
+        self.create_newsfeed(self.user2, old_tweet)
+        self.clear_cache()
+        # only user1's newsfeeds are cached
+        NewsFeedService.get_cached_newsfeeds(self.user1.id)
+
+        tweet = self.create_tweet(self.user2)
+        created_at = self.get_newsfeed_created_at(tweet)
+        batch_params = [
+            {'user_id': user_id, 'created_at': created_at, 'tweet_id': tweet.id}
+            for user_id in [self.user1.id, self.user2.id]
+        ]
+        newsfeeds, warm_count, skipped_count = NewsFeedService.batch_create(batch_params)
+        self.assertEqual(len(newsfeeds), 2)
+        self.assertEqual((warm_count, skipped_count), (1, 1))
+
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.user2.id)
+        self.assertEqual(conn.exists(key), False)
+        for user in [self.user1, self.user2]:
+            feeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([f.tweet_id for f in feeds], [tweet.id, old_tweet.id])
+
+    def test_sorted_set_cache(self):
+        with self.settings(REDIS_SORTED_SET_PATTERNS=[USER_NEWSFEEDS_PATTERN]):
+            tweets = [self.create_tweet(self.user2) for i in range(3)]
+            self.create_newsfeed(self.user1, tweets[0])
+            # warm up the cache
+            NewsFeedService.get_cached_newsfeeds(self.user1.id)
+
+            # fanout finishes out of order, pushed twice
+            feed1, feed2 = NewsFeed.objects.bulk_create([
+                NewsFeed(user=self.user1, tweet=tweets[1]),
+                NewsFeed(user=self.user1, tweet=tweets[2]),
+            ])
+            NewsFeedService.push_newsfeed_to_cache(feed2)
+            NewsFeedService.push_newsfeed_to_cache(feed1)
+            NewsFeedService.push_newsfeed_to_cache(feed1)
+
+            feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+            self.assertEqual(isinstance(feeds, CachedSortedObjectList), True)
+            self.assertEqual([f.tweet_id for f in feeds], [t.id for t in tweets[::-1]])
+            score = RedisHelper.get_score(feed2)
+            self.assertEqual(
+                [f.tweet_id for f in feeds.filter_by_score(max_score=score)],
+                [tweets[1].id, tweets[0].id],
+            )
+            self.assertEqual(feeds.filter_by_score(min_score=score), [])
+
+        # switched back to list, reloaded from db
+        with self.settings(REDIS_SORTED_SET_PATTERNS=[]):
+            feeds = NewsFeedService.get_cached_newsfeeds(self.user1.id)
+            self.assertEqual([f.tweet_id for f in feeds], [t.id for t in tweets[::-1]])
+            conn = RedisClient.get_connection()
+            key = USER_NEWSFEEDS_PATTERN.format(user_id=self.user1.id)
+            self.assertEqual(conn.type(key), b'list')
+
+    def test_cache_ids_only(self):
+        tweet = self.create_tweet(self.user2)
+        feed = self.create_newsfeed(self.user1, tweet)
+        model_serializer = RedisHelper.get_django_model_serializer()
+        serializer = NewsFeedService.get_cache_serializer(NewsFeed, self.user1.id)
+
+        data = serializer.serialize(feed)
+        self.assertEqual(len(data), 17)
+        self.assertLess(len(data), len(model_serializer.serialize(feed)))
+        obj = serializer.deserialize(data)
+        self.assertEqual(obj.user_id, self.user1.id)
+        self.assertEqual(obj.tweet_id, tweet.id)
+        self.assertEqual(obj.created_at, feed.created_at)
+        self.assertEqual(obj.cached_tweet.id, tweet.id)
+
+        # entries cached before switching to ids only
+        obj = serializer.deserialize(model_serializer.serialize(feed))
+        self.assertEqual(obj.id, feed.id)
+
+        with self.settings(REDIS_NEWSFEED_IDS_ONLY=False):
+            serializer = NewsFeedService.get_cache_serializer(NewsFeed, self.user1.id)
+            self.assertEqual(serializer.serialize(feed), model_serializer.serialize(feed))
+            self.assertEqual(serializer.deserialize(data).tweet_id, tweet.id)
+
+    def test_salted_hbase_newsfeeds(self):
+        ts = self.create_tweet(self.user2).timestamp
+        # written before the newsfeeds were salted
+        legacy_data = {'user_id': self.user1.id, 'created_at': ts, 'tweet_id': 1}
+        legacy_row_key = HBaseNewsFeed.serialize_row_key(legacy_data, codec=StringRowKeyCodec)
+        with HBaseNewsFeed.get_table() as table:
+            table.put(legacy_row_key, HBaseNewsFeed.serialize_row_data(legacy_data))
+        HBaseNewsFeed.create(user_id=self.user1.id, created_at=ts + 1, tweet_id=2)
+        HBaseNewsFeed.create(user_id=self.user2.id, created_at=ts, tweet_id=3)
+
+        row_key = HBaseNewsFeed(user_id=self.user1.id, created_at=ts + 1).row_key
+        self.assertEqual(row_key[0], HBaseNewsFeed.get_salt_bucket(self.user1.id))
+        newsfeeds = HBaseNewsFeed.filter(prefix=(self.user1.id, None), reverse=True)
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [2, 1])
+        self.assertEqual(len(HBaseNewsFeed.filter(prefix=(None, None))), 3)
+
+        # saved again, moved to the salted row key
+        newsfeed = HBaseNewsFeed.get(user_id=self.user1.id, created_at=ts)
+        newsfeed.save()
+        with HBaseNewsFeed.get_table() as table:
+            self.assertEqual(table.row(legacy_row_key), {})
+        self.assertEqual(HBaseNewsFeed.get(user_id=self.user1.id, created_at=ts).tweet_id, 1)
+
 
 class NewsFeedTaskTests(TestCase):
 
@@ -62,12 +180,12 @@ class NewsFeedTaskTests(TestCase):
     def test_fanout_main_task(self):
         tweet = self.create_tweet(self.user1, 'tweet 1')
         self.create_friendship(self.user2, self.user1)
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.user1.id)
-            self.assertEqual(1 + 1, len(HBaseNewsFeed.filter(prefix=(None, None))))
-        else:
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.created_at, self.user1.id)
-            self.assertEqual(1 + 1, NewsFeed.objects.count())
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.get_newsfeed_created_at(tweet),
+            self.user1.id,
+        )
+        self.assertEqual(self.count_newsfeeds(), 1 + 1)
 
         self.assertEqual(msg, '1 newsfeeds going to fanout, 1 batches created.')
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user1.id)
@@ -77,12 +195,12 @@ class NewsFeedTaskTests(TestCase):
             user = self.create_user('someone{}'.format(i))
             self.create_friendship(user, self.user1)
         tweet = self.create_tweet(self.user1, 'tweet 2')
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.user1.id)
-            self.assertEqual(4 + 2, len(HBaseNewsFeed.filter(prefix=(None, None))))
-        else:
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.created_at, self.user1.id)
-            self.assertEqual(4 + 2, NewsFeed.objects.count())
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.get_newsfeed_created_at(tweet),
+            self.user1.id,
+        )
+        self.assertEqual(self.count_newsfeeds(), 4 + 2)
         self.assertEqual(msg, '3 newsfeeds going to fanout, 1 batches created.')
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user1.id)
         self.assertEqual(len(cached_list), 2)
@@ -90,14 +208,193 @@ class NewsFeedTaskTests(TestCase):
         user = self.create_user('another user')
         self.create_friendship(user, self.user1)
         tweet = self.create_tweet(self.user1, 'tweet 3')
-        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.user1.id)
-            self.assertEqual(8 + 3, len(HBaseNewsFeed.filter(prefix=(None, None))))
-        else:
-            msg = fanout_newsfeeds_main_task(tweet.id, tweet.created_at, self.user1.id)
-            self.assertEqual(8 + 3, NewsFeed.objects.count())
+        msg = fanout_newsfeeds_main_task(
+            tweet.id,
+            self.get_newsfeed_created_at(tweet),
+            self.user1.id,
+        )
+        self.assertEqual(self.count_newsfeeds(), 8 + 3)
         self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user1.id)
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.user2.id)
-        self.assertEqual(len(cached_list), 3)
\ No newline at end of file
+        self.assertEqual(len(cached_list), 3)
+
+    def test_celebrity_fanout(self):
+        with self.settings(CELEBRITY_FOLLOWERS_THRESHOLD=2):
+            old_tweet = self.create_tweet(self.user1, 'before famous')
+            self.create_friendship(self.user2, self.user1)
+            fanout_newsfeeds_main_task(old_tweet.id, self.get_newsfeed_created_at(old_tweet), self.user1.id)
+            # followers_count of the profile, no query on the followers
+            self.assertEqual(NewsFeedService.is_celebrity(self.user1.id), False)
+            self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.user2.id), [])
+
+            user3 = self.create_user('user3')
+            self.create_friendship(user3, self.user1)
+            with self.assertNumQueries(0):
+                self.assertEqual(NewsFeedService.is_celebrity(self.user1.id), True)
+            tweet = self.create_tweet(self.user1, 'famous now')
+            msg = fanout_newsfeeds_main_task(tweet.id, self.get_newsfeed_created_at(tweet), self.user1.id)
+            self.assertEqual(
+                msg,
+                'Celebrity {} skipped fanout, newsfeeds will be pulled.'.format(
+                    self.user1.id,
+                ),
+            )
+            # only pushed to the author
+            self.assertEqual(self.count_newsfeeds(), 2 + 1)
+
+            # pulled and merged when reading, pushed one is not duplicated
+            feeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+            self.assertEqual([f.tweet_id for f in feeds], [tweet.id, old_tweet.id])
+            feeds = NewsFeedService.get_cached_newsfeeds(user3.id)
+            self.assertEqual([f.tweet_id for f in feeds], [tweet.id, old_tweet.id])
+            self.assertEqual(feeds[0].cached_tweet.content, 'famous now')
+
+            # the followed celebrities are kept per user
+            self.assertEqual(NewsFeedService.get_followed_celebrity_ids(user3.id), [self.user1.id])
+            user4 = self.create_user('user4')
+            self.assertEqual(NewsFeedService.get_followed_celebrity_ids(user4.id), [])
+            self.create_friendship(user4, self.user1)
+            self.assertEqual(NewsFeedService.get_followed_celebrity_ids(user4.id), [self.user1.id])
+            FriendshipService.unfollow(user4.id, self.user1.id)
+            self.assertEqual(NewsFeedService.get_followed_celebrity_ids(user4.id), [])
+
+    def test_celebrity_newsfeeds_pagination(self):
+        self.create_friendship(self.user2, self.user1)
+        NewsFeedService.mark_as_celebrity(self.user1.id)
+        user3 = self.create_user('user3')
+        self.create_friendship(self.user2, user3)
+        # tweets of user3 are pushed, tweets of user1 are pulled
+        tweets = []
+        for i in range(6):
+            if i % 2:
+                tweets.append(self.create_tweet(self.user1))
+                continue
+            tweet = self.create_tweet(user3)
+            self.create_newsfeed(self.user2, tweet)
+            tweets.append(tweet)
+        tweets = tweets[::-1]
+
+        for _ in range(2):
+            # cache miss first, then read from the cached lists
+            feeds = NewsFeedService.get_cached_newsfeeds(self.user2.id)
+            self.assertEqual(len(feeds), 6)
+            self.assertEqual([f.tweet_id for f in feeds], [t.id for t in tweets])
+            self.assertEqual([f.tweet_id for f in feeds[1:3]], [t.id for t in tweets[1:3]])
+            self.assertEqual(feeds[4].tweet_id, tweets[4].id)
+            # only the window is read from every list
+            window = feeds.filter_by_score(
+                max_score=RedisHelper.get_score(tweets[1]),
+                limit=3,
+            )
+            self.assertEqual([f.tweet_id for f in window], [t.id for t in tweets[2:5]])
+            window = feeds.filter_by_score(min_score=RedisHelper.get_score(tweets[2]))
+            self.assertEqual([f.tweet_id for f in window], [t.id for t in tweets[:2]])
+
+    def test_resume_fanout(self):
+        self.create_friendship(self.user2, self.user1)
+        for i in range(3):
+            user = self.create_user('someone{}'.format(i))
+            self.create_friendship(user, self.user1)
+        tweet = self.create_tweet(self.user1, 'tweet 1')
+        created_at = self.get_newsfeed_created_at(tweet)
+
+        # the worker died right after sending the first batch, before
+        # recording it
+        job = FanoutJobService.create_job(tweet.id, created_at, self.user1.id)
+        self.assertEqual(job['total_followers'], 4)
+        self.assertEqual(job['status'], FanoutJobService.RUNNING)
+        self.create_newsfeed(self.user1, tweet)
+        FanoutJobService.record_author_newsfeed(tweet.id)
+        batches = FriendshipService.iter_follower_id_batches(self.user1.id, FANOUT_BATCH_SIZE)
+        follower_ids, cursor = next(batches)
+        fanout_newsfeeds_batch_task(tweet.id, created_at, follower_ids)
+
+        # no resume while the lease of the first worker is alive
+        lease = FanoutJobService.get_lease(tweet.id)
+        lease.acquire(blocking=False)
+        msg = resume_fanout_newsfeeds_task(tweet.id)
+        self.assertEqual(msg, 'Fanout of tweet {} is running in another worker.'.format(tweet.id))
+        lease.release()
+
+        # the first batch is sent again, its newsfeeds are not written twice
+        msg = resume_fanout_newsfeeds_task(tweet.id)
+        self.assertEqual(msg, '4 newsfeeds going to fanout, 2 batches created.')
+        self.assertEqual(self.count_newsfeeds(), 1 + 4)
+        feeds = NewsFeedService.get_cached_newsfeeds(follower_ids[0])
+        self.assertEqual([feed.tweet_id for feed in feeds], [tweet.id])
+        job = FanoutJobService.get_job(tweet.id)
+        self.assertEqual(job['batches_dispatched'], 2)
+        self.assertEqual(job['batches_completed'], 1 + 2)
+        self.assertEqual(job['status'], FanoutJobService.FINISHED)
+
+        msg = fanout_newsfeeds_main_task(tweet.id, created_at, self.user1.id)
+        self.assertEqual(msg, 'Fanout of tweet {} already finished.'.format(tweet.id))
+        msg = resume_fanout_newsfeeds_task(0)
+        self.assertEqual(msg, 'No fanout job of tweet 0 to resume.')
+
+    def test_backfill_newsfeeds(self):
+        users = [self.create_user('reader{}'.format(i)) for i in range(3)]
+        tweets = [self.create_tweet(self.user1) for _ in range(3)]
+        for user in users:
+            for tweet in tweets:
+                NewsFeed.objects.create(user=user, tweet=tweet)
+        # newsfeeds of deleted tweets are skipped
+        newsfeed = NewsFeed.objects.create(user=users[0], tweet=self.create_tweet(self.user2))
+        NewsFeed.objects.filter(id=newsfeed.id).update(tweet=None)
+
+        # the first range stopped after its first batch
+        start_user_id = users[0].id
+        NewsFeedBackfillService.record_progress(
+            start_user_id,
+            start_user_id + 2,
+            next(NewsFeedBackfillService.iter_newsfeed_batches(start_user_id, start_user_id + 2, 2))[1],
+            0,
+            NewsFeedBackfillService.RUNNING,
+        )
+        out = StringIO()
+        call_command(
+            'backfill_newsfeeds_to_hbase',
+            range_size=2,
+            batch_size=2,
+            stdout=out,
+        )
+        self.assertIn('2 ranges of 2 users dispatched.', out.getvalue())
+        self.assertIn('2 of 2 ranges finished, 7 newsfeeds copied.', out.getvalue())
+        # 2 newsfeeds of the first batch skipped by the checkpoint
+        newsfeeds = HBaseNewsFeed.filter(prefix=(users[0].id, None))
+        self.assertEqual([newsfeed.tweet_id for newsfeed in newsfeeds], [tweets[2].id])
+        for user in users[1:]:
+            newsfeeds = HBaseNewsFeed.filter(prefix=(user.id, None))
+            self.assertEqual(
+                [(newsfeed.created_at, newsfeed.tweet_id) for newsfeed in newsfeeds],
+                [(tweet.timestamp, tweet.id) for tweet in tweets],
+            )
+
+        out = StringIO()
+        call_command('backfill_newsfeeds_to_hbase', range_size=2, stdout=out)
+        self.assertIn('0 ranges of 2 users dispatched.', out.getvalue())
+        msg = backfill_newsfeeds_range_task(start_user_id, start_user_id + 2, 2)
+        self.assertEqual(
+            msg,
+            'Backfill of users [{}, {}) already finished.'.format(start_user_id, start_user_id + 2),
+        )
+
+        out = StringIO()
+        call_command('backfill_newsfeeds_to_hbase', range_size=2, restart=True, stdout=out)
+        self.assertIn('2 of 2 ranges finished, 9 newsfeeds copied.', out.getvalue())
+        self.assertEqual(len(HBaseNewsFeed.filter(prefix=(users[0].id, None))), 3)
+
+        # newsfeeds created after the backfill are written to both
+        GateKeeper.turn_on('switch_newsfeed_dual_write_to_hbase')
+        self.create_friendship(users[1], self.user1)
+        tweet = self.create_tweet(self.user1)
+        fanout_newsfeeds_main_task(tweet.id, tweet.created_at, self.user1.id)
+        for user in [self.user1, users[1]]:
+            newsfeeds = HBaseNewsFeed.filter(prefix=(user.id, None), reverse=True)
+            self.assertEqual(
+                (newsfeeds[0].created_at, newsfeeds[0].tweet_id),
+                (tweet.timestamp, tweet.id),
+            )
+            self.assertEqual(NewsFeed.objects.filter(user=user, tweet=tweet).count(), 1)
@@ -5,7 +5,7 @@ from tweets.models import Tweet
 from rest_framework.test import APIClient
 from comments.models import Comment
 from likes.models import Like
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from django.core.cache import caches
 from utils.redis_client import RedisClient
 from friendships.services import FriendshipService
@@ -80,13 +80,20 @@ class TestCase(DjangoTestCase):
         client.force_authenticate(user)
         return user, client
 
-    def create_newsfeed(self, user, tweet):
+    def get_newsfeed_created_at(self, tweet):
+        # hbase newsfeeds are keyed by the timestamp of the tweet
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            created_at = tweet.timestamp
-        else:
-            created_at = tweet.created_at
+            return tweet.timestamp
+        return tweet.created_at
+
+    def create_newsfeed(self, user, tweet):
         return NewsFeedService.create(user_id=user.id, tweet_id=tweet.id,
-                                      created_at=created_at)
+                                      created_at=self.get_newsfeed_created_at(tweet))
+
+    def count_newsfeeds(self):
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            return len(HBaseNewsFeed.filter(prefix=(None, None)))
+        return NewsFeed.objects.count()
 
     def create_friendship(self, from_user, to_user):
         return FriendshipService.follow(from_user.id, to_user.id)
\ No newline at end of file
@@ -1,4 +1,5 @@
 from accounts.api.serializers import UserSerializerForTweet
+from accounts.services import UserService
 from comments.api.serializers import CommentSerializer
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
@@ -8,6 +9,7 @@ from rest_framework.exceptions import ValidationError
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.services import TweetService
 from utils.redis_helper import RedisHelper
+from utils.serializers import PrefetchListSerializer
 
 
 class TweetSerializer(serializers.ModelSerializer):
@@ -29,16 +31,38 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, tweets):
+        UserService.prefetch_users(tweets)
+        self._liked_object_ids = LikeService.get_liked_object_ids(
+            self.context['request'].user,
+            Tweet,
+            [tweet.id for tweet in tweets],
+        )
+        self._prefetched_counts = {
+            'likes_count': RedisHelper.get_counts(tweets, 'likes_count'),
+            'comments_count': RedisHelper.get_counts(tweets, 'comments_count'),
+        }
 
-    def get_likes_count(self, obj):
+    def _get_count(self, obj, attr):
         # N + 1 queries is not acceptable for db queries
-        # N + 1 queries is acceptable for redis/memcached
-        return RedisHelper.get_count(obj, 'likes_count')
+        # N + 1 queries is acceptable for redis/memcached,
+        # but a list page reads all counts in batch in prefetch.
+        prefetched_counts = getattr(self, '_prefetched_counts', {})
+        if obj.id in prefetched_counts.get(attr, {}):
+            return prefetched_counts[attr][obj.id]
+        return RedisHelper.get_count(obj, attr)
+
+    def get_likes_count(self, obj):
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
+        if hasattr(self, '_liked_object_ids'):
+            return obj.id in self._liked_object_ids
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
@@ -42,6 +42,9 @@ class Tweet(models.Model):
 
     @property
     def cached_user(self):
+        # set in batch by MemcachedHelper.prefetch_objects
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
     @property
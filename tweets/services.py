@@ -28,9 +28,18 @@ class TweetService(object):
     @classmethod
     def get_cached_tweets(cls, user_id):
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, lazy_load_tweets(user_id))
+        return RedisHelper.load_object_list(
+            key,
+            lazy_load_tweets(user_id),
+            sorted_set=RedisHelper.use_sorted_set(USER_TWEETS_PATTERN),
+        )
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, lazy_load_tweets(tweet.user_id))
\ No newline at end of file
+        RedisHelper.push_object(
+            key,
+            tweet,
+            lazy_load_tweets(tweet.user_id),
+            sorted_set=RedisHelper.use_sorted_set(USER_TWEETS_PATTERN),
+        )
\ No newline at end of file
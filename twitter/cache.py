@@ -1,7 +1,29 @@
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
\ No newline at end of file
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# set of the user ids a user follows, see FriendshipService
+FOLLOWINGS_PATTERN = 'followings:{user_id}'
+# the followings set being loaded, renamed to FOLLOWINGS_PATTERN when done
+FOLLOWINGS_LOADING_PATTERN = 'followings:{user_id}:loading:{token}'
+# users whose tweets are pulled instead of pushed to followers
+CELEBRITY_USER_IDS_KEY = 'celebrity_user_ids'
+# set of the celebrities a user follows, see NewsFeedService
+FOLLOWED_CELEBRITIES_PATTERN = 'followed_celebrities:{user_id}'
+# progress of the fanout of a tweet, see FanoutJobService
+FANOUT_JOB_PATTERN = 'fanout_job:{tweet_id}'
+# held by the worker running the fanout of a tweet, see FanoutJobService
+FANOUT_JOB_LEASE_PATTERN = 'fanout_job:{tweet_id}:lease'
+# progress of every user id range of the newsfeed backfill, see
+# NewsFeedBackfillService
+NEWSFEED_BACKFILL_KEY = 'newsfeed_backfill'
+# id of the last friendship copied to hbase, see migrate_friendships_to_hbase
+FRIENDSHIP_MIGRATION_CURSOR_KEY = 'friendship_migration_cursor'
+# cursor and status of the copy of HBaseFollowing rows to HBaseFriendship,
+# see backfill_hbase_friendships
+HBASE_FRIENDSHIP_BACKFILL_KEY = 'hbase_friendship_backfill'
+# users whose follower or following count changed since the last run of
+# repair_friendship_counts_main_task
+FRIENDSHIP_COUNTS_CHANGED_KEY = 'friendship_counts_changed_user_ids'
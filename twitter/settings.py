@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 
 from pathlib import Path
 from kombu import Queue
+from celery.schedules import crontab
 
 import sys
 
@@ -113,6 +114,21 @@ DATABASES = {
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+HBASE_PORT = 9090
+# thrift connections of each process, shared by its threads
+HBASE_POOL_SIZE = 10
+# seconds to wait for a free connection when all of them are in use
+HBASE_POOL_TIMEOUT = 5
+HBASE_SOCKET_TIMEOUT = 5000  # in milliseconds
+# 'thrift' talks to the hbase thrift server at HBASE_HOST through happybase,
+# 'memory' keeps tables in the process (django_hbase/memory_backend.py), to
+# run tests and benchmarks of the hbase paths without an hbase server
+HBASE_BACKEND = 'thrift'
+# Follows written to hbase before HBaseFriendship have no pair row until the
+# backfill_hbase_friendships command copied them. Turn on for such a
+# deployment until the backfill finished, lookups missing the pair row then
+# scan the followings of the user. Fresh installs leave it off.
+HBASE_FRIENDSHIP_LEGACY_LOOKUP = False
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -206,8 +222,32 @@ CACHES = {
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1
+# connection pool of each process, shared by its threads.
+# Wait up to REDIS_POOL_TIMEOUT seconds for a free connection when all
+# REDIS_MAX_CONNECTIONS are in use, see RedisClient.get_pool_metrics
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5  # in seconds
+REDIS_SOCKET_TIMEOUT = 5  # in seconds
+REDIS_SOCKET_CONNECT_TIMEOUT = 2  # in seconds
+# PING connections idle for longer than this before reusing them
+REDIS_HEALTH_CHECK_INTERVAL = 30  # in seconds
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# followings of a user following more users than this are not cached in a
+# redis set, see FriendshipService.get_following_user_id_set
+REDIS_FOLLOWINGS_SET_SIZE_LIMIT = 5000 if not TESTING else 20
+# cache django models in redis lists with CompactDjangoModelSerializer
+# instead of django json serialization, see utils/redis_serializers.py
+REDIS_USE_COMPACT_SERIALIZER = True
+# key patterns of twitter/cache.py cached as sorted sets scored by created_at
+# instead of lists. Switch them one by one, a key cached with the other
+# structure is reloaded from db on its next read.
+REDIS_SORTED_SET_PATTERNS = [
+    'user_newsfeeds:{user_id}',
+]
+# cache newsfeeds as (tweet_id, created_at) only, tweets are hydrated through
+# memcached, see utils.redis_serializers.NewsFeedIdSerializer
+REDIS_NEWSFEED_IDS_ONLY = True
 
 # Celery Configuration Options
 # Run worker（worker can be on different machine）separately
@@ -219,6 +259,19 @@ CELERY_QUEUES = (
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
+# Run beat separately for periodic tasks
+#   celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    # fix followers_count and followings_count drifting from friendships
+    'repair-friendship-counts': {
+        'task': 'friendships.tasks.repair_friendship_counts_main_task',
+        'schedule': crontab(hour=4, minute=0),
+    },
+}
+
+# Authors with at least this many followers don't fanout their tweets,
+# followers pull them when reading newsfeeds, see NewsFeedService.
+CELEBRITY_FOLLOWERS_THRESHOLD = 100000
 
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
@@ -24,7 +24,68 @@ class MemcachedHelper:
         cache.set(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        Batch version of get_object_through_cache.
+        One get_many for all keys, one id__in query and one set_many for all
+        the misses, no matter how many ids are given.
+        Returns {object_id: obj}, ids not found in db are left out.
+        """
+        object_ids = list(dict.fromkeys(
+            object_id for object_id in object_ids if object_id is not None
+        ))
+        if not object_ids:
+            return {}
+
+        key_to_id = {
+            cls.get_key(model_class, object_id): object_id
+            for object_id in object_ids
+        }
+        # cache hit
+        cached = cache.get_many(list(key_to_id.keys()))
+        objects = {key_to_id[key]: obj for key, obj in cached.items() if obj}
+
+        # cache miss
+        missing_ids = [
+            object_id
+            for object_id in object_ids
+            if object_id not in objects
+        ]
+        if not missing_ids:
+            return objects
+        to_cache = {}
+        for obj in model_class.objects.filter(id__in=missing_ids):
+            objects[obj.id] = obj
+            to_cache[cls.get_key(model_class, obj.id)] = obj
+        # using default expire time
+        cache.set_many(to_cache)
+        return objects
+
+    @classmethod
+    def prefetch_objects(cls, instances, model_class, id_attr, cached_attr):
+        """
+        Load the objects referenced by `id_attr` of all instances at once and
+        attach them as `cached_attr`, so that properties like `cached_user`
+        don't hit memcached once per instance.
+        """
+        # some instances may come with the object already
+        instances = [
+            instance
+            for instance in instances
+            if not hasattr(instance, cached_attr)
+        ]
+        objects = cls.get_objects_through_cache(
+            model_class,
+            [getattr(instance, id_attr) for instance in instances],
+        )
+        for instance in instances:
+            obj = objects.get(getattr(instance, id_attr))
+            # leave it unset, the property will fall back to the single get
+            if obj is not None:
+                setattr(instance, cached_attr, obj)
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
-        cache.delete(key)
\ No newline at end of file
+        cache.delete(key)
@@ -2,7 +2,9 @@ from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
 from dateutil import parser
 from django.conf import settings
+from utils.redis_helper import CachedSortedObjectList, MergedObjectList
 from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import datetime_to_timestamp
 
 
 class EndlessPagination(BasePagination):
@@ -18,14 +20,56 @@ class EndlessPagination(BasePagination):
     # TODO: When tweet is deleted, the deleted tweet can be cached somewhere else.
     # reverse_ordered_list could contain deleted ones,
     # skip the deleted ones by checking the cache.
+    def _parse_created_at(self, value):
+        # works for iso and int format timestamp
+        try:
+            return parser.isoparse(value)
+        except ValueError:
+            return int(value)
+
+    def _get_score(self, created_at):
+        # hbase cursors are micro seconds already
+        if isinstance(created_at, int):
+            return created_at
+        return datetime_to_timestamp(created_at)
+
+    def get_max_score(self, request):
+        # score of the created_at__lt cursor, None for the first page
+        if 'created_at__lt' not in request.query_params:
+            return None
+        return self._get_score(
+            self._parse_created_at(request.query_params['created_at__lt']))
+
+    def paginate_sorted_set(self, sorted_list, request):
+        # The cursor is turned into a score range of the sorted set,
+        # only the page itself is read from redis.
+        if 'created_at__gt' in request.query_params:
+            created_at__gt = self._parse_created_at(
+                request.query_params['created_at__gt'])
+            self.has_next_page = False
+            return sorted_list.filter_by_score(
+                min_score=self._get_score(created_at__gt),
+            )
+
+        if 'created_at__lt' in request.query_params:
+            objects = sorted_list.filter_by_score(
+                max_score=self.get_max_score(request),
+                limit=self.page_size + 1,
+            )
+        else:
+            objects = sorted_list[:self.page_size + 1]
+        self.has_next_page = len(objects) > self.page_size
+        return objects[:self.page_size]
+
     def paginate_ordered_list(self, reverse_ordered_list, request):
+        # reverse_ordered_list could be a list or a CachedObjectList,
+        # only len, index, slice and iteration are used here.
+        if isinstance(reverse_ordered_list, (CachedSortedObjectList, MergedObjectList)):
+            return self.paginate_sorted_set(reverse_ordered_list, request)
+
         if 'created_at__gt' in request.query_params:
-            # works for iso and int format timestamp
-            try:
-                created_at__gt = parser.isoparse(
-                    request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
+            created_at__gt = self._parse_created_at(
+                request.query_params['created_at__gt'])
             objects = []
             for obj in reverse_ordered_list:
                 if obj.created_at > created_at__gt:
@@ -37,21 +81,29 @@ class EndlessPagination(BasePagination):
 
         index = 0
         if 'created_at__lt' in request.query_params:
-            # works for iso and int format timestamp
-            try:
-                created_at__lt = parser.isoparse(
-                    request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # not found any objects which meet the criteria
-                reverse_ordered_list = []
+            created_at__lt = self._parse_created_at(
+                request.query_params['created_at__lt'])
+            # index == len(reverse_ordered_list) if not found any objects
+            # which meet the criteria
+            index = self._find_first_index_before(
+                reverse_ordered_list,
+                created_at__lt,
+            )
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
         return reverse_ordered_list[index: index + self.page_size]
 
+    def _find_first_index_before(self, reverse_ordered_list, created_at__lt):
+        # Binary search instead of a linear scan, reverse_ordered_list
+        # could be a CachedObjectList where every access is a redis read.
+        low, high = 0, len(reverse_ordered_list)
+        while low < high:
+            mid = (low + high) // 2
+            if reverse_ordered_list[mid].created_at < created_at__lt:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
     def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
             # created_at__gt is used for loading latest records.
@@ -135,7 +187,11 @@ class EndlessPagination(BasePagination):
         # when loading next page, has_next_page is false,
         # and cached_list length is smaller than the max limit.
         # This means cached_list has all the data, just return.
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        if isinstance(cached_list, MergedObjectList):
+            is_truncated = cached_list.is_truncated()
+        else:
+            is_truncated = len(cached_list) >= settings.REDIS_LIST_LENGTH_LIMIT
+        if not is_truncated:
             return paginated_list
 
         # other scenarios means some data exists in db but not in cache.
@@ -1,26 +1,110 @@
 from django.conf import settings
+from queue import Empty, LifoQueue
+import os
 import redis
+import threading
+import time
+
+
+class TimedLifoQueue(LifoQueue):
+    # Records how long callers blocked because every connection was in use.
+    # Created again with the queue in every pool reset, so the numbers
+    # are per process.
+
+    def __init__(self, maxsize=0):
+        super(TimedLifoQueue, self).__init__(maxsize)
+        self.wait_count = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def get(self, block=True, timeout=None):
+        try:
+            return super(TimedLifoQueue, self).get(block=False)
+        except Empty:
+            if not block:
+                raise
+        start = time.monotonic()
+        try:
+            return super(TimedLifoQueue, self).get(block, timeout)
+        finally:
+            wait_time = time.monotonic() - start
+            with self.mutex:
+                self.wait_count += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+
+class MeteredConnectionPool(redis.BlockingConnectionPool):
+    # Blocks up to timeout seconds when max_connections are all in use,
+    # instead of opening connections without limit.
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queue_class', TimedLifoQueue)
+        super(MeteredConnectionPool, self).__init__(**kwargs)
+
+    def get_metrics(self):
+        with self.pool.mutex:
+            # None is the placeholder of a connection not created yet
+            idle = sum(1 for connection in self.pool.queue if connection is not None)
+            wait_count = self.pool.wait_count
+            total_wait_time = self.pool.total_wait_time
+            max_wait_time = self.pool.max_wait_time
+        created = len(self._connections)
+        return {
+            'pid': self.pid,
+            'max_connections': self.max_connections,
+            'created': created,
+            'in_use': created - idle,
+            'idle': idle,
+            'wait_count': wait_count,
+            'total_wait_time': total_wait_time,
+            'max_wait_time': max_wait_time,
+        }
 
 
 class RedisClient:
     conn = None
+    pid = None
+    lock = threading.Lock()
 
     @classmethod
-    def get_connection(cls):
-        # Use singleton pattern to create one connection only.
-        if cls.conn:
-            return cls.conn
-        cls.conn = redis.Redis(
+    def create_connection_pool(cls):
+        return MeteredConnectionPool(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
         )
+
+    @classmethod
+    def get_connection(cls):
+        # Use singleton pattern to create one client per process, its pool
+        # is shared by all threads of the process. A forked process, like a
+        # celery prefork child, must not use the sockets of its parent, it
+        # creates its own client the first time it asks for one.
+        pid = os.getpid()
+        if cls.conn and cls.pid == pid:
+            return cls.conn
+        with cls.lock:
+            if cls.conn is None or cls.pid != pid:
+                cls.conn = redis.Redis(connection_pool=cls.create_connection_pool())
+                cls.pid = pid
         return cls.conn
 
+    @classmethod
+    def get_pool_metrics(cls):
+        # connections in use / idle and time spent waiting for a free one,
+        # for the current process
+        return cls.get_connection().connection_pool.get_metrics()
+
     @classmethod
     def clear(cls):
         # clear all keys in redis, for testing purpose
         if not settings.TESTING:
             raise Exception("You can not flush redis in production environment")
         conn = cls.get_connection()
-        conn.flushdb()
\ No newline at end of file
+        conn.flushdb()
@@ -1,15 +1,325 @@
 from django.conf import settings
+from redis.exceptions import ResponseError
 from utils.redis_client import RedisClient
-from utils.redis_serializers import DjangoModelSerializer
 from django_hbase.models import HBaseModel
-from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.redis_serializers import (
+    CompactDjangoModelSerializer,
+    DjangoModelSerializer,
+    HBaseModelSerializer,
+)
+from utils.time_helpers import datetime_to_timestamp
 
+import heapq
+
+
+def filter_by_score(reverse_ordered_list, max_score=None, min_score=None, limit=None):
+    """
+    Objects of a list sorted by score, the latest first, with a score between
+    the exclusive bounds, at most limit of them. The bounds are found by
+    binary search, reverse_ordered_list could be a CachedObjectList where
+    every access is a redis read.
+    """
+    start, stop = 0, len(reverse_ordered_list)
+    if max_score is not None:
+        start = _find_first_index(reverse_ordered_list, lambda score: score < max_score)
+    if min_score is not None:
+        stop = _find_first_index(reverse_ordered_list, lambda score: score <= min_score)
+    if limit is not None:
+        stop = min(stop, start + limit)
+    if start >= stop:
+        return []
+    return list(reverse_ordered_list[start:stop])
+
+
+def _find_first_index(reverse_ordered_list, condition):
+    # condition holds for a suffix of the list, len of the list if it is empty
+    low, high = 0, len(reverse_ordered_list)
+    while low < high:
+        mid = (low + high) // 2
+        if condition(RedisHelper.get_score(reverse_ordered_list[mid])):
+            high = mid
+        else:
+            low = mid + 1
+    return low
+
+
+class CachedObjectList:
+    """
+    Read-only, list-like view of a redis list of serialized objects.
+    Nothing is loaded upfront, indexing does LINDEX and slicing does LRANGE,
+    so a request only deserializes the part of the cached list it needs.
+    """
+    ITER_CHUNK_SIZE = 20
+
+    def __init__(self, key, serializer):
+        self.key = key
+        self.serializer = serializer
+        self._length = None
+        # index => deserialized object
+        self._loaded = {}
+
+    def __len__(self):
+        if self._length is None:
+            self._length = self._fetch_length()
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('{} does not support slice step'.format(
+                    self.__class__.__name__))
+            return self._load_range(start, stop)
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('{} index out of range'.format(
+                self.__class__.__name__))
+        if index not in self._loaded:
+            serialized_data = self._fetch_one(index)
+            if serialized_data is None:
+                raise IndexError('{} index out of range'.format(
+                    self.__class__.__name__))
+            self._loaded[index] = self.serializer.deserialize(serialized_data)
+        return self._loaded[index]
+
+    def __iter__(self):
+        start = 0
+        while start < len(self):
+            objects = self._load_range(start, start + self.ITER_CHUNK_SIZE)
+            if not objects:
+                return
+            yield from objects
+            start += self.ITER_CHUNK_SIZE
+
+    def _load_range(self, start, stop):
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        if any(index not in self._loaded for index in range(start, stop)):
+            serialized_list = self._fetch_range(start, stop)
+            for index, serialized_data in enumerate(serialized_list, start):
+                if index not in self._loaded:
+                    self._loaded[index] = self.serializer.deserialize(serialized_data)
+            # the list got trimmed by someone else in between
+            stop = start + len(serialized_list)
+        return [self._loaded[index] for index in range(start, stop)]
+
+    def filter_by_score(self, max_score=None, min_score=None, limit=None):
+        return filter_by_score(self, max_score, min_score, limit)
+
+    def _fetch_length(self):
+        conn = RedisClient.get_connection()
+        return conn.llen(self.key)
+
+    def _fetch_one(self, index):
+        conn = RedisClient.get_connection()
+        return conn.lindex(self.key, index)
+
+    def _fetch_range(self, start, stop):
+        conn = RedisClient.get_connection()
+        # lrange includes stop
+        return conn.lrange(self.key, start, stop - 1)
+
+
+class CachedSortedObjectList(CachedObjectList):
+    """
+    Same as CachedObjectList for a redis sorted set scored by created_at in
+    micro seconds, the latest first. It can also be read by score range,
+    which is how EndlessPagination finds a cursor without scanning.
+    """
+
+    def filter_by_score(self, max_score=None, min_score=None, limit=None):
+        # both bounds are exclusive, same as created_at__lt / created_at__gt
+        conn = RedisClient.get_connection()
+        serialized_list = conn.zrevrangebyscore(
+            self.key,
+            '({}'.format(max_score) if max_score is not None else '+inf',
+            '({}'.format(min_score) if min_score is not None else '-inf',
+            start=0 if limit is not None else None,
+            num=limit,
+        )
+        return [
+            self.serializer.deserialize(serialized_data)
+            for serialized_data in serialized_list
+        ]
+
+    def _fetch_length(self):
+        conn = RedisClient.get_connection()
+        return conn.zcard(self.key)
+
+    def _fetch_one(self, index):
+        serialized_list = self._fetch_range(index, index + 1)
+        return serialized_list[0] if serialized_list else None
+
+    def _fetch_range(self, start, stop):
+        conn = RedisClient.get_connection()
+        return conn.zrevrange(self.key, start, stop - 1)
+
+
+class MergedObjectList:
+    """
+    Read-only view of several lists sorted by score, the latest first, merged
+    on read. Like CachedSortedObjectList, only the window asked for is read:
+    every list is read within the same score bounds and limit, then the
+    windows are k-way merged. The lists are CachedObjectLists or the plain
+    lists load_object_list returns on a cache miss.
+
+    Objects are passed through convert, objects of the same unique_key as an
+    earlier one are left out, the one of the first list wins on equal scores.
+
+    A list of truncated_length objects or more is truncated, objects older
+    than its last one are missing from it. Nothing below the last score of a
+    truncated list is merged, the pages down there have to be read from db.
+    """
+
+    def __init__(self, object_lists, convert=None, unique_key=None,
+                 truncated_length=None):
+        self.object_lists = object_lists
+        self.convert = convert
+        self.unique_key = unique_key
+        self.truncated_length = truncated_length
+        self._min_score = None
+        self._min_score_loaded = False
+
+    def __len__(self):
+        # an upper bound for slicing only, duplicates and the objects below
+        # min_score are counted
+        return sum(len(object_list) for object_list in self.object_lists)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('{} does not support slice step'.format(
+                    self.__class__.__name__))
+            return self.filter_by_score(limit=stop)[start:]
+        return self.filter_by_score(limit=index + 1 if index >= 0 else None)[index]
+
+    def __iter__(self):
+        return iter(self.filter_by_score())
+
+    @property
+    def min_score(self):
+        # the last score of the truncated list which stops the earliest,
+        # None if no list is truncated
+        if self._min_score_loaded:
+            return self._min_score
+        if self.truncated_length is not None:
+            scores = [
+                RedisHelper.get_score(object_list[-1])
+                for object_list in self.object_lists
+                if len(object_list) >= self.truncated_length
+            ]
+            if scores:
+                self._min_score = max(scores)
+        self._min_score_loaded = True
+        return self._min_score
+
+    def is_truncated(self):
+        return self.min_score is not None
+
+    def filter_by_score(self, max_score=None, min_score=None, limit=None):
+        # scores are integers and the bounds are exclusive, objects at
+        # min_score itself are merged
+        if self.min_score is not None:
+            if min_score is None or min_score < self.min_score - 1:
+                min_score = self.min_score - 1
+        windows = []
+        for object_list in self.object_lists:
+            if isinstance(object_list, CachedObjectList):
+                objects = object_list.filter_by_score(max_score, min_score, limit)
+            else:
+                objects = filter_by_score(object_list, max_score, min_score, limit)
+            if self.convert is not None:
+                objects = [self.convert(obj) for obj in objects]
+            windows.append(objects)
+
+        merged = []
+        unique_keys = set()
+        for obj in heapq.merge(*windows, key=RedisHelper.get_score, reverse=True):
+            if limit is not None and len(merged) >= limit:
+                break
+            if self.unique_key is not None:
+                unique_key = self.unique_key(obj)
+                if unique_key in unique_keys:
+                    continue
+                unique_keys.add(unique_key)
+            merged.append(obj)
+        return merged
 
 
 class RedisHelper:
+    # whether the redis server has SMISMEMBER (6.2+), asked on first use
+    _has_smismember = None
+
+    @classmethod
+    def get_django_model_serializer(cls):
+        # Both serializers can read what the other one wrote,
+        # so the setting can be switched without flushing the cache.
+        if settings.REDIS_USE_COMPACT_SERIALIZER:
+            return CompactDjangoModelSerializer
+        return DjangoModelSerializer
+
+    @classmethod
+    def get_serializer(cls, obj):
+        if isinstance(obj, HBaseModel):
+            return HBaseModelSerializer
+        return cls.get_django_model_serializer()
+
+    @classmethod
+    def smismember(cls, key, members):
+        """
+        [whether member is in the set of key for member in members]
+        One SMISMEMBER on redis server 6.2+, a pipeline of SISMEMBER on older
+        servers. redis-py 3.5 has no smismember() either.
+        """
+        conn = RedisClient.get_connection()
+        if cls._has_smismember is None:
+            version = str(conn.info('server')['redis_version'])
+            cls._has_smismember = \
+                tuple(int(part) for part in version.split('.')[:2]) >= (6, 2)
+        if cls._has_smismember:
+            try:
+                flags = conn.execute_command('SMISMEMBER', key, *members)
+                return [bool(flag) for flag in flags]
+            except ResponseError as e:
+                # e.g. a proxy in front of the server not knowing the command
+                if 'unknown command' not in str(e).lower():
+                    raise
+                cls._has_smismember = False
+        pipeline = conn.pipeline(transaction=False)
+        for member in members:
+            pipeline.sismember(key, member)
+        return pipeline.execute()
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects, serializer):
+    def use_sorted_set(cls, key_pattern):
+        return key_pattern in settings.REDIS_SORTED_SET_PATTERNS
+
+    @classmethod
+    def get_score(cls, obj):
+        # hbase models store created_at as micro seconds already
+        if isinstance(obj.created_at, int):
+            return obj.created_at
+        return datetime_to_timestamp(obj.created_at)
+
+    @classmethod
+    def _is_cached(cls, conn, key, sorted_set):
+        # TYPE costs the same as EXISTS, and tells us whether the key was
+        # cached with the other structure before the pattern got switched.
+        # Drop it in that case so that it is loaded again.
+        key_type = conn.type(key)
+        if key_type == b'none':
+            return False
+        if key_type == (b'zset' if sorted_set else b'list'):
+            return True
+        conn.delete(key)
+        return False
+
+    @classmethod
+    def _load_objects_to_cache(cls, key, objects, serializer, sorted_set=False):
         conn = RedisClient.get_connection()
 
         serialized_list = []
@@ -21,13 +331,21 @@ class RedisHelper:
             serialized_data = serializer.serialize(obj)
             serialized_list.append(serialized_data)
 
-        if serialized_list:
+        if not serialized_list:
+            return
+        if sorted_set:
+            conn.zadd(key, {
+                serialized_data: cls.get_score(obj)
+                for obj, serialized_data in zip(objects, serialized_list)
+            })
+        else:
             conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
 
     @classmethod
-    def load_objects(cls, key, lazy_load_objects,
-                     serializer=DjangoModelSerializer):
+    def load_objects(cls, key, lazy_load_objects, serializer=None):
+        if serializer is None:
+            serializer = cls.get_django_model_serializer()
         conn = RedisClient.get_connection()
 
         if conn.exists(key):
@@ -45,24 +363,90 @@ class RedisHelper:
         return list(objects)
 
     @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
-        if isinstance(obj, HBaseModel):
-            serializer = HBaseModelSerializer
-        else:
-            serializer = DjangoModelSerializer
+    def load_object_list(cls, key, lazy_load_objects, serializer=None,
+                         sorted_set=False):
+        """
+        Same as load_objects, but doesn't LRANGE the whole list when the key
+        exists. Returns a CachedObjectList (or CachedSortedObjectList if the
+        key is cached as a sorted set) which loads objects on demand.
+        """
+        if serializer is None:
+            serializer = cls.get_django_model_serializer()
+        conn = RedisClient.get_connection()
+
+        if cls._is_cached(conn, key, sorted_set):
+            if sorted_set:
+                return CachedSortedObjectList(key, serializer)
+            return CachedObjectList(key, serializer)
 
+        objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+        cls._load_objects_to_cache(key, objects, serializer, sorted_set)
+        return objects
+
+    @classmethod
+    def push_object(cls, key, obj, lazy_load_objects, serializer=None,
+                    sorted_set=False):
+        if serializer is None:
+            serializer = cls.get_serializer(obj)
         conn = RedisClient.get_connection()
 
-        if conn.exists(key):
+        if cls._is_cached(conn, key, sorted_set):
             serialized_data = serializer.serialize(obj)
+            if sorted_set:
+                # ZADD is idempotent and keeps the order by created_at even
+                # if fanout tasks finish out of order.
+                pipeline = conn.pipeline()
+                pipeline.zadd(key, {serialized_data: cls.get_score(obj)})
+                # keep the latest REDIS_LIST_LENGTH_LIMIT objects
+                pipeline.zremrangebyrank(key, 0, -settings.REDIS_LIST_LENGTH_LIMIT - 1)
+                pipeline.execute()
+                return
             conn.lpush(key, serialized_data)
             conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
             return
 
         # If key doesn't exist, load from db,
         # instead of pushing the single object to cache.
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
+        objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+        cls._load_objects_to_cache(key, objects, serializer, sorted_set)
+
+    @classmethod
+    def push_objects_to_warm_keys(cls, items, sorted_set=False):
+        """
+        items are (key, obj, serializer) tuples, pushed in two round trips
+        no matter how many keys: TYPE of all keys, then the writes.
+        Unlike push_object, cold keys are skipped instead of loaded from db,
+        they get loaded on their next read, which sees the new objects.
+        returns (warm_count, skipped_count)
+        """
+        if not items:
+            return 0, 0
+        conn = RedisClient.get_connection()
+
+        pipeline = conn.pipeline(transaction=False)
+        for key, _, _ in items:
+            pipeline.type(key)
+        key_types = pipeline.execute()
+
+        warm_count, skipped_count = 0, 0
+        pipeline = conn.pipeline(transaction=False)
+        for (key, obj, serializer), key_type in zip(items, key_types):
+            if key_type != (b'zset' if sorted_set else b'list'):
+                # same as _is_cached, drop the key cached with the other structure
+                if key_type != b'none':
+                    pipeline.delete(key)
+                skipped_count += 1
+                continue
+            serialized_data = serializer.serialize(obj)
+            if sorted_set:
+                pipeline.zadd(key, {serialized_data: cls.get_score(obj)})
+                pipeline.zremrangebyrank(key, 0, -settings.REDIS_LIST_LENGTH_LIMIT - 1)
+            else:
+                pipeline.lpush(key, serialized_data)
+                pipeline.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+            warm_count += 1
+        pipeline.execute()
+        return warm_count, skipped_count
 
     @classmethod
     def get_count_key(cls, obj, attr):
@@ -110,3 +494,42 @@ class RedisHelper:
         count = getattr(obj, attr)
         conn.set(key, count)
         return count
+
+    @classmethod
+    def get_counts(cls, objects, attr):
+        """
+        Batch version of get_count for a page of objects of the same model.
+        One MGET for all keys, one id__in query to back fill the misses and
+        one pipeline to write them back, instead of one round trip per object.
+        Returns {obj.id: count}, every given object gets a count, the ones
+        deleted from db in the meantime get 0.
+        """
+        if not objects:
+            return {}
+        conn = RedisClient.get_connection()
+        id_to_key = {obj.id: cls.get_count_key(obj, attr) for obj in objects}
+        object_ids = list(id_to_key.keys())
+
+        counts = {}
+        missing_ids = []
+        for object_id, count in zip(object_ids, conn.mget(list(id_to_key.values()))):
+            if count is not None:
+                counts[object_id] = int(count)
+            else:
+                missing_ids.append(object_id)
+        if not missing_ids:
+            return counts
+
+        # back fill cache from db
+        model_class = objects[0].__class__
+        pipeline = conn.pipeline()
+        rows = model_class.objects.filter(id__in=missing_ids).values_list('id', attr)
+        for object_id, count in rows:
+            count = count or 0
+            counts[object_id] = count
+            pipeline.set(id_to_key[object_id], count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        pipeline.execute()
+        # deleted objects, nothing to back fill
+        for object_id in missing_ids:
+            counts.setdefault(object_id, 0)
+        return counts
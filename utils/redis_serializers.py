@@ -1,8 +1,11 @@
+from django.apps import apps
 from django.core import serializers
 from utils.json_encoder import JSONEncoder
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
 from django_hbase.models import HBaseModel
 
 import json
+import struct
 
 
 class DjangoModelSerializer:
@@ -15,10 +18,243 @@ class DjangoModelSerializer:
 
     @classmethod
     def deserialize(cls, serialized_data):
+        # The same cached list could contain both formats while switching
+        # REDIS_USE_COMPACT_SERIALIZER on or off.
+        if CompactDjangoModelSerializer.is_compact(serialized_data):
+            return CompactDjangoModelSerializer.deserialize(serialized_data)
         # Note `.object` is to get ORM object. Otherwise, it is a DeserializedObject.
         return list(serializers.deserialize('json', serialized_data))[0].object
 
 
+INT64 = struct.Struct('<q')
+UINT32 = struct.Struct('<I')
+UINT8 = struct.Struct('<B')
+BOOL = struct.Struct('<?')
+FLOAT64 = struct.Struct('<d')
+
+
+def _pack_struct(fmt):
+    def _pack(value):
+        return fmt.pack(value)
+    return _pack
+
+
+def _unpack_struct(fmt):
+    def _unpack(data, offset):
+        return fmt.unpack_from(data, offset)[0], offset + fmt.size
+    return _unpack
+
+
+def _pack_datetime(value):
+    return INT64.pack(datetime_to_timestamp(value))
+
+
+def _unpack_datetime(data, offset):
+    value = INT64.unpack_from(data, offset)[0]
+    return timestamp_to_datetime(value), offset + INT64.size
+
+
+def _pack_str(value):
+    value = str(value).encode('utf-8')
+    return UINT32.pack(len(value)) + value
+
+
+def _unpack_str(data, offset):
+    length = UINT32.unpack_from(data, offset)[0]
+    offset += UINT32.size
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+INT_CODEC = (_pack_struct(INT64), _unpack_struct(INT64))
+STR_CODEC = (_pack_str, _unpack_str)
+
+FIELD_CODECS = {
+    'AutoField': INT_CODEC,
+    'BigAutoField': INT_CODEC,
+    'SmallAutoField': INT_CODEC,
+    'IntegerField': INT_CODEC,
+    'BigIntegerField': INT_CODEC,
+    'SmallIntegerField': INT_CODEC,
+    'PositiveIntegerField': INT_CODEC,
+    'PositiveBigIntegerField': INT_CODEC,
+    'PositiveSmallIntegerField': INT_CODEC,
+    'BooleanField': (_pack_struct(BOOL), _unpack_struct(BOOL)),
+    'FloatField': (_pack_struct(FLOAT64), _unpack_struct(FLOAT64)),
+    'DateTimeField': (_pack_datetime, _unpack_datetime),
+    'CharField': STR_CODEC,
+    'TextField': STR_CODEC,
+    'EmailField': STR_CODEC,
+    'SlugField': STR_CODEC,
+    'URLField': STR_CODEC,
+    # the file name is stored, FileDescriptor wraps it back to FieldFile
+    'FileField': STR_CODEC,
+}
+
+
+class CompactDjangoModelSerializer:
+    """
+    Pack a model instance as a fixed tuple of its concrete fields instead of
+    going through Django's json serialization framework.
+
+    Layout:
+        version (1 byte) | model label length (1 byte) | model label |
+        field count (1 byte) | null bitmap | non-null values in field order
+
+    The field list is derived from model._meta.concrete_fields. Fields are
+    decoded by position, so a new field appended to the model can still read
+    entries cached before the migration (the new field is left deferred).
+    Removing or reordering fields requires flushing the cached lists.
+    """
+    VERSION = 1
+
+    # model class => (label bytes, [(attname, pack, unpack)])
+    _schemas = {}
+    # label bytes => model class
+    _models = {}
+
+    @classmethod
+    def get_schema(cls, model_class):
+        if model_class in cls._schemas:
+            return cls._schemas[model_class]
+        fields = []
+        for field in model_class._meta.concrete_fields:
+            internal_type = field.get_internal_type()
+            if field.is_relation:
+                internal_type = field.target_field.get_internal_type()
+            if internal_type not in FIELD_CODECS:
+                raise NotImplementedError(
+                    '{}.{} ({}) is not supported by {}'.format(
+                        model_class.__name__,
+                        field.name,
+                        internal_type,
+                        cls.__name__,
+                    ))
+            pack, unpack = FIELD_CODECS[internal_type]
+            fields.append((field.attname, pack, unpack))
+        label = model_class._meta.label_lower.encode('utf-8')
+        cls._schemas[model_class] = (label, fields)
+        cls._models[label] = model_class
+        return cls._schemas[model_class]
+
+    @classmethod
+    def get_model_class(cls, label):
+        if label not in cls._models:
+            model_class = apps.get_model(label.decode('utf-8'))
+            cls.get_schema(model_class)
+        return cls._models[label]
+
+    @classmethod
+    def is_compact(cls, serialized_data):
+        # json payload always starts with '['
+        return isinstance(serialized_data, bytes) and \
+            serialized_data[:1] == bytes([cls.VERSION])
+
+    @classmethod
+    def serialize(cls, instance):
+        label, fields = cls.get_schema(instance.__class__)
+        null_bitmap = 0
+        values = []
+        for index, (attname, pack, _) in enumerate(fields):
+            value = getattr(instance, attname)
+            if value is None:
+                null_bitmap |= 1 << index
+                continue
+            values.append(pack(value))
+        bitmap_size = (len(fields) + 7) // 8
+        return b''.join([
+            UINT8.pack(cls.VERSION),
+            UINT8.pack(len(label)),
+            label,
+            UINT8.pack(len(fields)),
+            null_bitmap.to_bytes(bitmap_size, 'little'),
+            *values,
+        ])
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        # lists cached in json before REDIS_USE_COMPACT_SERIALIZER was
+        # turned on are still read until they expire
+        if not cls.is_compact(serialized_data):
+            return list(serializers.deserialize('json', serialized_data))[0].object
+        offset = 1
+        label_length = serialized_data[offset]
+        offset += 1
+        label = serialized_data[offset:offset + label_length]
+        offset += label_length
+        model_class = cls.get_model_class(label)
+        _, fields = cls.get_schema(model_class)
+
+        field_count = serialized_data[offset]
+        offset += 1
+        if field_count > len(fields):
+            raise ValueError(
+                'Cached {} has {} fields but the model has {}, '
+                'flush the cache after removing fields'.format(
+                    model_class.__name__, field_count, len(fields),
+                ))
+        bitmap_size = (field_count + 7) // 8
+        null_bitmap = int.from_bytes(
+            serialized_data[offset:offset + bitmap_size],
+            'little',
+        )
+        offset += bitmap_size
+
+        field_names = []
+        values = []
+        for index, (attname, _, unpack) in enumerate(fields[:field_count]):
+            field_names.append(attname)
+            if null_bitmap & (1 << index):
+                values.append(None)
+                continue
+            value, offset = unpack(serialized_data, offset)
+            values.append(value)
+        return model_class.from_db(None, field_names, values)
+
+
+class NewsFeedIdSerializer:
+    """
+    Cache a newsfeed as (tweet_id, created_at) only, 17 bytes per entry.
+    user_id is known from the cache key and the tweet is hydrated through
+    memcached in batch (see NewsFeedSerializer.prefetch), so a celebrity
+    fanout doesn't copy the same serialized newsfeed into every follower's
+    cache.
+
+    Entries written by model_serializer can still be read, so ids_only can
+    be switched either way without flushing.
+    """
+    MARKER = 2
+    ENTRY = struct.Struct('<Bqq')
+
+    def __init__(self, model_class, user_id, model_serializer, ids_only=True):
+        # NewsFeed or HBaseNewsFeed
+        self.model_class = model_class
+        self.user_id = user_id
+        self.model_serializer = model_serializer
+        self.ids_only = ids_only
+
+    def serialize(self, instance):
+        if not self.ids_only:
+            return self.model_serializer.serialize(instance)
+        created_at = instance.created_at
+        # hbase models store created_at as micro seconds already
+        if not isinstance(created_at, int):
+            created_at = datetime_to_timestamp(created_at)
+        return self.ENTRY.pack(self.MARKER, instance.tweet_id, created_at)
+
+    def deserialize(self, serialized_data):
+        if len(serialized_data) != self.ENTRY.size or \
+                serialized_data[0] != self.MARKER:
+            return self.model_serializer.deserialize(serialized_data)
+        _, tweet_id, created_at = self.ENTRY.unpack(serialized_data)
+        if not issubclass(self.model_class, HBaseModel):
+            created_at = timestamp_to_datetime(created_at)
+        return self.model_class(
+            user_id=self.user_id,
+            tweet_id=tweet_id,
+            created_at=created_at,
+        )
+
+
 class HBaseModelSerializer:
 
     @classmethod
@@ -0,0 +1,23 @@
+from django.db import models
+from rest_framework import serializers
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    ListSerializer renders items one by one, every cached_xxx property
+    then costs one cache round trip per item.
+    Give the child serializer a chance to load what the whole page needs
+    in batch before rendering, via child.prefetch(instances).
+
+    Usage:
+        class Meta:
+            list_serializer_class = PrefetchListSerializer
+    """
+
+    def to_representation(self, data):
+        # same as ListSerializer, data could be a manager like comment_set
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        if instances:
+            self.child.prefetch(instances)
+        return super(PrefetchListSerializer, self).to_representation(instances)
@@ -1,5 +1,14 @@
+from django.contrib.auth.models import User
 from testing.testcases import TestCase
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_client import RedisClient
+from utils.redis_helper import CachedObjectList, RedisHelper
+from utils.redis_serializers import (
+    CompactDjangoModelSerializer,
+    DjangoModelSerializer,
+)
+
+import threading
 
 
 class UtilsTests(TestCase):
@@ -17,3 +26,164 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_get_objects_through_cache(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        self.clear_cache()
+
+        # cache miss, loaded in one query
+        with self.assertNumQueries(1):
+            users = MemcachedHelper.get_objects_through_cache(
+                User,
+                [user2.id, user1.id, user2.id, -1],
+            )
+        self.assertEqual(set(users.keys()), {user1.id, user2.id})
+        self.assertEqual(users[user1.id].username, 'user1')
+
+        # cache hit, no query
+        with self.assertNumQueries(0):
+            users = MemcachedHelper.get_objects_through_cache(
+                User,
+                [user1.id, user2.id],
+            )
+        self.assertEqual(users[user2.id].username, 'user2')
+
+        self.assertEqual(MemcachedHelper.get_objects_through_cache(User, []), {})
+
+    def test_get_counts(self):
+        user = self.create_user('user1')
+        tweet1 = self.create_tweet(user)
+        tweet2 = self.create_tweet(user)
+        self.create_like(user, tweet1)
+        RedisClient.clear()
+
+        # cache miss, back filled with one query
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts([tweet1, tweet2], 'likes_count')
+        self.assertEqual(counts, {tweet1.id: 1, tweet2.id: 0})
+
+        # cache hit
+        with self.assertNumQueries(0):
+            counts = RedisHelper.get_counts([tweet1, tweet2], 'likes_count')
+        self.assertEqual(counts, {tweet1.id: 1, tweet2.id: 0})
+        self.assertEqual(RedisHelper.get_count(tweet1, 'likes_count'), 1)
+
+        self.assertEqual(RedisHelper.get_counts([], 'likes_count'), {})
+
+        # deleted objects count as 0 and are not cached
+        RedisClient.clear()
+        tweet2_id = tweet2.id
+        tweet2.delete()
+        tweet2.id = tweet2_id
+        counts = RedisHelper.get_counts([tweet1, tweet2], 'likes_count')
+        self.assertEqual(counts, {tweet1.id: 1, tweet2.id: 0})
+        conn = RedisClient.get_connection()
+        self.assertFalse(conn.exists(RedisHelper.get_count_key(tweet2, 'likes_count')))
+
+    def test_compact_serializer(self):
+        user = self.create_user('user1')
+        tweet = self.create_tweet(user, 'compact content')
+        newsfeed = self.create_newsfeed(user, tweet)
+
+        for instance in [tweet, newsfeed]:
+            data = CompactDjangoModelSerializer.serialize(instance)
+            self.assertEqual(CompactDjangoModelSerializer.is_compact(data), True)
+            self.assertLess(len(data), len(DjangoModelSerializer.serialize(instance)))
+            obj = CompactDjangoModelSerializer.deserialize(data)
+            self.assertEqual(obj.__class__, instance.__class__)
+            for field in instance._meta.concrete_fields:
+                self.assertEqual(
+                    getattr(obj, field.attname),
+                    getattr(instance, field.attname),
+                )
+
+        # null values
+        tweet.likes_count = None
+        obj = CompactDjangoModelSerializer.deserialize(
+            CompactDjangoModelSerializer.serialize(tweet),
+        )
+        self.assertEqual(obj.likes_count, None)
+        self.assertEqual(obj.content, 'compact content')
+
+        # both serializers read both formats
+        json_data = DjangoModelSerializer.serialize(tweet).encode('utf-8')
+        compact_data = CompactDjangoModelSerializer.serialize(tweet)
+        self.assertEqual(CompactDjangoModelSerializer.is_compact(json_data), False)
+        self.assertEqual(DjangoModelSerializer.deserialize(compact_data).id, tweet.id)
+        self.assertEqual(CompactDjangoModelSerializer.deserialize(json_data).id, tweet.id)
+
+    def test_compact_serializer_switch(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for i in range(3)][::-1]
+
+        def lazy_load(limit):
+            return tweets[:limit]
+
+        # the list is cached in json before the flag is turned on
+        with self.settings(REDIS_USE_COMPACT_SERIALIZER=False):
+            RedisHelper.load_object_list('tweets', lazy_load)
+        with self.settings(REDIS_USE_COMPACT_SERIALIZER=True):
+            objects = RedisHelper.load_object_list('tweets', lazy_load)
+            self.assertEqual(isinstance(objects, CachedObjectList), True)
+            self.assertEqual([t.id for t in objects], [t.id for t in tweets])
+            # new entries are compact, old ones are still json
+            RedisHelper.push_object('tweets', self.create_tweet(user), lazy_load)
+            objects = RedisHelper.load_object_list('tweets', lazy_load)
+            self.assertEqual(len(objects), 4)
+            self.assertEqual([t.id for t in objects[1:]], [t.id for t in tweets])
+
+    def test_load_object_list(self):
+        user = self.create_user('user1')
+        tweets = [self.create_tweet(user) for i in range(5)][::-1]
+        RedisClient.clear()
+
+        def lazy_load(limit):
+            return tweets[:limit]
+
+        # cache miss returns the loaded list
+        objects = RedisHelper.load_object_list('tweets', lazy_load)
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets])
+
+        # cache hit loads on demand
+        objects = RedisHelper.load_object_list('tweets', lazy_load)
+        self.assertEqual(isinstance(objects, CachedObjectList), True)
+        self.assertEqual(len(objects), 5)
+        self.assertEqual(objects[1].id, tweets[1].id)
+        self.assertEqual(objects[-1].id, tweets[-1].id)
+        self.assertEqual([t.id for t in objects[1:3]], [t.id for t in tweets[1:3]])
+        self.assertEqual(objects[4:10][0].id, tweets[4].id)
+        self.assertEqual(objects[5:10], [])
+        self.assertEqual([t.id for t in objects], [t.id for t in tweets])
+        with self.assertRaises(IndexError):
+            objects[5]
+
+    def test_redis_client(self):
+        conn = RedisClient.get_connection()
+        self.assertEqual(RedisClient.get_connection() is conn, True)
+        conn.set('key', 'value')
+        metrics = RedisClient.get_pool_metrics()
+        self.assertEqual(metrics['in_use'], 0)
+        self.assertEqual(metrics['idle'], metrics['created'])
+
+        # a forked process creates its own client
+        RedisClient.pid = -1
+        self.assertEqual(RedisClient.get_connection() is conn, False)
+        self.assertEqual(RedisClient.get_connection().get('key'), b'value')
+
+    def test_redis_pool_wait(self):
+        with self.settings(REDIS_MAX_CONNECTIONS=1):
+            pool = RedisClient.create_connection_pool()
+        connection = pool.get_connection('GET')
+        self.assertEqual(pool.get_metrics()['in_use'], 1)
+        self.assertEqual(pool.get_metrics()['idle'], 0)
+
+        # blocks until the only connection is released
+        timer = threading.Timer(0.1, pool.release, [connection])
+        timer.start()
+        self.assertEqual(pool.get_connection('GET') is connection, True)
+        timer.join()
+        metrics = pool.get_metrics()
+        self.assertEqual(metrics['wait_count'], 1)
+        self.assertEqual(metrics['max_wait_time'] > 0, True)
+        pool.disconnect()
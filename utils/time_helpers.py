@@ -1,6 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_timestamp(value):
+    # in micro seconds,
+    # integer arithmetic instead of value.timestamp() keeps micro seconds exact
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=pytz.utc)
+    return (value - EPOCH) // ONE_MICROSECOND
+
+
+def timestamp_to_datetime(value):
+    return EPOCH + timedelta(microseconds=value)